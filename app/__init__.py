@@ -60,6 +60,13 @@ def create_app(config_class=Config):
     from app.playlists import bp as playlists_bp
     app.register_blueprint(playlists_bp)
 
+    #--- Background Jobs ---#
+    from app.playlists.jobs import runner
+    runner.init_app(app)
+
+    from app.main.last_seen import last_seen
+    last_seen.init_app(app)
+
     from app import models
 
     return app
@@ -1,11 +1,12 @@
 import os
-from flask import redirect, url_for, session, request, flash
+from flask import redirect, url_for, session, request, flash, jsonify
 from flask_login import current_user, login_required
 from app import db
 from app.misc import misc
 from app.models import Service
 from app.auth_external import bp
-from app.auth_external.services import Spotify, Youtube
+from app.auth_external.services import Spotify, Youtube, clients, searches
+from app.auth_external.scheduler import schedulers
 
 # a universal path for logging into services
 @bp.route('/auth_login/<service>', methods=['GET', 'POST'])
@@ -49,6 +50,8 @@ def auth_login(service):
 @bp.route("/auth_redirect/<service>")
 def auth_redirect(service):
     if current_user.is_authenticated:
+        clients.discard(current_user.id, service)
+
         if service == 'spotify':
             db_sp = Service.query.filter_by(
                 user_id=current_user.id,
@@ -89,3 +92,15 @@ def auth_redirect(service):
     else:
         flash('Please log in to access this page')
         return redirect(url_for('auth_internal.login'))
+
+# reports the remaining call budget of each service: current rate, pauses and quota left
+@bp.route('/rate_limits')
+@login_required
+def rate_limits():
+    return jsonify({name: scheduler.status() for name, scheduler in schedulers.items()})
+
+# reports the hits and misses of the shared search cache
+@bp.route('/search_cache')
+@login_required
+def search_cache():
+    return jsonify(searches.status())
@@ -0,0 +1,220 @@
+import random
+import threading
+from contextvars import ContextVar
+from time import time, sleep
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from config import Config
+
+# raised when a call would go over a service's daily quota
+class QuotaExceeded(Exception):
+    pass
+
+# raised by a scheduled call when the service asks to be retried later (e.g. a 429)
+# retry_after is the number of seconds the service asked to wait, if it said
+class RateLimited(Exception):
+
+    def __init__(self, retry_after=None):
+        super().__init__(f'Rate limited, retry after {retry_after}s')
+        self.retry_after = retry_after
+
+# counts the calls made to each endpoint of each service on behalf of a piece of
+# work, e.g. a playlist refresh. calls are counted by whichever report is
+# current_report in the calling context, so threads doing the work have to be
+# started in a copy of its context (see contextvars.copy_context)
+class CallReport():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {} # service name -> endpoint -> number of calls
+
+    def record(self, service, endpoint):
+        with self.lock:
+            endpoints = self.calls.setdefault(service, {})
+            endpoints[endpoint] = endpoints.get(endpoint, 0) + 1
+
+    # returns the calls made to each endpoint and the total per service
+    def snapshot(self):
+        with self.lock:
+            return {
+                service: dict(endpoints, total=sum(endpoints.values()))
+                for service, endpoints in self.calls.items()}
+
+current_report = ContextVar('current_report', default=None)
+
+# limits calls to a steady rate while allowing short bursts
+# the rate is halved whenever the service rate limits a call and recovers
+# gradually with every successful call, so it settles just below the
+# highest rate the service accepts
+class TokenBucket():
+
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def fill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # blocks until a call can be made
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time()
+                self.fill(now)
+
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+
+            sleep(wait)
+
+    # stops every call for the given number of seconds and slows the rate down
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time() + seconds)
+            self.rate = max(self.rate / 2, self.max_rate / 16)
+
+    def recover(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+# counts the quota units a service's calls cost against a daily limit
+# quota is accounted per process, and resets at midnight in the service's timezone
+class Quota():
+
+    def __init__(self, limit, costs, timezone):
+        self.limit = limit
+        self.costs = costs # endpoint -> units, calls to other endpoints cost 1
+        self.timezone = ZoneInfo(timezone)
+        self.used = 0
+        self.resets_at = self.next_reset()
+        self.lock = threading.Lock()
+
+    def next_reset(self):
+        now = datetime.now(self.timezone)
+        return (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+
+    def cost(self, endpoint):
+        return self.costs.get(endpoint, 1)
+
+    # reserves the units calls to the given endpoints will cost, raising
+    # QuotaExceeded without spending any if there are not enough left for all of them
+    def spend(self, endpoints):
+        cost = sum(self.cost(endpoint) for endpoint in endpoints)
+
+        with self.lock:
+            if time() >= self.resets_at:
+                self.used = 0
+                self.resets_at = self.next_reset()
+
+            if self.used + cost > self.limit:
+                raise QuotaExceeded(
+                    f'{", ".join(sorted(set(endpoints)))} cost {cost} units, {self.limit - self.used} left until the quota resets')
+
+            self.used += cost
+
+    # marks the quota as used up, e.g. when the service reports it is
+    def exhaust(self):
+        with self.lock:
+            self.used = self.limit
+
+    def remaining(self):
+        with self.lock:
+            return max(self.limit - self.used, 0)
+
+# schedules the outbound calls of every client of a service
+# calls wait for the service's token bucket, spend its quota and are retried
+# with jittered backoff when the service rate limits them
+class ServiceScheduler():
+
+    def __init__(self, name, rate, burst, quota=None):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.quota = quota
+        self.calls = {} # endpoint -> number of calls made
+        self.limited = 0 # number of calls that were rate limited
+        self.batches = 0 # number of batches of calls sent in a single request
+        self.lock = threading.Lock()
+
+    # makes a call to an endpoint of the service and returns its result
+    # call raises RateLimited to have the call retried after a backoff
+    # a call sending a batch of requests in one round trip (see Youtube.execute_batch)
+    # passes the endpoint of each request as batch instead. it only waits for the
+    # token bucket once, but every request in it spends quota and is counted
+    def call(self, endpoint, call, batch=None):
+        endpoints = [endpoint] if batch is None else batch
+
+        for attempt in range(Config.RATE_LIMIT_RETRIES + 1):
+            self.bucket.acquire()
+
+            if self.quota:
+                self.quota.spend(endpoints)
+
+            with self.lock:
+                for e in endpoints:
+                    self.calls[e] = self.calls.get(e, 0) + 1
+                if batch is not None:
+                    self.batches += 1
+
+            report = current_report.get()
+            if report is not None:
+                for e in endpoints:
+                    report.record(self.name, e)
+
+            try:
+                result = call()
+            except RateLimited as e:
+                with self.lock:
+                    self.limited += 1
+
+                if attempt == Config.RATE_LIMIT_RETRIES:
+                    raise
+
+                # honors the service's Retry-After, otherwise backs off exponentially
+                # jitter keeps the paused calls from all retrying at the same moment
+                delay = e.retry_after if e.retry_after is not None else 2 ** attempt
+                self.bucket.pause(delay + random.uniform(0, 1))
+                continue
+
+            self.bucket.recover()
+            return result
+
+    # returns the scheduler's current budget and usage
+    def status(self):
+        with self.lock:
+            status = {
+                'rate': round(self.bucket.rate, 2),
+                'max_rate': self.bucket.max_rate,
+                'paused_for': round(max(self.bucket.paused_until - time(), 0), 2),
+                'rate_limited_calls': self.limited,
+                'batches': self.batches,
+                'calls': dict(self.calls)}
+
+        if self.quota:
+            status.update({
+                'quota_limit': self.quota.limit,
+                'quota_remaining': self.quota.remaining(),
+                'quota_resets_at': datetime.utcfromtimestamp(self.quota.resets_at).isoformat() + 'Z'})
+
+        return status
+
+# service name -> scheduler of its calls, shared by every user's client
+schedulers = {
+    'spotify': ServiceScheduler(
+        'spotify',
+        Config.SPOTIFY_RATE_LIMIT,
+        Config.SPOTIFY_BURST),
+    'youtube': ServiceScheduler(
+        'youtube',
+        Config.YOUTUBE_RATE_LIMIT,
+        Config.YOUTUBE_BURST,
+        Quota(Config.YOUTUBE_DAILY_QUOTA, Config.YOUTUBE_QUOTA_COSTS, 'America/Los_Angeles')),
+}
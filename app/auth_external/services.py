@@ -1,88 +1,337 @@
 from config import Config
 from time import time
+from datetime import timezone
 from flask import session, url_for, redirect, request
 from flask_login import current_user
-from sqlalchemy import delete, update, text
-from app.models import Service, Source, Track, playlist_track
+from sqlalchemy import select, delete, update, text
+from app.models import Service, Source, Track, playlist_track, user_cache
 from app import db
+from app.auth_external.scheduler import schedulers, RateLimited, QuotaExceeded
 from urllib.parse import urlparse
+import json
 
 import spotipy.util as util
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOAuth
+from spotipy.cache_handler import CacheHandler
+from spotipy.exceptions import SpotifyException
 
 from google_auth_oauthlib.flow import InstalledAppFlow, Flow
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2
+import hashlib
+import requests
+import random
+import threading
+import queue
+from contextlib import contextmanager
+from functools import lru_cache
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextvars import copy_context
+from cachetools import TTLCache
+
+# a requests session that stays open for the life of the process
+# spotipy closes the session of every client and oauth object it garbage
+# collects, which would drop the connections of a session they share
+class SharedSession(requests.Session):
+
+    def close(self):
+        pass
+
+# keep-alive connections to spotify, shared by every user's client
+# requests sessions are safe to share between threads, the access token is sent per request
+# retries the same failures as spotipy's own session would, except for 429s
+# which are left to the spotify scheduler so that every thread backs off
+spotify_session = SharedSession()
+spotify_session.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=Config.HTTP_POOL_SIZE,
+    max_retries=Retry(
+        total=3,
+        connect=None,
+        read=False,
+        allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+        status=3,
+        backoff_factor=0.3,
+        status_forcelist=(500, 502, 503, 504),
+        respect_retry_after_header=False)))
+
+# returns the number of seconds a Retry-After header asks to wait, if it is given in seconds
+def retry_after(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+# spotify api client whose calls are made through the spotify scheduler
+class SpotifyClient(spotipy.Spotify):
+
+    def _internal_call(self, method, url, payload, params):
+        # calls are accounted by their top level endpoint, e.g. 'GET playlists'
+        path = urlparse(url).path if url.startswith('http') else url
+        segments = [s for s in path.split('/') if s and s != 'v1']
+        endpoint = f'{method} {segments[0] if segments else ""}'
+
+        def call():
+            try:
+                # spotipy consumes some of the params, so every attempt gets a copy
+                return super(SpotifyClient, self)._internal_call(method, url, payload, dict(params))
+            except SpotifyException as e:
+                if e.http_status == 429:
+                    raise RateLimited(retry_after(e.headers.get('Retry-After')))
+                raise
+
+        return schedulers['spotify'].call(endpoint, call)
+
+# keep-alive connections to youtube, shared by every user's client
+# httplib2 is not thread-safe, so a connection is checked out for each request
+class HttpPool():
+
+    def __init__(self, size):
+        self.size = size
+        self.idle = queue.LifoQueue()
+
+    # checks out an idle connection, or opens a new one if there is none
+    @contextmanager
+    def connection(self):
+        try:
+            http = self.idle.get_nowait()
+        except queue.Empty:
+            http = httplib2.Http()
+
+        try:
+            yield http
+        finally:
+            if self.idle.qsize() < self.size:
+                self.idle.put(http)
+
+youtube_pool = HttpPool(Config.HTTP_POOL_SIZE)
+
+# returns the youtube api's resource tree, built once per process from the
+# discovery document shipped with googleapiclient instead of downloading it
+# requests are executed with each user's credentials (see Youtube.execute), so
+# the tree is shared by every client. its default http object is unauthorized
+@lru_cache(maxsize=None)
+def youtube_resource():
+    return build_from_document(
+        get_static_doc('youtube', Config.YOUTUBE_API_VERSION),
+        http=httplib2.Http())
+
+# keeps each user's access tokens in memory, keyed by (user id, service name)
+# valid tokens are served without touching the database, and concurrent
+# refreshes of the same token collapse into a single upstream refresh
+class TokenCache():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens = {} # (user id, service name) -> token
+        self.refreshing = {} # (user id, service name) -> lock held while the token is loaded or refreshed
+
+    # returns a valid token, loading it with load() or refreshing it with refresh(token) when needed
+    # load and refresh return none if there is no usable token
+    def get(self, key, load, valid, refresh):
+        with self.lock:
+            token = self.tokens.get(key)
+            key_lock = self.refreshing.setdefault(key, threading.Lock())
+
+        if token is not None and valid(token):
+            return token
+
+        with key_lock:
+            # another thread may have refreshed the token while this one waited
+            with self.lock:
+                token = self.tokens.get(key)
+
+            if token is None:
+                token = load()
+
+            if token is not None and not valid(token):
+                token = refresh(token)
+
+            with self.lock:
+                if token is None:
+                    self.tokens.pop(key, None)
+                else:
+                    self.tokens[key] = token
+
+        return token
+
+    # stores a token that was just issued
+    def put(self, key, token):
+        with self.lock:
+            self.tokens[key] = token
+
+    # forgets the tokens of a user, they are loaded from the database again on next use
+    def discard(self, user_id, service=None):
+        with self.lock:
+            for key in list(self.tokens):
+                if key[0] == user_id and service in (None, key[1]):
+                    del self.tokens[key]
+
+tokens = TokenCache()
+
+# caches search results, shared by every user
+# results expire after SEARCH_CACHE_TTL seconds, and the least recently used
+# ones are dropped once SEARCH_CACHE_SIZE are kept. a search that is already
+# running is waited for instead of being sent to the service again
+class SearchCache():
+
+    def __init__(self, maxsize, ttl):
+        self.lock = threading.Lock()
+        self.results = TTLCache(maxsize, ttl) # (service, type, query, market) -> results
+        self.pending = {} # key -> future of a search that is running
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0 # searches that waited for an identical one that was running
+
+    # queries differing only in case and spacing share their results
+    @staticmethod
+    def key(service, type, query, market=None):
+        return (service, type, ' '.join(query.casefold().split()), market)
+
+    # returns the cached results of a search, running search() if there are none
+    def get(self, key, search):
+        with self.lock:
+            results = self.results.get(key)
+            if results is not None:
+                self.hits += 1
+                return results
+
+            future = self.pending.get(key)
+            running = future is not None
+            if running:
+                self.coalesced += 1
+            else:
+                future = self.pending[key] = Future()
+                self.misses += 1
+
+        if running:
+            return future.result()
+
+        try:
+            results = search()
+        except Exception as e:
+            # failures are not cached, the waiting searches fail as well
+            with self.lock:
+                del self.pending[key]
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            self.results[key] = results
+            del self.pending[key]
+        future.set_result(results)
+
+        return results
+
+    def status(self):
+        with self.lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                'size': len(self.results),
+                'maxsize': self.results.maxsize,
+                'ttl': self.results.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'hit_rate': round((self.hits + self.coalesced) / lookups, 3) if lookups else None}
+
+searches = SearchCache(Config.SEARCH_CACHE_SIZE, Config.SEARCH_CACHE_TTL)
+
+# stores a user's token of a service in their service row
+# used by spotipy in place of its .cache file, and by Youtube for its credentials
+class ServiceCacheHandler(CacheHandler):
+
+    def __init__(self, user_id, service):
+        self.user_id = user_id
+        self.service = service
+
+    def get_cached_token(self):
+        return user_cache.credentials(self.user_id, self.service)
+
+    # only called when a token was issued or refreshed
+    def save_token_to_cache(self, token_info):
+        db.session.execute(update(Service).where(
+            Service.user_id == self.user_id,
+            Service.name == self.service).values(credentials=token_info))
+        db.session.commit()
+
+        user_cache.invalidate(self.user_id)
+        tokens.put((self.user_id, self.service), token_info)
 
 # handles the authorization and interfacing with the spotify api
 class Spotify():
 
+    # fields of the playlist metadata and tracklist pages that are used, the rest is not downloaded
+    PLAYLIST_FIELDS = 'name,snapshot_id,images(url)'
+    TRACK_FIELDS = 'total,items(track(id,name,external_urls,artists(id,name,external_urls),album(id,name,external_urls,images)))'
+
     # initialized with a spotify authorization object
     def __init__(self):
         self.oauth =  SpotifyOAuth(
             client_id=Config.SPOTIFY_CLIENT_ID,
             client_secret=Config.SPOTIFY_CLIENT_SECRET,
             redirect_uri=url_for('auth_external.auth_redirect', _external=True, service='spotify'),
-            scope=Config.SPOTIFY_SCOPES)
+            scope=Config.SPOTIFY_SCOPES,
+            cache_handler=ServiceCacheHandler(current_user.id, 'spotify'),
+            requests_session=spotify_session)
 
         self.auth_url = self.oauth.get_authorize_url() # used to redirect spotify to auth_redirect
 
     # returns a valid access token, refreshing it if needed
+    # refreshed and new tokens are saved to the database by the oauth object's cache handler
     def get_token(self):
-        # queries db for spotify value associated with the current user
-        db_sp = Service.query.filter_by(
-            user_id=current_user.id,
-            name='spotify')
-
-        # passes the token info from the database into a variable
-        token_info = db_sp.first().credentials
-
-        # if token does not exist or it's not valid
-        if token_info != None:
-            # token exists: refresh it
-            # checks if token is close to expiring
-            now = int(time())
-            is_expired = (token_info['expires_at'] - now) < 60
-
-            # if the token is close to expiring, refresh it
-            if is_expired:
-                token_info = self.oauth.refresh_access_token(token_info['refresh_token'])
-        else:
+        token_info = tokens.get(
+            (current_user.id, 'spotify'),
+            load=self.oauth.cache_handler.get_cached_token,
+            valid=lambda t: (t['expires_at'] - int(time())) >= 60, # refreshes tokens close to expiring
+            refresh=lambda t: self.oauth.refresh_access_token(t['refresh_token']))
+
+        if token_info is None:
             # returns none if the get_token method was called to generate a new token
             # but is not on the auth_redirect page
-            try:
-                request.args.get('code')
-            except:
+            code = request.args.get('code') # gets code from response URL
+            if not code:
                 return None
 
             # token does not exist: generate a new one
-            code = request.args.get('code') # gets code from response URL
-            token_info = self.oauth.get_access_token(code) # uses code sent from Spotify to exchange for an access & refresh token
-
-        # stores the relevant token data into the session and database
-        session['sp_token_info'] = token_info
-        db_sp.update({'credentials': (token_info)})
-        db.session.commit()
+            # uses code sent from Spotify to exchange for an access & refresh token
+            token_info = self.oauth.get_access_token(code, check_cache=False)
 
         return token_info
 
     # creates api object and passes it into itself
     def create_api(self):
-        # tries to get token data, return none if unable to
-        token_info = self.get_token()
-        self.api = spotipy.Spotify(auth=token_info['access_token'])
-        session['sp_username'] = self.api.current_user()
+        # tries to get token data, api is none if unable to
         try:
             token_info = self.get_token()
-            self.api = spotipy.Spotify(auth=token_info['access_token'])
-            session['sp_username'] = self.api.current_user()
+            self.api = SpotifyClient(
+                auth=token_info['access_token'],
+                requests_session=spotify_session)
+            # the user's identity is looked up once per client, not once per call that needs it
+            user = self.api.current_user()
+            self.username = user['display_name']
+            self.user_id = user['id']
+            self.country = user.get('country') # only sent with the user-read-private scope
+            self.expires_at = token_info['expires_at']
+            session['sp_username'] = self.username
         except:
             self.api = None
 
     # generic function that returns search results
-    def search(self, type, query):
-        results = self.api.search(q=query, type=type)
+    # results are shared with every user through the search cache
+    # without a market spotify searches the user's country, so results are
+    # only shared between users of the same country (or kept per user if
+    # spotify did not say which it is)
+    def search(self, type, query, market=None):
+        results = searches.get(
+            SearchCache.key('spotify', type, query, market or self.country or ('user', self.user_id)),
+            lambda: self.api.search(q=query, type=type, market=market))
 
         return results
 
@@ -90,7 +339,7 @@ class Spotify():
     def delete_playlist(self, source):
 
         self.api.user_playlist_unfollow(
-            user=session['sp_username'],
+            user=self.username,
             playlist_id=source.service_id)
 
         # deletes the source locally
@@ -98,24 +347,33 @@ class Spotify():
         db.session.execute(d)
 
     # gets a list of tracks from a given playlist
-    def get_tracks(self, playlist_id):
-        tracks = []
-        offset = 0
+    # the first page reports the playlist's total, so the remaining pages are
+    # fetched concurrently (up to SPOTIFY_PAGE_WORKERS at a time) and reassembled in order
+    # on_page is called after every page of tracks retrieved
+    def get_tracks(self, playlist_id, on_page=None, fields=None):
+        # retrieves a page of up to 100 tracks
+        def get_page(offset):
+            page = self.api.playlist_tracks(
+                playlist_id,
+                fields=fields or self.TRACK_FIELDS,
+                limit=100,
+                offset=offset)
 
-        batch = self.api.playlist_tracks(
-            playlist_id,
-            limit=100,
-            offset=offset)['items']
+            if on_page:
+                on_page()
 
-        while batch:
-            for track in batch:
-                tracks.append(track)
+            return page
 
-            offset += 1
-            batch = self.api.playlist_tracks(
-                playlist_id,
-                limit=100,
-                offset=offset*100)['items']
+        page = get_page(0)
+        tracks = page['items']
+
+        offsets = range(100, page['total'], 100)
+        if offsets:
+            with ThreadPoolExecutor(max_workers=Config.SPOTIFY_PAGE_WORKERS) as pool:
+                # pages run in a copy of the caller's context so their calls are reported with it
+                futures = [pool.submit(copy_context().run, get_page, offset) for offset in offsets]
+                for future in futures:
+                    tracks.extend(future.result()['items'])
 
         return tracks
 
@@ -139,98 +397,74 @@ class Spotify():
         # tests the playlist link
         try:
             # test the playlist link
-            self.api.playlist_is_following(
-                playlist_id=service_id,
-                user_ids=[self.api.current_user()['display_name']])
+            self.is_following(service_id)
         except:
             # playlist link is not valid
             return None
 
         return True
 
-    # adds a spotify track to a playlist
-    def add_track_to_playlist(self, playlist, source, track):
-        # retrieves the track from the database (if it exists)
-        db_track = Track.query.filter_by(service_id=track['track']['id']).first()
-
-        # gets the playlist's blacklisted tracks
-        blacklist = playlist.blacklist.all()
-
-        # checks if the track was previously blacklisted by the user
-        if not db_track in blacklist:
-            # if this is a new track that is not in db, create and add it
-            if not db_track:
-                # tries to get a link to track art
-                try:
-                    art = track['track']['album']['images'][2]['url']
-                except:
-                    art = ''
+    # returns whether the user follows a playlist
+    def is_following(self, service_id):
+        return self.api.playlist_is_following(
+            playlist_id=service_id,
+            user_ids=[self.user_id])[0]
 
-                # tries to get external link
-                try:
-                    href = track['track']['external_urls']['spotify']
-                except:
-                    href = 'https://open.spotify.com'
-
-
-                t = Track(
-                    title=track['track']['name'],
-                    service='spotify',
-                    service_id=track['track']['id'],
-                    art=art,
-                    href=href)
-
-                # adds artists from track into the database
-                artists = track['track']['artists']
-                for artist in artists:
-                    # tries to get the external link to the artist
-                    try:
-                        href = artist['external_urls']['spotify']
-                    except:
-                        href = 'https://open.spotify.com'
-
-                    t.add_artist(
-                        artist['name'],
-                        artist['id'],
-                        href)
-
-                # tries to get the external link to album
-                try:
-                    href = track['track']['album']['external_urls']['spotify']
-                except:
-                    href = 'https://open.spotify.com'
-
-                # links the track to its album
-                t.add_album(
-                    track['track']['album']['name'],
-                    track['track']['album']['id'],
-                    href
-                )
-
-                db.session.add(t)
-
-            # queries the database for the track
-            track = Track.query.filter_by(service_id=track['track']['id']).first()
-
-            # used to prevent a bug where the track_pos was getting updated
-            # when a track that is already in the db was added to the playlist
-            if not track in playlist.tracks.all():
-                was_not_in_playlist = True
-            else:
-                was_not_in_playlist = False
+    # returns the title, cover images and snapshot id of a playlist in a single
+    # call, or none if the playlist does not exist
+    def get_playlist(self, service_id):
+        try:
+            return self.api.playlist(playlist_id=service_id, fields=self.PLAYLIST_FIELDS)
+        except SpotifyException as e:
+            if e.http_status in (400, 404):
+                return None
+            raise
 
-            # adds track to this playlist and adds source to track
-            playlist.add_track(track)
-            track.sources.append(source)
-            db.session.commit()
+    # parses a spotify playlist item into a track that can be synced into a playlist
+    # returns none for items that are not spotify tracks (e.g. local files)
+    def parse_track(self, item):
+        track = item['track']
+        if not track or not track.get('id'):
+            return None
 
-            # if the track has now been on the playlist before, update its track_pos
-            if was_not_in_playlist:
-                playlist.set_track_pos(track)
+        # tries to get a link to track art
+        try:
+            art = track['album']['images'][2]['url']
+        except:
+            art = ''
+
+        # gets the track's artists and their external links
+        artists = [{
+            'name': artist['name'],
+            'service_id': artist['id'],
+            'href': artist.get('external_urls', {}).get('spotify', 'https://open.spotify.com'),
+            } for artist in track['artists']]
+
+        # gets the track's album and its external link
+        album = {
+            'title': track['album']['name'],
+            'service_id': track['album']['id'],
+            'href': track['album'].get('external_urls', {}).get('spotify', 'https://open.spotify.com'),
+        }
+
+        return {
+            'service': 'spotify',
+            'service_id': track['id'],
+            'title': track['name'],
+            'art': art,
+            'href': track.get('external_urls', {}).get('spotify', 'https://open.spotify.com'),
+            'artists': artists,
+            'album': album,
+        }
 
 # handles the authorization and interfacing with the youtube api
 class Youtube():
 
+    # fields of the playlist metadata and tracklist pages that are used, the rest is not downloaded
+    # the item count stays in so that the playlist's etag changes when tracks are added or removed
+    PLAYLIST_FIELDS = 'etag,pageInfo(totalResults),items(snippet(title,thumbnails(default(url))),contentDetails(itemCount))'
+    TRACK_FIELDS = 'etag,nextPageToken,items(snippet(title,thumbnails(default(url)),resourceId(videoId),videoOwnerChannelTitle,videoOwnerChannelId))'
+
     # creates a youtube authorization object
     def __init__(self):
         flow = Flow.from_client_secrets_file(
@@ -255,82 +489,181 @@ class Youtube():
         except:
             session['yt_state'] = self.state # if a new oauth object is being requested
 
-    # returns a valid access token, refreshing it if needed
+    # returns valid credentials, refreshing them if needed
     def get_token(self):
-        # queries db for youtube value associated with the current user
-        db_yt = Service.query.filter_by(
-            user_id=current_user.id,
-            name='youtube')
-
-        # passes the token info from the database into a variable
-        token_info = db_yt.first().credentials
-
-        # if token does not exist or it's not valid
-        if not token_info or not token_info.valid:
-            if token_info and token_info.expired and token_info.refresh_token:
-                # token exists but is expired: refresh it
-                token_info.refresh(Request())
-            elif 'auth_redirect/youtube?state' in request.url:
-                # token does not exist: generate a new one
-                flow = Flow.from_client_secrets_file(
-                        Config.YOUTUBE_CLIENT_SECRETS_FILE,
-                        scopes=Config.YOUTUBE_SCOPES,
-                        state=self.state)
-
-                flow.redirect_uri = url_for(
-                        'auth_external.auth_redirect',
-                        _external=True,
-                        service='youtube')
-
-                flow.fetch_token(authorization_response=request.url)
-                token_info = flow.credentials
-            else:
-                token_info = None
+        cache = ServiceCacheHandler(current_user.id, 'youtube')
 
-        # stores the relevant token data into the session and database
-        try:
-            session['yt_token_info'] =  {
-                'token': db_yt.credentials.token,
-                'refresh_token': db_yt.credentials.refresh_token,
-                'token_uri': db_yt.credentials.token_uri,
-                'client_id': db_yt.credentials.client_id,
-                'client_secret': db_yt.credentials.client_secret,
-                'scopes': db_yt.credentials.scopes}
-        except:
-            session['yt_token_info'] = None
-        db_yt.update({'credentials': (token_info)})
-        db.session.commit()
+        token_info = tokens.get(
+            (current_user.id, 'youtube'),
+            load=cache.get_cached_token,
+            valid=lambda t: t.valid,
+            refresh=lambda t: self.refresh_token(cache, t))
+
+        if token_info is None and 'auth_redirect/youtube?state' in request.url:
+            # token does not exist: generate a new one
+            flow = Flow.from_client_secrets_file(
+                    Config.YOUTUBE_CLIENT_SECRETS_FILE,
+                    scopes=Config.YOUTUBE_SCOPES,
+                    state=self.state)
+
+            flow.redirect_uri = url_for(
+                    'auth_external.auth_redirect',
+                    _external=True,
+                    service='youtube')
+
+            flow.fetch_token(authorization_response=request.url)
+            token_info = flow.credentials
+            cache.save_token_to_cache(token_info)
 
         return token_info
 
+    # refreshes expired credentials and saves them
+    # returns none if the credentials cannot be refreshed
+    def refresh_token(self, cache, credentials):
+        if not credentials.refresh_token:
+            return None
+
+        credentials.refresh(Request())
+        cache.save_token_to_cache(credentials)
+
+        return credentials
+
     # creates an interface to interact with youtube
     def create_api(self):
         # tries to get token data
         try:
-            token_info = self.get_token()
-            self.api = build('youtube', Config.YOUTUBE_API_VERSION, credentials=token_info)
+            self.credentials = self.get_token()
+            self.api = youtube_resource()
+
+            # credentials without an expiry do not expire
+            expiry = self.credentials.expiry
+            self.expires_at = expiry.replace(tzinfo=timezone.utc).timestamp() if expiry else float('inf')
         except:
             self.api = None
 
     # returns search results for a given query
+    # a search costs 100 quota units, so results are shared with every user through the search cache
     def search(self, query):
-        request = self.api.search().list(part='snippet', q=query)
-        response = request.execute()
+        response = searches.get(
+            SearchCache.key('youtube', 'snippet', query),
+            lambda: self.execute(self.api.search().list(part='snippet', q=query)))
 
         return response
 
-    # returns a youtube playlist from a service id
-    def get_playlist(self, service_id):
-        response = None
+    # executes a request with the user's credentials on a pooled connection
+    # sends the etag of a previous response along if given, and returns none if
+    # youtube reports that the resource has not changed since (304)
+    # requests are made through the youtube scheduler, which accounts their quota cost
+    def execute(self, request, etag=None):
+        if etag:
+            request.headers['If-None-Match'] = etag
 
-        if self.verify_service_id(service_id):
-            request = self.api.playlists().list(
-                part='snippet',
-                id=service_id
-            )
-            response = request.execute()
+        def call():
+            with youtube_pool.connection() as http:
+                try:
+                    return request.execute(http=AuthorizedHttp(self.credentials, http=http))
+                except HttpError as e:
+                    if e.resp.status == 304:
+                        return None
+                    raise self.error(e, request)
+
+        return schedulers['youtube'].call(self.endpoint(request), call)
+
+    # executes many write requests in as few round trips as possible, sending
+    # up to YOUTUBE_BATCH_SIZE of them at a time through youtube's batch endpoint
+    # requests that fail do not fail the rest. the ones youtube rate limits are
+    # sent again in a later batch, after the scheduler backed off
+    # youtube may run the requests of a batch in any order, a size of 1 sends them in order
+    # returns a list of (response, error) in the order of the requests, where error is
+    # the HttpError or QuotaExceeded a request failed with, if it did
+    def execute_batch(self, requests, size=None):
+        size = size or Config.YOUTUBE_BATCH_SIZE
+        results = [(None, None)] * len(requests)
+        pending = list(range(len(requests)))
+
+        for attempt in range(Config.RATE_LIMIT_RETRIES + 1):
+            limited = []
+
+            for start in range(0, len(pending), size):
+                chunk = pending[start:start + size]
+
+                def callback(request_id, response, exception):
+                    i = int(request_id)
+                    error = self.error(exception, requests[i]) if exception else None
+                    if isinstance(error, RateLimited):
+                        limited.append((i, error))
+                    else:
+                        results[i] = (response, error)
+
+                def call():
+                    batch = self.api.new_batch_http_request(callback=callback)
+                    for i in chunk:
+                        batch.add(requests[i], request_id=str(i))
+
+                    with youtube_pool.connection() as http:
+                        try:
+                            batch.execute(http=AuthorizedHttp(self.credentials, http=http))
+                        except HttpError as e:
+                            raise self.error(e, batch)
 
-        return response
+                try:
+                    schedulers['youtube'].call(
+                        'batch', call, batch=[self.endpoint(requests[i]) for i in chunk])
+                except QuotaExceeded as e:
+                    # the requests that were not sent fail, the ones already made stand
+                    for i in pending[start:] + [i for i, _ in limited]:
+                        results[i] = (None, e)
+                    return results
+
+            if not limited:
+                break
+
+            # backs off like the scheduler does for a rate limited call
+            pending = sorted(i for i, _ in limited)
+            if attempt < Config.RATE_LIMIT_RETRIES:
+                delay = max((e.retry_after or 0 for _, e in limited), default=0) or 2 ** attempt
+                schedulers['youtube'].bucket.pause(delay + random.uniform(0, 1))
+
+        for i, error in limited:
+            results[i] = (None, error)
+
+        return results
+
+    # returns the scheduler endpoint of a request, e.g. 'playlistItems.insert'
+    def endpoint(self, request):
+        return request.methodId.replace('youtube.', '', 1)
+
+    # returns the exception a failed request should raise
+    # rate limits are raised as RateLimited for the scheduler to retry, and quota
+    # errors as QuotaExceeded, marking the quota as used up
+    def error(self, e, request):
+        reason = self.error_reason(e)
+        if e.resp.status == 429 or reason in ('rateLimitExceeded', 'userRateLimitExceeded'):
+            return RateLimited(retry_after(e.resp.get('retry-after')))
+        if reason in ('quotaExceeded', 'dailyLimitExceeded'):
+            # youtube's count is the one that matters, whatever was accounted locally
+            schedulers['youtube'].quota.exhaust()
+            return QuotaExceeded(f'Youtube quota exceeded ({getattr(request, "methodId", "batch")})')
+        return e
+
+    # returns the reason youtube gave for an error, e.g. 'quotaExceeded'
+    def error_reason(self, error):
+        try:
+            return json.loads(error.content)['error']['errors'][0]['reason']
+        except (ValueError, KeyError, IndexError, TypeError):
+            return None
+
+    # returns a youtube playlist from a service id
+    # the playlist has no items if it does not exist
+    # when the etag of a previous response is given, returns none if the playlist has not changed
+    def get_playlist(self, service_id, etag=None):
+        request = self.api.playlists().list(
+            part='snippet,contentDetails',
+            id=service_id,
+            fields=self.PLAYLIST_FIELDS
+        )
+
+        return self.execute(request, etag)
 
     # creates a new playlist on youtube
     def create_playlist(self, title, description, visibility, default_language):
@@ -346,7 +679,7 @@ class Youtube():
                 }
             })
 
-        response = request.execute()
+        response = self.execute(request)
 
         return response
 
@@ -356,7 +689,7 @@ class Youtube():
         request = self.api.playlists().delete(
             id=source.service_id
         )
-        response = request.execute()
+        response = self.execute(request)
 
         # deletes the source locally
         d = delete(Source).where(Source.id == source.id)
@@ -364,20 +697,74 @@ class Youtube():
 
         return response
 
+    # returns a request inserting a video into a playlist at a position
+    def insert_item(self, playlist_id, video_id, position):
+        return self.api.playlistItems().insert(
+            part='snippet',
+            fields='id',
+            body={'snippet': {
+                'playlistId': playlist_id,
+                'position': position,
+                'resourceId': {'kind': 'youtube#video', 'videoId': video_id}}})
+
+    # returns a request moving a playlist item to a position
+    def move_item(self, playlist_id, item_id, video_id, position):
+        return self.api.playlistItems().update(
+            part='snippet',
+            fields='id',
+            body={'id': item_id, 'snippet': {
+                'playlistId': playlist_id,
+                'position': position,
+                'resourceId': {'kind': 'youtube#video', 'videoId': video_id}}})
+
+    # returns a request removing an item from its playlist
+    def delete_item(self, item_id):
+        return self.api.playlistItems().delete(id=item_id)
+
+    # returns the etag of a tracklist from the etags of its pages
+    # a tracklist that fits on one page keeps that page's etag ('page:<etag>'), which
+    # can be sent along with the next download. a longer one can change past its
+    # first page while the first page and the item count stay the same, so it gets
+    # a digest of the etags of all its pages ('pages:<digest>') instead
+    @staticmethod
+    def tracks_etag(etags):
+        if len(etags) == 1:
+            return 'page:' + etags[0]
+
+        return 'pages:' + hashlib.sha1('\n'.join(etags).encode()).hexdigest()
+
     # gets a list of tracks from a given playlist
-    def get_tracks(self, playlist_id):
+    # returns the tracks and the etag of the tracklist (see tracks_etag)
+    # when the etag of a previous download is given and the tracklist has not
+    # changed since, returns none instead of the tracks. the download is only
+    # skipped for a tracklist that fit on one page, a longer one is downloaded
+    # again to compare the etags of all its pages
+    # on_page is called after every page of tracks retrieved
+    # fields defaults to the ones parse_track needs
+    def get_tracks(self, playlist_id, on_page=None, etag=None, fields=None):
         tracks = []
+        etags = []
+        fields = fields or self.TRACK_FIELDS
 
         request = self.api.playlistItems().list(
             part='snippet',
             maxResults=50,
-            playlistId=playlist_id)
-        batch = request.execute()
+            playlistId=playlist_id,
+            fields=fields)
+        page_etag = etag[len('page:'):] if etag and etag.startswith('page:') else None
+        batch = self.execute(request, page_etag)
+
+        if batch is None:
+            return None, etag
 
         while True:
+            etags.append(batch['etag'])
             for track in batch['items']:
                 tracks.append(track)
 
+            if on_page:
+                on_page()
+
             # breaks out of loop when there is no next page
             try:
                 page_token = batch['nextPageToken']
@@ -388,10 +775,14 @@ class Youtube():
                 part='snippet',
                 maxResults=50,
                 pageToken=page_token,
-                playlistId=playlist_id)
-            batch = request.execute()
+                playlistId=playlist_id,
+                fields=fields)
+            batch = self.execute(request)
 
-        return tracks
+        if self.tracks_etag(etags) == etag:
+            return None, etag
+
+        return tracks, self.tracks_etag(etags)
 
     # parses through a source to retrieve the service id
     def get_service_id(self, source):
@@ -419,81 +810,90 @@ class Youtube():
                 part='snippet',
                 playlistId=service_id
             )
-            response = request.execute()
+            response = self.execute(request)
         except:
             return False
 
         return True
 
-    # adds a youtube track to a playlist
-    def add_track_to_playlist(self, playlist, source, track):
-        # retrieves the track from the database (if it exists)
-        db_track = Track.query.filter_by(service_id=track['snippet']['resourceId']['videoId']).first()
+    # parses a youtube playlist item into a track that can be synced into a playlist
+    def parse_track(self, item):
+        snippet = item['snippet']
+        video_id = snippet['resourceId']['videoId']
 
-        # gets the playlist's blacklisted tracks
-        blacklist = playlist.blacklist.all()
+        # tries to get a link to track art
+        try:
+            art = snippet['thumbnails']['default']['url']
+        except:
+            art = ''
+
+        # the channel that uploaded the video is used as the track's artist
+        channel_title = snippet.get('videoOwnerChannelTitle', '')
+        channel_id = snippet.get('videoOwnerChannelId', '')
+
+        return {
+            'service': 'youtube',
+            'service_id': video_id,
+            'title': snippet['title'],
+            'art': art,
+            'href': 'https://www.youtube.com/watch?v=' + video_id,
+            'artists': [{
+                'name': channel_title,
+                'service_id': channel_id,
+                'href': 'https://www.youtube.com/channel/' + channel_id}],
+            'album': None,
+        }
 
-        # checks if the track was previously blacklisted by the user
-        if not db_track in blacklist:
-            if not db_track:
-                # tries to get a link to track art
-                try:
-                    art = track['snippet']['thumbnails']['default']['url']
-                except:
-                    art = ''
+# https://youtube.com/playlist?list=PLVCtLXKko6G0zRGLJwnEg5OAri2HMVtcc
 
-                # tries to get external link
-                try:
-                    href = 'https://www.youtube.com/watch?v=' + track['snippet']['resourceId']['videoId']
-                except:
-                    href = 'https://www.youtube.com'
+"""
+<iframe src="{{ "https://www.youtube-nocookie.com/embed/{0}?showinfo=0&rel=0&iv_load_policy=3&fs=0&controls=0&disablekb=1".format(track.service_id) }}" width="64" height="64" frameborder="0">
+</iframe>
+"""
 
-                # tries to get the channel that uploaded the video
-                try:
-                    videoOwnerChannelTitle = track['snippet']['videoOwnerChannelTitle']
-                    videoOwnerChannelId = track['snippet']['videoOwnerChannelId']
-                except:
-                    videoOwnerChannelTitle = ''
-                    videoOwnerChannelId = ''
-
-                # if there is a new track that is not in db, add it
-                t = Track(
-                    title=track['snippet']['title'],
-                    service='youtube',
-                    service_id=track['snippet']['resourceId']['videoId'],
-                    art=art,
-                    href=href)
-
-                # adds artists from track into the database
-                t.add_artist(
-                    videoOwnerChannelTitle,
-                    videoOwnerChannelId,
-                    'https://www.youtube.com/channel/' + videoOwnerChannelId)
-
-                db.session.add(t)
-
-            # queries the database for the track
-            track = Track.query.filter_by(service_id=track['snippet']['resourceId']['videoId']).first()
-
-            # used to prevent a bug where the track_pos was getting updated /
-            # when a track that is already in the db was added to the playlist
-            if not track in playlist.tracks.all():
-                was_not_in_playlist = True
+# builds and caches the api clients of each user
+# clients are only built the first time a request actually talks to a service,
+# and are then reused across requests until their access token is about to expire
+class ClientRegistry():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {} # (user id, service name) -> client with a working api
+
+    # returns the current user's client for a service ('spotify' or 'youtube')
+    # the client's api is none if the user is not logged into the service
+    def get(self, service):
+        key = (current_user.id, service)
+
+        with self.lock:
+            client = self.clients.get(key)
+
+        if client and client.expires_at - time() > 60:
+            return client
+
+        client = SERVICES[service]()
+        client.create_api()
+
+        # clients without a working api are rebuilt on their next use
+        with self.lock:
+            if client.api is not None:
+                self.clients[key] = client
             else:
-                was_not_in_playlist = False
+                self.clients.pop(key, None)
 
-            # adds track to this playlist and adds source to track
-            playlist.add_track(track)
-            track.sources.append(source)
-            db.session.commit()
+        return client
 
-            # if the track has now been on the playlist before, update its track_pos
-            if was_not_in_playlist:
-                playlist.set_track_pos(track)
+    # forgets the clients of a user, e.g. after their credentials changed
+    def discard(self, user_id, service=None):
+        with self.lock:
+            for key in list(self.clients):
+                if key[0] == user_id and service in (None, key[1]):
+                    del self.clients[key]
 
-# https://youtube.com/playlist?list=PLVCtLXKko6G0zRGLJwnEg5OAri2HMVtcc
+# service name -> client class
+SERVICES = {
+    'spotify': Spotify,
+    'youtube': Youtube,
+}
 
-"""
-<iframe src="{{ "https://www.youtube-nocookie.com/embed/{0}?showinfo=0&rel=0&iv_load_policy=3&fs=0&controls=0&disablekb=1".format(track.service_id) }}" width="64" height="64" frameborder="0">
-</iframe>
-"""
+clients = ClientRegistry()
@@ -0,0 +1,62 @@
+import atexit
+import threading
+from datetime import datetime
+from sqlalchemy import update, bindparam
+from app import db
+from app.models import User
+
+# buffers the last time each user was seen and writes them in one bulk UPDATE
+# at most LAST_SEEN_FLUSH_INTERVAL seconds later, so page views never have to
+# wait for (or hold) the database's write lock
+class LastSeenBuffer():
+
+    def __init__(self):
+        self.app = None
+        self.lock = threading.Lock()
+        self.pending = {} # user id -> last time the user was seen
+        self.timer = None
+
+    def init_app(self, app):
+        self.app = app
+
+        # writes what is left in the buffer when the process exits
+        atexit.register(self.flush)
+
+    # records that a user was just seen
+    # the first visit after a flush schedules the next one
+    def touch(self, user_id):
+        with self.lock:
+            self.pending[user_id] = datetime.utcnow()
+
+            if self.timer is None:
+                self.timer = threading.Timer(
+                    self.app.config['LAST_SEEN_FLUSH_INTERVAL'], self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    # writes every buffered last_seen time in a single statement
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+        if not pending:
+            return
+
+        with self.app.app_context():
+            sql = update(User.__table__).where(
+                User.id == bindparam('b_user_id')).values(
+                    last_seen=bindparam('b_last_seen'))
+
+            try:
+                db.session.execute(sql, [
+                    {'b_user_id': user_id, 'b_last_seen': seen}
+                    for user_id, seen in pending.items()])
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception('Could not write last_seen times')
+
+last_seen = LastSeenBuffer()
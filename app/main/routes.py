@@ -3,6 +3,7 @@ from flask_login import current_user, login_required
 from datetime import datetime
 from app import db
 from app.main import bp
+from app.main.last_seen import last_seen
 from app.auth_external.services import Spotify, Youtube
 from app.models import Playlist
 
@@ -10,9 +11,9 @@ from app.models import Playlist
 @bp.before_request
 def before_request():
     # logs the last time the user interacted with the website
+    # the time is written to the database in the background (see LastSeenBuffer)
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        last_seen.touch(current_user.id)
 
 # home page
 @bp.route('/', methods=['GET', 'POST'])
@@ -1,6 +1,11 @@
+from flask_login import current_user
+from app.auth_external.services import tokens, clients
+from app.models import user_cache
+
+# drops the current user's cached records, tokens and api clients from memory
+# needed to allow refresh token to be regenerated instead of being loaded from cache
 def clear_cache():
-    try:
-        # needed to allow refresh token to be regenerated instead of being loaded from cache
-        os.remove(r"/Users/brendan/Documents/code/universal/.cache")
-    except:
-        pass
+    if current_user.is_authenticated:
+        tokens.discard(current_user.id)
+        clients.discard(current_user.id)
+        user_cache.invalidate(current_user.id)
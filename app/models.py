@@ -6,8 +6,12 @@ from datetime import datetime
 from app import db, ma, login
 from flask import current_app
 from config import Config
-from sqlalchemy import delete, update, text
+from sqlalchemy import select, delete, update, text, func, true, bindparam
 from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from cachetools import TTLCache
+import threading
 
 # EXAMPLE QUERY FOR FUTURE REFERENCE
 # u.services.filter_by(name='spotify').first().id
@@ -21,12 +25,18 @@ class Serializer(object):
     def serialize_list(l):
         return [m.serialize() for m in l]
 
+# tracks are ordered on a playlist by track_pos, spaced TRACK_POS_GAP apart so
+# that a track can be added, removed or moved without renumbering the others
+TRACK_POS_GAP = 1024
+TRACK_POS_MIN_GAP = 8 # playlists are renumbered in the background once a move leaves a smaller gap
+
 # association table connecting playlists and tracks
 # is used to prevent duplication of tracks if one track is used in multiple playlists
 playlist_track = db.Table('playlist_track',
-    db.Column('playlist_id', db.Integer, db.ForeignKey('playlist.id')),
-    db.Column('track_id', db.Integer, db.ForeignKey('track.id')),
-    db.Column('track_pos', db.Integer)
+    db.Column('playlist_id', db.Integer, db.ForeignKey('playlist.id'), primary_key=True),
+    db.Column('track_id', db.Integer, db.ForeignKey('track.id'), primary_key=True),
+    db.Column('track_pos', db.Integer),
+    db.Index('ix_playlist_track_playlist_id_track_pos', 'playlist_id', 'track_pos')
 )
 
 # each entry in this table is a track that is blacklisted on a specific table
@@ -35,13 +45,22 @@ playlist_track = db.Table('playlist_track',
 blacklist = db.Table('blacklist',
     db.Column('playlist_id', db.Integer, db.ForeignKey('playlist.id')),
     db.Column('track_id', db.Integer, db.ForeignKey('track.id')),
-    db.Column('reason', db.String(120))
+    db.Column('reason', db.String(120)),
+    db.Index('ix_blacklist_playlist_id_track_id', 'playlist_id', 'track_id')
 )
 
 # association table connecting playlists and sources
+# also stores the state of the source as of the playlist's last refresh, which
+# is kept per playlist because sources can be shared between playlists
 playlist_source = db.Table('playlist_source',
     db.Column('playlist_id', db.Integer, db.ForeignKey('playlist.id')),
-    db.Column('source_id', db.Integer, db.ForeignKey('source.id'))
+    db.Column('source_id', db.Integer, db.ForeignKey('source.id')),
+    db.Column('etag', db.String(64)), # etag of the youtube playlist resource
+    db.Column('tracks_etag', db.String(64)), # etag of the youtube playlist items (see Youtube.tracks_etag)
+    db.Column('snapshot_id', db.String(128)), # version of the spotify playlist's tracklist
+    db.Column('push', db.Boolean, default=False, server_default='0'), # the playlist's tracklist is pushed to the source
+    db.Column('pushed_tracks', db.JSON), # tracklist last pushed to the source: spotify ids, or youtube (item id, video id) pairs
+    db.Index('ix_playlist_source_playlist_id_source_id', 'playlist_id', 'source_id')
 )
 
 # association table connecting albums and artists
@@ -55,13 +74,17 @@ album_artist = db.Table('album_artist',
 # allows multiple artists to be on the same track and vice versa
 track_artist = db.Table('track_artist',
     db.Column('track_id', db.Integer, db.ForeignKey('track.id')),
-    db.Column('artist_id', db.Integer, db.ForeignKey('artist.id'))
+    db.Column('artist_id', db.Integer, db.ForeignKey('artist.id')),
+    db.Index('ix_track_artist_track_id_artist_id', 'track_id', 'artist_id'),
+    db.Index('ix_track_artist_artist_id', 'artist_id')
 )
 
 # association table connecting tracks and sources
 track_source = db.Table('track_source',
     db.Column('track_id', db.Integer, db.ForeignKey('track.id')),
-    db.Column('source_id', db.Integer, db.ForeignKey('source.id'))
+    db.Column('source_id', db.Integer, db.ForeignKey('source.id')),
+    db.Index('ix_track_source_source_id_track_id', 'source_id', 'track_id'),
+    db.Index('ix_track_source_track_id', 'track_id')
 )
 
 # stores information on the user logged into universal, NOT a service attached to universal
@@ -104,6 +127,7 @@ class User(UserMixin, db.Model, Serializer):
                 db.session.delete(Service.query.filter_by(user_id=self.id, name=service).first())
 
         db.session.commit()
+        user_cache.invalidate(self.id)
 
     # Creates a unique default avatar for the user using their username
     def avatar(self, size):
@@ -150,6 +174,8 @@ class Playlist(db.Model, Serializer):
     title = db.Column(db.String(30))
     description = db.Column(db.String(140))
     art = db.Column(db.String(140))
+    version = db.Column(db.Integer, default=0, server_default='0') # bumped whenever the tracklist changes
+    updated = db.Column(db.DateTime, default=datetime.utcnow) # last time the tracklist changed
     sources = db.relationship(
         'Source',
         secondary=playlist_source,
@@ -180,7 +206,6 @@ class Playlist(db.Model, Serializer):
             self.tracks.append(track)
 
     # removes a track from the playlist
-    # updates track_pos to be continuous
     def remove_track(self, track):
         if self.contains_track(track):
             self.tracks.remove(track)
@@ -206,43 +231,120 @@ class Playlist(db.Model, Serializer):
         return self.sources.filter_by(
             service_id=source.service_id).first()
 
-    # updates all track positions in playlist to make them continuous
-    def refresh_track_positions(self):
-        track_ids = db.session.execute(text(f'SELECT track_id FROM playlist_track WHERE playlist_id={self.id}')).all()
-        for i in range(len(track_ids)):
-            sql = update(playlist_track).where(
-                playlist_track.c.track_id==track_ids[i][0]).where(
-                    playlist_track.c.playlist_id==self.id).values(track_pos=i)
-            db.session.execute(sql)
+    # marks the tracklist as changed, invalidating cached pages of it
+    def bump_version(self):
+        self.version = Playlist.version + 1
+        self.updated = datetime.utcnow()
+
+    # returns source id -> state of each of the playlist's sources as of the last refresh
+    def source_states(self):
+        rows = db.session.execute(select(playlist_source).where(
+            playlist_source.c.playlist_id == self.id)).mappings().all()
+
+        return {row['source_id']: dict(row) for row in rows}
+
+    # stores the state of one of the playlist's sources after a refresh
+    def set_source_state(self, source, **state):
+        db.session.execute(update(playlist_source).where(
+            playlist_source.c.playlist_id == self.id).where(
+                playlist_source.c.source_id == source.id).values(**state))
+
+    # forgets the state of all sources so the next refresh downloads them in full
+    def reset_source_states(self):
+        db.session.execute(update(playlist_source).where(
+            playlist_source.c.playlist_id == self.id).values(
+                etag=None,
+                tracks_etag=None,
+                snapshot_id=None,
+                pushed_tracks=None))
+
+    # returns the sources the playlist's tracklist is pushed to
+    def push_targets(self):
+        return Source.query.join(
+            playlist_source, playlist_source.c.source_id == Source.id).filter(
+                playlist_source.c.playlist_id == self.id,
+                playlist_source.c.push == true()).all()
+
+    # returns the position after the last track on the playlist
+    def next_track_pos(self):
+        last_track_pos = db.session.execute(
+            select(func.max(playlist_track.c.track_pos)).where(
+                playlist_track.c.playlist_id == self.id)).scalar()
+
+        return 0 if last_track_pos is None else last_track_pos + TRACK_POS_GAP
 
+    # renumbers all track positions in the playlist so they are evenly spaced again
+    # only needed once moves have used up the gap between two tracks
+    def refresh_track_positions(self):
+        track_ids = db.session.execute(
+            select(playlist_track.c.track_id).where(
+                playlist_track.c.playlist_id == self.id).order_by(
+                    playlist_track.c.track_pos)).scalars().all()
+
+        sql = update(playlist_track).where(
+            playlist_track.c.playlist_id == self.id).where(
+                playlist_track.c.track_id == bindparam('b_track_id')).values(
+                    track_pos=bindparam('b_track_pos'))
+        db.session.execute(sql, [
+            {'b_track_id': track_id, 'b_track_pos': i * TRACK_POS_GAP}
+            for i, track_id in enumerate(track_ids)])
+
+    # adds a track onto the end of the playlist
     def set_track_pos(self, track):
-        # gets the position of the last track on the playlist
-        last_track_pos = db.session.execute(
-            f"""SELECT MAX(track_pos)
-                FROM playlist_track
-                WHERE playlist_id={self.id};""").first()
-
-        # sets the track positions of new tracks in the playlist
-        if last_track_pos != (None,):
-            # if the playlist isn't empty, add track onto the end
-            sql = update(playlist_track).where(
-                playlist_track.c.track_id == track.id).where(
-                    playlist_track.c.playlist_id == self.id).values(
-                        track_pos=int(last_track_pos[0]) + 1)
-        else:
-            # if the playlist is empty, initialize track position to 0
-            sql = update(playlist_track).where(
-                playlist_track.c.track_id == track.id).where(
-                    playlist_track.c.playlist_id == self.id).values(track_pos=0)
+        sql = update(playlist_track).where(
+            playlist_track.c.track_id == track.id).where(
+                playlist_track.c.playlist_id == self.id).values(
+                    track_pos=self.next_track_pos())
 
         db.session.execute(sql)
 
+    # moves a track on the playlist to just after another track, or to the top
+    # if after is none. only the moved track's row is updated, unless the gap
+    # between its new neighbours has run out and the playlist is renumbered
+    # returns the track's new position and the gap it was placed in
+    def move_track(self, track, after=None):
+        # gets the positions of the tracks the track is moved between
+        if after:
+            prev_pos = db.session.execute(
+                select(playlist_track.c.track_pos).where(
+                    playlist_track.c.playlist_id == self.id).where(
+                        playlist_track.c.track_id == after.id)).scalar()
+        else:
+            prev_pos = None
+
+        next_pos = db.session.execute(
+            select(func.min(playlist_track.c.track_pos)).where(
+                playlist_track.c.playlist_id == self.id).where(
+                    playlist_track.c.track_id != track.id).where(
+                        playlist_track.c.track_pos > prev_pos if prev_pos is not None
+                        else true())).scalar()
+
+        if prev_pos is None and next_pos is None:
+            # the track is the only track on the playlist
+            return None, None
+        elif prev_pos is None:
+            track_pos, gap = next_pos - TRACK_POS_GAP, TRACK_POS_GAP
+        elif next_pos is None:
+            track_pos, gap = prev_pos + TRACK_POS_GAP, TRACK_POS_GAP
+        elif next_pos - prev_pos < 2:
+            # there is no position left between the two tracks
+            self.refresh_track_positions()
+            return self.move_track(track, after)
+        else:
+            track_pos, gap = (prev_pos + next_pos) // 2, next_pos - prev_pos
+
+        db.session.execute(update(playlist_track).where(
+            playlist_track.c.playlist_id == self.id).where(
+                playlist_track.c.track_id == track.id).values(track_pos=track_pos))
+
+        return track_pos, gap
+
 # stores dynamic sources of a playlist and their options
 # a sources is defined as playlist hosted on an external service
 class Source(db.Model, Serializer):
     id = db.Column(db.Integer, primary_key=True)
     service = db.Column(db.String(32))
-    service_id = db.Column(db.String(64))
+    service_id = db.Column(db.String(64), index=True)
     title = db.Column(db.String(128))
     art = db.Column(db.String(1024)) # source artwork
     href = db.Column(db.String(1024)) # source external link
@@ -273,6 +375,7 @@ class Track(db.Model, Serializer):
     art = db.Column(db.String(1024)) # track artwork
     href = db.Column(db.String(1024)) # track external link
     album_id = db.Column(db.Integer, db.ForeignKey('album.id')) # album the track is on
+    song_id = db.Column(db.Integer, db.ForeignKey('song.id'), index=True) # same song on other services
     sources = db.relationship(
         'Source',
         secondary=track_source,
@@ -294,6 +397,11 @@ class Track(db.Model, Serializer):
         back_populates='blacklist',
         lazy='dynamic')
 
+    # the service id comes first so that the constraint also serves lookups by service id
+    __table_args__ = (
+        db.UniqueConstraint('service_id', 'service', name='uq_track_service_id_service'),
+    )
+
     def __repr__(self):
         return '<Track {}, Service {}>'.format(
             self.title, self.service)
@@ -339,6 +447,23 @@ class Track(db.Model, Serializer):
 
         db.session.commit()
 
+# a song as it exists across services
+# tracks of the same song on different services are linked to one song by
+# the matcher in app.playlists.matching
+class Song(db.Model, Serializer):
+    id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.String(128))
+    artist = db.Column(db.String(256)) # credited artists, comma separated
+    created = db.Column(db.DateTime, default=datetime.utcnow)
+    tracks = db.relationship('Track', backref='song', lazy='dynamic')
+
+    def __repr__(self):
+        return '<Song {}, Artist {}>'.format(self.title, self.artist)
+
+    def serialize(self):
+        d = Serializer.serialize(self)
+        return d
+
 # stores infromation about an album
 class Album(db.Model, Serializer):
     id = db.Column(db.Integer, primary_key=True)
@@ -353,6 +478,10 @@ class Album(db.Model, Serializer):
         back_populates='albums',
         lazy='dynamic')
 
+    __table_args__ = (
+        db.Index('ix_album_service_id_title', 'service_id', 'title'),
+    )
+
     def __repr__(self):
         return '<Album {}>'.format(self.title)
 
@@ -392,6 +521,10 @@ class Artist(db.Model, Serializer):
         back_populates='artists',
         lazy='dynamic')
 
+    __table_args__ = (
+        db.Index('ix_artist_service_id_name', 'service_id', 'name'),
+    )
+
     def __repr__(self):
         return '<Artist {}>'.format(self.name)
 
@@ -414,6 +547,39 @@ class Artist(db.Model, Serializer):
             return #YOUTUBE LINK
 
 
+# a queued piece of background work on a playlist, e.g. a refresh
+# jobs are stored in the database so queued work survives restarts, and are
+# picked up by the worker pool in app.playlists.jobs in (priority, id) order
+class Job(db.Model, Serializer):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    playlist_id = db.Column(db.Integer, db.ForeignKey('playlist.id'))
+    kind = db.Column(db.String(32), default='refresh') # type of work to run
+    priority = db.Column(db.Integer, default=0) # lower runs first
+    status = db.Column(db.String(16), default='queued') # queued, running, done or failed
+    phase = db.Column(db.String(32), default='queued') # current step of a running job
+    pages_fetched = db.Column(db.Integer, default=0)
+    tracks_ingested = db.Column(db.Integer, default=0)
+    sources_skipped = db.Column(db.Integer, default=0) # sources that were unchanged since the last refresh
+    external_calls = db.Column(db.JSON) # service name -> endpoint -> calls made by the job
+    error = db.Column(db.String(1024))
+    created = db.Column(db.DateTime, default=datetime.utcnow)
+    started = db.Column(db.DateTime)
+    finished = db.Column(db.DateTime)
+    heartbeat = db.Column(db.DateTime) # last time the process running the job reported it alive
+
+    __table_args__ = (
+        db.Index('ix_job_status_priority', 'status', 'priority', 'id'),
+    )
+
+    def __repr__(self):
+        return '<Job {}, {} Playlist {}, Status {}>'.format(
+            self.id, self.kind, self.playlist_id, self.status)
+
+    def serialize(self):
+        d = Serializer.serialize(self)
+        return d
+
 #- Meta tables from Marchmallow -#
 class UserSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
@@ -449,6 +615,71 @@ class ArtistSchema(ma.SQLAlchemyAutoSchema):
         model = Artist
         include_fk = True
 
+# caches users and their services between requests, for USER_CACHE_TTL seconds
+# entries are snapshots of the rows' columns, which are turned back into instances
+# of the current session without querying it, so no instance is shared between requests
+class UserCache():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = TTLCache(maxsize=1024, ttl=Config.USER_CACHE_TTL) # user id -> snapshot
+
+    # returns the columns of a loaded instance
+    def snapshot(self, instance):
+        return {c.key: getattr(instance, c.key) for c in inspect(instance).mapper.column_attrs}
+
+    # returns a user's snapshot, loading it (and the user's services) from the database if needed
+    def entry(self, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+
+        if entry is None:
+            user = db.session.get(User, user_id)
+            if user is None:
+                return None
+
+            entry = {
+                'user': self.snapshot(user),
+                'services': [self.snapshot(s) for s in user.services]}
+
+            with self.lock:
+                self.entries[user_id] = entry
+
+        return entry
+
+    # returns a user, with their services loaded, as an instance of the current session
+    def get_user(self, user_id):
+        entry = self.entry(user_id)
+        if entry is None:
+            return None
+
+        services = [Service(**s) for s in entry['services']]
+        for service in services:
+            make_transient_to_detached(service)
+
+        user = User(**entry['user'])
+        make_transient_to_detached(user)
+        set_committed_value(user, 'services', services)
+
+        return db.session.merge(user, load=False)
+
+    # returns the credentials of a user's service
+    def credentials(self, user_id, name):
+        entry = self.entry(user_id)
+        if entry is None:
+            return None
+
+        for service in entry['services']:
+            if service['name'] == name:
+                return service['credentials']
+
+    # forgets a user, e.g. after their services or credentials changed
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+user_cache = UserCache()
+
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    return user_cache.get_user(int(id))
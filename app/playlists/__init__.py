@@ -2,4 +2,4 @@ from flask import Blueprint
 
 bp = Blueprint('playlists', __name__)
 
-from app.playlists import forms, routes
+from app.playlists import forms, routes, export, matching, search
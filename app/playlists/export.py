@@ -0,0 +1,123 @@
+import csv
+import io
+import json
+import sys
+import click
+from itertools import groupby
+from sqlalchemy import select
+from app import db
+from app.playlists import bp
+from app.models import Playlist, Track, Album, Artist, playlist_track, track_artist
+from config import Config
+
+# fields of each exported track, in the order csv columns are written
+EXPORT_FIELDS = ('position', 'title', 'artists', 'album', 'service', 'service_id', 'href')
+
+# streams a playlist's tracks in track_pos order from a server-side cursor
+# each track is yielded as soon as its rows are read, so memory use stays
+# constant however long the playlist is
+def export_tracks(playlist_id):
+    query = select(
+        Track.id,
+        Track.title,
+        Track.service,
+        Track.service_id,
+        Track.href,
+        Album.title.label('album'),
+        Artist.name.label('artist')).select_from(Track.__table__).join(
+            playlist_track, playlist_track.c.track_id == Track.id).outerjoin(
+                Album, Album.id == Track.album_id).outerjoin(
+                    track_artist, track_artist.c.track_id == Track.id).outerjoin(
+                        Artist, Artist.id == track_artist.c.artist_id).where(
+                            playlist_track.c.playlist_id == playlist_id).order_by(
+                                playlist_track.c.track_pos, playlist_track.c.track_id)
+
+    # yield_per fetches the rows in batches instead of loading the whole result
+    result = db.session.execute(query.execution_options(yield_per=Config.EXPORT_CHUNK_SIZE))
+    rows = (row for partition in result.partitions() for row in partition)
+
+    # a track has a row per artist, and its rows are next to each other
+    for position, (_, track_rows) in enumerate(groupby(rows, key=lambda row: row.id), 1):
+        track_rows = list(track_rows)
+        track = track_rows[0]
+
+        yield {
+            'position': position,
+            'title': track.title,
+            'artists': [row.artist for row in track_rows if row.artist is not None],
+            'album': track.album,
+            'service': track.service,
+            'service_id': track.service_id,
+            'href': track.href,
+        }
+
+# one line of newline delimited json per track
+def ndjson_lines(tracks):
+    for track in tracks:
+        yield json.dumps(track, separators=(',', ':'), ensure_ascii=False) + '\n'
+
+# a header row, then a row per track with its artists separated by commas
+def csv_lines(tracks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def line(values):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(values)
+        return buffer.getvalue()
+
+    yield line(EXPORT_FIELDS)
+    for track in tracks:
+        yield line([
+            ', '.join(track[f]) if f == 'artists' else track[f] for f in EXPORT_FIELDS])
+
+# an extended m3u playlist of the tracks' links
+def m3u_lines(tracks):
+    yield '#EXTM3U\n'
+    for track in tracks:
+        title = f"{', '.join(track['artists'])} - {track['title']}" if track['artists'] else track['title']
+        # titles cannot span lines in an m3u file
+        title = ' '.join((title or '').splitlines())
+        yield f"#EXTINF:-1,{title}\n{track['href']}\n"
+
+# format name -> (mimetype, function turning tracks into lines)
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', ndjson_lines),
+    'csv': ('text/csv', csv_lines),
+    'm3u': ('audio/x-mpegurl', m3u_lines),
+}
+
+# streams a playlist in one of EXPORT_FORMATS as chunks of text
+# the first chunk is sent right away, the rest every EXPORT_CHUNK_SIZE tracks
+def export_playlist(playlist_id, format):
+    _, lines = EXPORT_FORMATS[format]
+
+    chunk = []
+    for i, line in enumerate(lines(export_tracks(playlist_id))):
+        chunk.append(line)
+
+        if i == 0 or len(chunk) >= Config.EXPORT_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+
+    if chunk:
+        yield ''.join(chunk)
+
+# writes a playlist to a file, or to stdout if no file is given
+# e.g. flask playlists export 3 --format csv --output playlist.csv
+@bp.cli.command('export')
+@click.argument('playlist_id', type=int)
+@click.option('--format', 'format', type=click.Choice(list(EXPORT_FORMATS)), default='ndjson')
+@click.option('--output', type=click.Path(dir_okay=False, writable=True))
+def export_command(playlist_id, format, output):
+    if not db.session.get(Playlist, playlist_id):
+        raise click.ClickException(f'Playlist {playlist_id} does not exist')
+
+    out = open(output, 'w', encoding='utf-8', newline='') if output else sys.stdout
+    try:
+        for chunk in export_playlist(playlist_id, format):
+            out.write(chunk)
+    finally:
+        if output:
+            out.close()
@@ -0,0 +1,301 @@
+import threading
+from time import sleep
+from datetime import datetime, timedelta
+from flask_login import login_user
+from sqlalchemy import select, update, func
+from app import db
+from app.playlists import bp
+from app.playlists.refresh import refresh_playlist
+from app.playlists.push import push_playlist
+from app.models import Job, Playlist, User
+from app.auth_external.scheduler import CallReport, current_report
+
+# priority of each lane of work, lower runs first
+LANES = {
+    'user': 0, # refreshes triggered by the user
+    'scheduled': 1, # refreshes queued by the scheduler (flask playlists refresh)
+}
+
+# spreads a playlist's track positions out again once moves have used up their gaps
+def renumber_playlist(playlist, progress):
+    progress.phase('renumbering')
+    playlist.refresh_track_positions()
+    playlist.bump_version()
+    db.session.commit()
+
+# functions that carry out each kind of job
+HANDLERS = {
+    'refresh': refresh_playlist,
+    'renumber': renumber_playlist,
+    'push': push_playlist,
+}
+
+# live progress of a running job
+# it is kept in memory instead of the job row so that reporting progress never
+# contends with the job's own transaction for the database's write lock
+class Progress():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {
+            'phase': 'starting',
+            'pages_fetched': 0,
+            'tracks_ingested': 0,
+            'sources_skipped': 0}
+        self.calls = CallReport() # calls the job made to each service
+
+    # sets the step the job is currently on
+    def phase(self, name):
+        with self.lock:
+            self.values['phase'] = name
+
+    # counts a page of tracks fetched from a service
+    def page(self):
+        with self.lock:
+            self.values['pages_fetched'] += 1
+
+    # counts tracks added to the playlist
+    def ingested(self, amount):
+        with self.lock:
+            self.values['tracks_ingested'] += amount
+
+    # counts a source that was skipped because it has not changed
+    def skipped(self):
+        with self.lock:
+            self.values['sources_skipped'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            values = dict(self.values)
+
+        values['external_calls'] = self.calls.snapshot()
+        return values
+
+# runs queued jobs on a pool of local worker threads
+# jobs are claimed from the job table, so jobs queued by another process (or
+# before a restart) are picked up as well. the first worker only serves the
+# user lane so that a backlog of scheduled work never delays user refreshes
+# every process keeps a heartbeat on the jobs it runs, and jobs whose
+# heartbeat stopped (e.g. their process crashed or restarted) are queued again
+class JobRunner():
+
+    def __init__(self):
+        self.app = None
+        self.workers = []
+        self.progress = {} # job id -> Progress of the jobs running in this process
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition()
+
+    def init_app(self, app):
+        self.app = app
+        app.before_first_request(self.start)
+
+    # starts the worker threads once per process
+    def start(self):
+        with self.lock:
+            if self.workers:
+                return
+
+            with self.app.app_context():
+                self.requeue_stale()
+
+            heartbeat = threading.Thread(target=self.beat, name='job-heartbeat', daemon=True)
+            heartbeat.start()
+
+            for i in range(max(self.app.config['REFRESH_WORKERS'], 1)):
+                lanes = ['user'] if i == 0 and self.app.config['REFRESH_WORKERS'] > 1 \
+                    else list(LANES)
+                worker = threading.Thread(
+                    target=self.work,
+                    args=(lanes,),
+                    name=f'job-worker-{i}',
+                    daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    # queues a job on a playlist and returns it
+    # if the playlist already has a pending job of the same kind, that job is returned instead
+    def enqueue(self, playlist, lane='user', kind='refresh'):
+        job = Job.query.filter(
+            Job.playlist_id == playlist.id,
+            Job.kind == kind,
+            Job.status.in_(['queued', 'running'])).first()
+
+        if not job:
+            job = Job(
+                user_id=playlist.user_id,
+                playlist_id=playlist.id,
+                kind=kind,
+                priority=LANES[lane])
+            db.session.add(job)
+        elif job.status == 'queued' and job.priority > LANES[lane]:
+            # moves a pending job into a more urgent lane
+            job.priority = LANES[lane]
+
+        db.session.commit()
+
+        # wakes up idle workers, workers of other processes poll the job table
+        with self.wakeup:
+            self.wakeup.notify_all()
+
+        return job
+
+    # returns the newest pending job on a playlist, if there is one
+    def active_job(self, playlist, kind='refresh'):
+        return Job.query.filter(
+            Job.playlist_id == playlist.id,
+            Job.kind == kind,
+            Job.status.in_(['queued', 'running'])).order_by(Job.id.desc()).first()
+
+    # returns a serializable report of a job's status and progress
+    def status(self, job):
+        status = {
+            'id': job.id,
+            'playlist_id': job.playlist_id,
+            'kind': job.kind,
+            'status': job.status,
+            'phase': job.phase,
+            'pages_fetched': job.pages_fetched,
+            'tracks_ingested': job.tracks_ingested,
+            'sources_skipped': job.sources_skipped,
+            'external_calls': job.external_calls,
+            'error': job.error}
+
+        # running jobs report their live progress
+        progress = self.progress.get(job.id)
+        if progress and job.status == 'running':
+            status.update(progress.snapshot())
+
+        return status
+
+    # queues the running jobs whose heartbeat stopped again
+    # jobs running in other live processes keep their heartbeat fresh and are left alone
+    def requeue_stale(self):
+        cutoff = datetime.utcnow() - timedelta(seconds=self.app.config['JOB_STALE_AFTER'])
+        # jobs claimed before heartbeats were kept only have their start time
+        stale = (Job.status == 'running', func.coalesce(Job.heartbeat, Job.started) < cutoff)
+
+        # checks first so that idle workers do not take the database's write lock
+        if db.session.execute(select(Job.id).where(*stale).limit(1)).scalar() is None:
+            return
+
+        db.session.execute(
+            update(Job).where(*stale).values(status='queued', phase='queued').execution_options(
+                synchronize_session=False))
+        db.session.commit()
+
+    # keeps the heartbeat of the jobs running in this process fresh until the process exits
+    def beat(self):
+        while True:
+            sleep(self.app.config['JOB_HEARTBEAT_INTERVAL'])
+
+            job_ids = list(self.progress)
+            if not job_ids:
+                continue
+
+            with self.app.app_context():
+                try:
+                    db.session.execute(update(Job).where(
+                        Job.id.in_(job_ids),
+                        Job.status == 'running').values(heartbeat=datetime.utcnow()))
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception('Could not write job heartbeats')
+
+    # atomically marks the next queued job in the given lanes as running
+    # returns the id of the claimed job or none if there is no work
+    def claim(self, lanes):
+        job_id = db.session.execute(
+            select(Job.id).where(
+                Job.status == 'queued',
+                Job.priority.in_([LANES[lane] for lane in lanes])).order_by(
+                    Job.priority, Job.id).limit(1)).scalar()
+
+        if job_id is None:
+            return None
+
+        # another worker may have claimed the job in the meantime
+        claimed = db.session.execute(update(Job).where(
+            Job.id == job_id,
+            Job.status == 'queued').values(
+                status='running',
+                phase='starting',
+                started=datetime.utcnow(),
+                heartbeat=datetime.utcnow())).rowcount
+        db.session.commit()
+
+        return job_id if claimed else None
+
+    # worker loop, runs jobs from the given lanes until the process exits
+    def work(self, lanes):
+        while True:
+            with self.app.app_context():
+                job_id = self.claim(lanes)
+
+                # idle workers pick up the jobs of processes that went away
+                if job_id is None:
+                    self.requeue_stale()
+
+            if job_id is None:
+                with self.wakeup:
+                    self.wakeup.wait(self.app.config['JOB_POLL_INTERVAL'])
+                continue
+
+            try:
+                self.run(job_id)
+            except Exception:
+                # the job is queued again once its heartbeat goes stale
+                self.app.logger.exception(f'Could not record the outcome of job {job_id}')
+
+    # runs a single claimed job and records its outcome
+    def run(self, job_id):
+        progress = Progress()
+        self.progress[job_id] = progress
+
+        # the calls the job makes to spotify and youtube are counted by its progress
+        token = current_report.set(progress.calls)
+
+        try:
+            # services read the current user and session, so jobs run inside a request context
+            with self.app.test_request_context():
+                job = Job.query.get(job_id)
+
+                try:
+                    login_user(User.query.get(job.user_id))
+                    HANDLERS[job.kind](Playlist.query.get(job.playlist_id), progress)
+                    status, error = 'done', None
+                except Exception as e:
+                    db.session.rollback()
+                    self.app.logger.exception(f'Job {job_id} failed')
+                    status, error = 'failed', repr(e)[:1024]
+
+                values = progress.snapshot()
+                db.session.execute(update(Job).where(Job.id == job_id).values(
+                    status=status,
+                    phase=status,
+                    pages_fetched=values['pages_fetched'],
+                    tracks_ingested=values['tracks_ingested'],
+                    sources_skipped=values['sources_skipped'],
+                    external_calls=values['external_calls'],
+                    error=error,
+                    finished=datetime.utcnow()))
+                db.session.commit()
+        finally:
+            current_report.reset(token)
+            del self.progress[job_id]
+
+        if values['external_calls']:
+            self.app.logger.info(f'Job {job_id} made external calls: {values["external_calls"]}')
+
+runner = JobRunner()
+
+# queues a refresh of every playlist in the scheduled lane
+# meant to be run periodically, e.g. from cron: flask playlists refresh
+@bp.cli.command('refresh')
+def schedule_refreshes():
+    playlists = Playlist.query.all()
+    for playlist in playlists:
+        runner.enqueue(playlist, lane='scheduled')
+
+    print(f'Queued {len(playlists)} playlist refreshes')
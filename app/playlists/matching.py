@@ -0,0 +1,289 @@
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby
+import click
+from sqlalchemy import select, insert, update, bindparam
+from app import db
+from app.playlists import bp
+from app.playlists.sync import chunks
+from app.models import Track, Artist, Song, track_artist
+from config import Config
+
+# the service whose tracks the others are matched against
+# spotify's titles and artists are clean, unlike youtube video titles
+REFERENCE_SERVICE = 'spotify'
+
+# words in brackets that only describe the upload and are dropped from titles
+NOISE = {
+    'official', 'video', 'music', 'audio', 'lyric', 'lyrics', 'hd', 'hq', '4k',
+    'premiere', 'visualizer', 'visualiser', 'explicit', 'clean', 'clip', 'mv',
+    'color', 'coded', 'full', 'song', 'out', 'now', 'free', 'download'}
+
+# words that make a track a different recording of a song, e.g. a remix
+# tracks only match if they have the same version words
+VERSION = {
+    'remix', 'mix', 'edit', 'live', 'acoustic', 'instrumental', 'cover',
+    'remake', 'vip', 'bootleg', 'flip', 'rework', 'extended', 'unplugged'}
+
+# suffixes youtube adds to channel names
+CHANNEL_SUFFIXES = re.compile(r'(\s*-\s*topic|vevo|\s+official)$', re.IGNORECASE)
+
+BRACKETS = re.compile(r'[\(\[\{]([^\)\]\}]*)[\)\]\}]')
+FEATURING = re.compile(r'\s(?:feat|ft|featuring)\b\.?\s*(.*)$', re.IGNORECASE)
+FEATURING_BRACKET = re.compile(r'^\s*(?:feat|ft|featuring|with)\b\.?\s*(.*)$', re.IGNORECASE)
+SEPARATOR = re.compile(r'\s+[-–—]\s+')
+NOT_WORD = re.compile(r'[^\w]+')
+
+# tokens appearing in more than this share of the reference titles are too
+# common to narrow down candidates, they still count towards the score
+COMMON_TOKEN_SHARE = 0.05
+
+# candidates scored per track, the ones sharing the most title tokens
+MAX_CANDIDATES = 32
+
+# lower cased ascii words of a string
+def tokens(s):
+    s = unicodedata.normalize('NFKD', s or '')
+    s = ''.join(c for c in s if not unicodedata.combining(c)).casefold()
+    return [t for t in NOT_WORD.sub(' ', s.replace("'", '').replace('’', '')).split() if t]
+
+# splits a title into the tokens of the song's name, its version words and
+# the artists it features
+def parse_title(title):
+    featured = []
+    version = set()
+
+    # bracketed parts are either featured artists, version words or noise
+    def bracket(match):
+        inner = match.group(1)
+        feat = FEATURING_BRACKET.match(inner)
+        if feat:
+            featured.extend(tokens(feat.group(1)))
+        else:
+            words = set(tokens(inner))
+            if words & VERSION:
+                version.update(words - NOISE)
+        return ' '
+
+    title = BRACKETS.sub(bracket, title or '')
+
+    feat = FEATURING.search(title)
+    if feat:
+        featured.extend(tokens(feat.group(1)))
+        title = title[:feat.start()]
+
+    name = [t for t in tokens(title.replace('"', ' ')) if t not in NOISE]
+    # e.g. "Title Remix - Artist" without brackets
+    version.update(set(name) & VERSION)
+    return name, version, featured
+
+# normalizes a track into (title tokens, version words, artist tokens, whether
+# the artist was only guessed from a youtube channel name)
+def normalize(service, title, artists):
+    name, version, featured = parse_title(title)
+    artist_tokens = set(featured)
+
+    if service == REFERENCE_SERVICE:
+        for a in artists:
+            artist_tokens.update(tokens(a))
+        return name, version, artist_tokens, False
+
+    # youtube titles are usually "Artist - Title", the uploader is often a label
+    parts = SEPARATOR.split(title or '', maxsplit=1)
+    if len(parts) == 2:
+        name, version, featured = parse_title(parts[1])
+        artist_tokens = set(featured) | set(tokens(parts[0]))
+        guessed = False
+    else:
+        guessed = True
+
+    for a in artists:
+        artist_tokens.update(tokens(CHANNEL_SUFFIXES.sub('', a or '')))
+
+    return name, version, artist_tokens, guessed
+
+# how alike two tracks are, from 0 to 1
+# titles weigh the most, artists only need to overlap since youtube credits are partial
+def score(query, candidate):
+    q_name, q_version, q_artists, guessed = query
+    c_name, c_version, c_artists, _ = candidate
+
+    if q_version != c_version or not c_name:
+        return 0
+
+    q_name = set(q_name)
+    c_name = set(c_name)
+    if guessed:
+        # without an "Artist - Title" split the title may contain the artist
+        q_name -= c_artists - c_name
+
+    if not q_name:
+        return 0
+
+    title = 2 * len(q_name & c_name) / (len(q_name) + len(c_name))
+
+    shared = q_artists & c_artists
+    artist = len(shared) / min(len(q_artists), len(c_artists)) if shared else 0
+
+    return 0.7 * title + 0.3 * artist
+
+# an inverted index from title tokens to the reference tracks containing them
+# candidates for a track are the reference tracks sharing its least common
+# tokens, so each track is only scored against a handful of others
+class TrackIndex():
+
+    def __init__(self, tracks):
+        self.ids = [] # position -> track id
+        self.tracks = [] # position -> normalized track
+        self.postings = defaultdict(list) # title token -> positions of the tracks containing it
+
+        for track_id, track in tracks:
+            position = len(self.ids)
+            self.ids.append(track_id)
+            self.tracks.append(track)
+            for t in set(track[0]):
+                self.postings[t].append(position)
+
+        self.common = max(int(len(self.ids) * COMMON_TOKEN_SHARE), 8)
+
+    # returns the positions of the tracks sharing the most title tokens with a query
+    def candidates(self, query):
+        counts = Counter()
+        for t in set(query[0]):
+            positions = self.postings.get(t, ())
+            if len(positions) <= self.common:
+                counts.update(positions)
+
+        if not counts:
+            # every token is common, e.g. a one word title
+            for t in set(query[0]):
+                counts.update(self.postings.get(t, ()))
+
+        return [position for position, _ in counts.most_common(MAX_CANDIDATES)]
+
+    # returns (track id, score) of the best match of a query, if any clears the threshold
+    def match(self, query, threshold):
+        best = None, 0
+        for position in self.candidates(query):
+            s = score(query, self.tracks[position])
+            if s > best[1]:
+                best = self.ids[position], s
+
+        return best if best[1] >= threshold else None
+
+# the index of a worker process, set once by its initializer
+worker_index = None
+
+def init_worker(index):
+    global worker_index
+    worker_index = index
+
+def match_chunk(queries, threshold):
+    return [(track_id, worker_index.match(query, threshold)) for track_id, query in queries]
+
+# returns (track id, normalized track) of every track of the given services
+# tracks already linked to a song are left out unless include_linked is set
+def load_tracks(services, include_linked):
+    query = select(
+        Track.id,
+        Track.service,
+        Track.title,
+        Artist.name).select_from(Track.__table__).outerjoin(
+            track_artist, track_artist.c.track_id == Track.id).outerjoin(
+                Artist, Artist.id == track_artist.c.artist_id).where(
+                    Track.service.in_(services)).order_by(Track.id)
+
+    if not include_linked:
+        query = query.where(Track.song_id.is_(None))
+
+    for track_id, rows in groupby(db.session.execute(query), key=lambda row: row.id):
+        rows = list(rows)
+        yield track_id, normalize(
+            rows[0].service,
+            rows[0].title,
+            [row.name for row in rows if row.name is not None])
+
+# matches every unlinked track of the other services against the reference catalog
+# returns a list of (track id, reference track id, score)
+def find_matches(threshold=None, workers=None):
+    threshold = Config.MATCH_THRESHOLD if threshold is None else threshold
+    workers = Config.MATCH_WORKERS if workers is None else workers
+
+    index = TrackIndex(load_tracks([REFERENCE_SERVICE], include_linked=True))
+    queries = list(load_tracks(
+        [s for s in Config.SUPPORTED_SERVICES if s != REFERENCE_SERVICE], include_linked=False))
+
+    if workers > 1 and len(queries) >= Config.MATCH_PROCESS_THRESHOLD:
+        # the index is sent to each worker once, then only the queries travel
+        size = -(-len(queries) // (workers * 4))
+        with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(index,)) as pool:
+            futures = [
+                pool.submit(match_chunk, queries[i:i + size], threshold)
+                for i in range(0, len(queries), size)]
+            results = [r for f in futures for r in f.result()]
+    else:
+        results = [(track_id, index.match(query, threshold)) for track_id, query in queries]
+
+    return [(track_id, match[0], match[1]) for track_id, match in results if match]
+
+# links matched tracks to a song, creating songs for reference tracks that have none
+# returns the number of tracks that were linked
+def link_matches(matches):
+    if not matches:
+        return 0
+
+    reference_ids = {reference_id for _, reference_id, _ in matches}
+    songs = {} # reference track id -> song id
+    for chunk in chunks(reference_ids):
+        songs.update(db.session.execute(
+            select(Track.id, Track.song_id).where(
+                Track.id.in_(chunk), Track.song_id.isnot(None))).all())
+
+    # the reference track names the song
+    unlinked = reference_ids - songs.keys()
+    if unlinked:
+        rows = []
+        for chunk in chunks(unlinked):
+            rows.extend(db.session.execute(
+                select(Track.id, Track.title, Artist.name).outerjoin(
+                    track_artist, track_artist.c.track_id == Track.id).outerjoin(
+                        Artist, Artist.id == track_artist.c.artist_id).where(
+                            Track.id.in_(chunk)).order_by(Track.id)).all())
+
+        for track_id, track_rows in groupby(rows, key=lambda row: row.id):
+            track_rows = list(track_rows)
+            song_id = db.session.execute(insert(Song).values(
+                title=track_rows[0].title,
+                artist=', '.join(r.name for r in track_rows if r.name)[:256])).inserted_primary_key[0]
+            songs[track_id] = song_id
+
+    sql = update(Track.__table__).where(
+        Track.id == bindparam('b_track_id')).values(song_id=bindparam('b_song_id'))
+    db.session.execute(sql, [
+        {'b_track_id': track_id, 'b_song_id': songs[track_id]} for track_id in unlinked] + [
+        {'b_track_id': track_id, 'b_song_id': songs[reference_id]}
+        for track_id, reference_id, _ in matches])
+    db.session.commit()
+
+    return len(matches)
+
+# links tracks on different services that are the same song
+# e.g. flask playlists match --threshold 0.85 --dry-run
+@bp.cli.command('match')
+@click.option('--threshold', type=float, help='Lowest score at which tracks are linked')
+@click.option('--workers', type=int, help='Processes to match with')
+@click.option('--dry-run', is_flag=True, help='Print the matches instead of storing them')
+def match_command(threshold, workers, dry_run):
+    matches = find_matches(threshold, workers)
+
+    if dry_run:
+        titles = {}
+        for chunk in chunks({i for m in matches for i in m[:2]}):
+            titles.update(db.session.execute(
+                select(Track.id, Track.title).where(Track.id.in_(chunk))).all())
+        for track_id, reference_id, s in matches:
+            print(f'{s:.2f}  {titles[track_id]}  ->  {titles[reference_id]}')
+    else:
+        print(f'Linked {link_matches(matches)} tracks to songs')
@@ -0,0 +1,331 @@
+from bisect import bisect_left
+from collections import Counter
+from flask import current_app
+from googleapiclient.errors import HttpError
+from sqlalchemy import select
+from app import db
+from app.models import Track, playlist_track
+from app.auth_external.services import clients
+from app.auth_external.scheduler import QuotaExceeded
+from app.playlists.refresh import refresh_playlist
+from app.playlists.sync import chunks
+
+# spotify takes at most this many tracks per add or remove call
+PUSH_BATCH_SIZE = 100
+
+# only the ids of the remote tracks are needed to diff against
+PUSH_TRACK_FIELDS = 'total,items(track(id))'
+YOUTUBE_PUSH_TRACK_FIELDS = 'etag,nextPageToken,items(id,snippet(resourceId(videoId)))'
+
+# rounds of writes made to a youtube playlist before giving up on matching the local order
+YOUTUBE_PUSH_ROUNDS = 3
+
+# returns the ids a service knows a playlist's tracks by, in track_pos order
+# tracks of other services are pushed as the track of the same song on the
+# service, if the matcher linked one (see app.playlists.matching), and are left out otherwise
+def service_tracklist(playlist, service):
+    rows = db.session.execute(
+        select(Track.service, Track.service_id, Track.song_id).join(
+            playlist_track, playlist_track.c.track_id == Track.id).where(
+                playlist_track.c.playlist_id == playlist.id).order_by(
+                    playlist_track.c.track_pos, playlist_track.c.track_id)).all()
+
+    songs = {}
+    song_ids = {row.song_id for row in rows if row.service != service and row.song_id}
+    for chunk in chunks(song_ids):
+        songs.update(db.session.execute(
+            select(Track.song_id, Track.service_id).where(
+                Track.song_id.in_(chunk),
+                Track.service == service)).all())
+
+    tracklist = (
+        row.service_id if row.service == service else songs.get(row.song_id)
+        for row in rows)
+
+    # a song is only pushed once, where it first appears
+    return list(dict.fromkeys(t for t in tracklist if t))
+
+# returns the indexes of a longest increasing subsequence of a list of numbers
+def longest_increasing(numbers):
+    tails = [] # smallest last number of an increasing subsequence of each length
+    tail_indexes = []
+    previous = [None] * len(numbers)
+
+    for i, n in enumerate(numbers):
+        length = bisect_left(tails, n)
+        if length == len(tails):
+            tails.append(n)
+            tail_indexes.append(i)
+        else:
+            tails[length] = n
+            tail_indexes[length] = i
+        previous[i] = tail_indexes[length - 1] if length else None
+
+    indexes = []
+    i = tail_indexes[-1] if tail_indexes else None
+    while i is not None:
+        indexes.append(i)
+        i = previous[i]
+
+    return indexes[::-1]
+
+# plans the calls that turn the remote tracklist into the local one
+# remote is the list of track ids on the spotify playlist, with none for items
+# that have no id (e.g. local files), which are kept at the end of the playlist
+# returns a list of operations, applied in order:
+#   ('remove', ids): removes every occurrence of the tracks
+#   ('move', range_start, insert_before, range_length): moves a range of tracks
+#   ('add', ids, position): inserts tracks at a position
+# tracks that kept their relative order are left where they are, so only the
+# tracks that were added, removed or moved around cost calls
+def plan_push(remote, local):
+    ops = []
+
+    # drops tracks that are no longer on the playlist, along with duplicates,
+    # which are added back once in the right place
+    counts = Counter(remote)
+    wanted = set(local)
+    removed = [t for t in counts if t is not None and (t not in wanted or counts[t] > 1)]
+    if removed:
+        ops.append(('remove', removed))
+
+    removed = set(removed)
+    current = [t for t in remote if t not in removed]
+    present = set(current)
+
+    # ranks every remaining track by the position it should end up at
+    rank = {t: r for r, t in enumerate(t for t in local if t in present)}
+
+    # items without an id keep their order after the tracks
+    ranks = []
+    unaddressed = len(rank)
+    for t in current:
+        if t is None:
+            ranks.append(unaddressed)
+            unaddressed += 1
+        else:
+            ranks.append(rank[t])
+
+    # the longest run of tracks already in order stays, the rest is moved in
+    # rank order to just after the track ranked before it. tracks that are next
+    # to each other and stay next to each other are moved as one range
+    placed = {ranks[i] for i in longest_increasing(ranks)}
+    r = 0
+    while r < len(ranks):
+        if r in placed:
+            r += 1
+            continue
+
+        start = ranks.index(r)
+        length = 1
+        while start + length < len(ranks) and ranks[start + length] == r + length \
+                and r + length not in placed:
+            length += 1
+
+        before = ranks.index(r - 1) + 1 if r else 0
+        if before != start:
+            ops.append(('move', start, before, length))
+            moved = ranks[start:start + length]
+            del ranks[start:start + length]
+            at = before - length if before > start else before
+            ranks[at:at] = moved
+
+        placed.update(range(r, r + length))
+        r += length
+
+    # inserts the new tracks, in order, so the tracks before each run are already in place
+    run = []
+    for position, t in enumerate(local + [None]):
+        if t is not None and t not in present:
+            run.append(t)
+        elif run:
+            start = position - len(run)
+            for i in range(0, len(run), PUSH_BATCH_SIZE):
+                ops.append(('add', run[i:i + PUSH_BATCH_SIZE], start + i))
+            run = []
+
+    return ops
+
+# applies planned operations to a spotify playlist
+# every call is made against the snapshot the previous call produced
+# returns the snapshot id of the playlist once all operations were applied
+def apply_push(sp, service_id, ops, snapshot_id):
+    for op in ops:
+        if op[0] == 'remove':
+            for chunk in chunks(op[1], PUSH_BATCH_SIZE):
+                snapshot_id = sp.api.playlist_remove_all_occurrences_of_items(
+                    service_id, chunk, snapshot_id=snapshot_id)['snapshot_id']
+        elif op[0] == 'move':
+            _, start, before, length = op
+            snapshot_id = sp.api.playlist_reorder_items(
+                service_id, start, before, range_length=length,
+                snapshot_id=snapshot_id)['snapshot_id']
+        elif op[0] == 'add':
+            _, ids, position = op
+            snapshot_id = sp.api.playlist_add_items(
+                service_id, ids, position=position)['snapshot_id']
+
+    return snapshot_id
+
+# turns planned operations into requests to youtube, one per playlist item
+# items is the list of (item id, video id) on the playlist
+# returns a list of (request, kind of request, video id)
+def youtube_requests(yt, playlist_id, items, ops):
+    requests = []
+    items = list(items)
+
+    for op in ops:
+        if op[0] == 'remove':
+            removed = set(op[1])
+            requests.extend(
+                (yt.delete_item(item_id), 'delete', video_id)
+                for item_id, video_id in items if video_id in removed)
+            items = [item for item in items if item[1] not in removed]
+        elif op[0] == 'move':
+            _, start, before, length = op
+            moved = items[start:start + length]
+            del items[start:start + length]
+            at = before - length if before > start else before
+            items[at:at] = moved
+
+            # a range moving down is moved last item first, so that each item
+            # lands where it should without shifting the ones already moved
+            order = range(length) if before <= start else reversed(range(length))
+            requests.extend(
+                (yt.move_item(playlist_id, moved[k][0], moved[k][1], at + k), 'move', moved[k][1])
+                for k in order)
+        elif op[0] == 'add':
+            _, ids, position = op
+            requests.extend(
+                (yt.insert_item(playlist_id, video_id, position + k), 'insert', video_id)
+                for k, video_id in enumerate(ids))
+            items[position:position] = [(None, video_id) for video_id in ids]
+
+    return requests
+
+# returns the (item id, video id) of every item on a youtube playlist and the
+# etag of its tracklist
+def youtube_items(yt, playlist_id, progress):
+    tracks, tracks_etag = yt.get_tracks(
+        playlist_id, on_page=progress.page, fields=YOUTUBE_PUSH_TRACK_FIELDS)
+
+    return [[t['id'], t['snippet']['resourceId']['videoId']] for t in tracks], tracks_etag
+
+# pushes a tracklist to a spotify playlist
+# each call is a diff operation (see plan_push) made against the snapshot the previous one produced
+def push_spotify(playlist, source, state, local, progress):
+    sp = clients.get('spotify')
+    sp_playlist = sp.get_playlist(source.service_id)
+    if sp_playlist is None:
+        current_app.logger.warning(f'Push target {source.service_id} no longer exists')
+        return
+
+    if sp_playlist['snapshot_id'] == state['snapshot_id'] and state['pushed_tracks'] is not None:
+        remote = state['pushed_tracks']
+    else:
+        remote = [
+            (item['track'] or {}).get('id')
+            for item in sp.get_tracks(source.service_id, on_page=progress.page, fields=PUSH_TRACK_FIELDS)]
+
+    ops = plan_push(remote, local)
+    snapshot_id = apply_push(sp, source.service_id, ops, sp_playlist['snapshot_id'])
+
+    # the target now holds the local tracklist, followed by the items without an id
+    playlist.set_source_state(
+        source,
+        snapshot_id=snapshot_id,
+        pushed_tracks=local + [t for t in remote if t is None])
+
+# pushes a tracklist to a youtube playlist
+# youtube has no bulk writes, so every video added, moved or removed is a request
+# of its own costing 50 quota units. they are sent in batches (see
+# Youtube.execute_batch), which youtube does not promise to run in order, so
+# the playlist is read back after each round of writes and whatever is still
+# out of place is planned again, for up to YOUTUBE_PUSH_ROUNDS rounds. the
+# requests of those later rounds, usually few, are sent one at a time so that
+# their order holds
+def push_youtube(playlist, source, state, local, progress):
+    yt = clients.get('youtube')
+
+    # the refresh drops the pushed items if the tracklist changed since
+    tracks_etag = state['tracks_etag']
+    if state['pushed_tracks'] is not None:
+        items = state['pushed_tracks']
+    else:
+        items, tracks_etag = youtube_items(yt, source.service_id, progress)
+
+    unavailable = set() # videos youtube would not add, e.g. deleted or private ones
+    wrote = False
+    for attempt in range(YOUTUBE_PUSH_ROUNDS):
+        wanted = [v for v in local if v not in unavailable]
+        requests = youtube_requests(
+            yt, source.service_id, items, plan_push([v for _, v in items], wanted))
+        if not requests:
+            break
+
+        results = yt.execute_batch([request for request, _, _ in requests], size=1 if attempt else None)
+        wrote = True
+
+        for (_, kind, video_id), (_, error) in zip(requests, results):
+            if error is None or isinstance(error, QuotaExceeded):
+                continue
+
+            # the rest failed for the time being (e.g. a conflict with another
+            # write or a rate limit that outlasted its retries) and are planned again
+            status = error.resp.status if isinstance(error, HttpError) else None
+            if kind == 'insert' and status in (403, 404):
+                unavailable.add(video_id)
+            elif not (kind == 'delete' and status == 404): # already removed
+                current_app.logger.warning(f'Could not {kind} {video_id} on {source.service_id}: {error}')
+
+        # the playlist was partly written, the next push reads it again
+        if any(isinstance(error, QuotaExceeded) for _, error in results):
+            current_app.logger.warning(f'Youtube quota ran out while pushing to {source.service_id}')
+            playlist.set_source_state(source, pushed_tracks=None)
+            return
+
+        items, tracks_etag = youtube_items(yt, source.service_id, progress)
+
+    if [v for _, v in items] != [v for v in local if v not in unavailable]:
+        current_app.logger.warning(f'Push to {source.service_id} did not converge')
+
+    # the playlist's etags are kept so that the next refresh does not download what was just pushed
+    if wrote:
+        playlist.set_source_state(
+            source,
+            etag=yt.get_playlist(source.service_id)['etag'],
+            tracks_etag=tracks_etag,
+            pushed_tracks=items)
+    elif state['pushed_tracks'] is None:
+        playlist.set_source_state(source, pushed_tracks=items)
+
+# function pushing a tracklist to each service
+PUSHERS = {
+    'spotify': push_spotify,
+    'youtube': push_youtube,
+}
+
+# writes a playlist's merged tracklist out to the playlists it pushes to (see
+# Playlist.push_targets). the playlist is refreshed first so that changes
+# made on the services are merged in rather than overwritten
+# the tracklist last pushed is kept with the target, so an unchanged target
+# is only diffed against it instead of being downloaded again
+def push_playlist(playlist, progress):
+    refresh_playlist(playlist, progress)
+
+    targets = playlist.push_targets()
+    if not targets:
+        return
+
+    progress.phase('pushing')
+    states = playlist.source_states()
+    tracklists = {}
+
+    for source in targets:
+        if source.service not in tracklists:
+            tracklists[source.service] = service_tracklist(playlist, source.service)
+
+        PUSHERS[source.service](
+            playlist, source, states[source.id], tracklists[source.service], progress)
+
+    db.session.commit()
@@ -0,0 +1,172 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from flask import current_app
+from sqlalchemy import delete
+from app import db
+from app.models import Source
+from app.auth_external.services import clients
+from app.auth_external.scheduler import QuotaExceeded
+from app.playlists.sync import PlaylistSync
+
+# retrieves a spotify source's metadata and tracklist
+# runs on a fetch thread, so it only talks to spotify and never touches the database
+# state is the source's row in playlist_source, along with its service id
+# takes one call for the playlist's metadata and one to check the user still
+# follows it, the tracklist is only downloaded if it changed
+def fetch_spotify_source(sp, state, on_page):
+    service_id = state['service_id']
+
+    # retrieves playlist art, title and the version of its tracklist
+    sp_playlist = sp.get_playlist(service_id)
+
+    # the source is removed if it no longer exists or the user stopped following it
+    if sp_playlist is None or not sp.is_following(service_id):
+        return {'exists': False}
+
+    images = sp_playlist.get('images') or []
+    art = images[0]['url'] if images else None
+
+    result = {
+        'exists': True,
+        'title': sp_playlist['name'],
+        'art': art,
+        'tracks': None,
+        'state': {'snapshot_id': sp_playlist['snapshot_id']}}
+
+    # the snapshot id only changes when the tracklist does, so an
+    # unchanged tracklist is not downloaded or diffed
+    if sp_playlist['snapshot_id'] != state['snapshot_id']:
+        tracks = [sp.parse_track(t) for t in sp.get_tracks(service_id, on_page=on_page)]
+        result['tracks'] = [t for t in tracks if t]
+
+        # the tracklist last pushed to the playlist (see app.playlists.push) is outdated
+        result['state']['pushed_tracks'] = None
+
+    return result
+
+# retrieves a youtube source's metadata and tracklist
+# runs on a fetch thread, so it only talks to youtube and never touches the database
+# state is the source's row in playlist_source, along with its service id
+# the etags of the last refresh are sent along, so unchanged playlists are not
+# diffed again, and unchanged playlists of one page are not even downloaded
+def fetch_youtube_source(yt, state, on_page):
+    service_id = state['service_id']
+    result = {
+        'exists': True,
+        'title': None,
+        'art': None,
+        'tracks': None,
+        'state': {'etag': state['etag'], 'tracks_etag': None}}
+
+    # tries to retrieve the playlist from youtube, unless it has not changed
+    response = yt.get_playlist(service_id, etag=state['etag'])
+
+    if response is not None:
+        # checks if the source still exists
+        if response['pageInfo']['totalResults'] == 0:
+            return {'exists': False}
+
+        # retrieves playlist art and title
+        snippet = response['items'][0]['snippet']
+        result['title'] = snippet['title']
+        result['art'] = snippet['thumbnails']['default']['url']
+        result['state']['etag'] = response['etag']
+
+    # the tracklist is only checked against its etag if the playlist itself is
+    # unchanged (its etag covers the item count), otherwise it is downloaded again.
+    # a tracklist longer than a page is downloaded either way (see Youtube.get_tracks)
+    tracks_etag = state['tracks_etag'] if response is None else None
+    tracks, result['state']['tracks_etag'] = yt.get_tracks(
+        service_id, on_page=on_page, etag=tracks_etag)
+
+    # an unchanged tracklist is not downloaded or diffed
+    if tracks is not None:
+        result['tracks'] = [yt.parse_track(t) for t in tracks]
+
+        # the items last pushed to the playlist (see app.playlists.push) are outdated
+        result['state']['pushed_tracks'] = None
+
+    return result
+
+# keeps a musiversal playlist up-to-date with the tracklists of its sources
+# the metadata and tracklists of all sources are fetched concurrently first,
+# then the changes are written to the database in a single transaction
+# progress is notified of the current phase, every page fetched from a service,
+# the number of tracks ingested and every source skipped because it has not
+# changed since the last refresh (see app.playlists.jobs.Progress)
+def refresh_playlist(playlist, progress):
+    progress.phase('connecting')
+
+    fetchers = {
+        'spotify': fetch_spotify_source,
+        'youtube': fetch_youtube_source,
+    }
+
+    # only connects to the services the playlist has sources on
+    sources = [s for s in playlist.sources.all() if s.service in fetchers]
+    apis = {service: clients.get(service) for service in {s.service for s in sources}}
+
+    progress.phase('fetching')
+
+    # fetches every source on a bounded pool of threads
+    states = playlist.source_states()
+    with ThreadPoolExecutor(max_workers=current_app.config['REFRESH_FETCH_WORKERS']) as pool:
+        # fetches run in copies of the job's context so their calls are reported with it
+        futures = [pool.submit(
+            copy_context().run,
+            fetchers[s.service],
+            apis[s.service],
+            dict(states[s.id], service_id=s.service_id),
+            progress.page) for s in sources]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except QuotaExceeded:
+                results.append(None)
+
+    progress.phase('writing')
+
+    # loads the playlist's tracks, blacklist and source links once
+    sync = PlaylistSync(playlist)
+
+    # keeps the db's list of sources up-to-date, removing sources that no longer exist
+    for source, result in zip(sources, results):
+        # sources whose service ran out of quota are left as they are until the next refresh
+        if result is None:
+            progress.skipped()
+            continue
+
+        if not result['exists']:
+            # removes the tracks that were on the source from the playlist
+            sync.remove_source(source)
+
+            if source.service == 'spotify':
+                # if the user is not following the playlist
+                playlist.remove_source(source)
+            else:
+                # TODO delete playlist_source assciation rows
+                d = delete(Source).where(Source.id == source.id)
+                db.session.execute(d)
+            continue
+
+        # updates playlist art and title, only writing them if they changed
+        if result['title'] is not None and (source.title, source.art) != (result['title'], result['art']):
+            source.title = result['title']
+            source.art = result['art']
+
+        # diffs the remote tracklist against the musiversal playlist
+        if result['tracks'] is not None:
+            sync.sync_source(source, result['tracks'])
+        else:
+            progress.skipped()
+
+        # only writes the source's state if it changed
+        state = states[source.id]
+        if any(state[k] != v for k, v in result['state'].items()):
+            playlist.set_source_state(source, **result['state'])
+
+    # writes all new tracks, links and removals in bulk
+    progress.ingested(sync.flush())
+
+    db.session.commit()
@@ -1,13 +1,21 @@
-from flask import render_template, flash, redirect, url_for, request, session, jsonify
+from flask import render_template, flash, redirect, url_for, request, session, jsonify, \
+    current_app, stream_with_context, abort
 from flask_login import current_user, login_required
 from flask_assets import Bundle, Environment
-from sqlalchemy import func, delete, update, text
+from sqlalchemy import func, delete, update, text, select
 from app import db
 from app.playlists import bp
-from app.auth_external.services import Spotify, Youtube
+from app.auth_external.services import clients
 from app.playlists.forms import CreatePlaylistForm, EditPlaylistForm
+from app.playlists.jobs import runner
+from app.playlists import export, search
+from app.playlists.export import EXPORT_FORMATS
 from app.models import *
 from urllib.parse import urlparse
+import json
+from cachetools import LRUCache
+from config import Config
+import threading
 
 @bp.route('/super_secret/<playlist_id>')
 @login_required
@@ -39,12 +47,11 @@ def create_playlist():
 
         # creates the playlist on spotify
         if form.sp_create.data:
-            sp = Spotify()
-            sp.create_api()
+            sp = clients.get('spotify')
 
             # creates the new playlist on spotify
             sp_playlist_info = sp.api.user_playlist_create(
-                sp.api.current_user()['display_name'],
+                sp.user_id,
                 form.title.data,
                 public=form.sp_public.data,
                 description=form.description.data)
@@ -68,11 +75,14 @@ def create_playlist():
 
             db.session.add(source)
             playlist.add_source(source)
+            db.session.flush()
+
+            # the playlist's tracklist is pushed to the spotify playlist it created
+            playlist.set_source_state(source, push=True)
 
         # creates the playlist on youtube
         if form.yt_create.data:
-            yt = Youtube()
-            yt.create_api()
+            yt = clients.get('youtube')
 
             # creates the new playlist on youtube
             yt_playlist_info = yt.create_playlist(
@@ -87,6 +97,10 @@ def create_playlist():
                 service='youtube')
             db.session.add(source)
             playlist.add_source(source)
+            db.session.flush()
+
+            # the playlist's tracklist is pushed to the youtube playlist it created
+            playlist.set_source_state(source, push=True)
 
         db.session.commit()
         flash('Playlist Created!')
@@ -97,12 +111,6 @@ def create_playlist():
 @bp.route('/view_playlist/<playlist_id>', methods=['GET', 'POST'])
 @login_required
 def view_playlist(playlist_id):
-    sp = Spotify()
-    sp.create_api()
-
-    yt = Youtube()
-    yt.create_api()
-
     form = EditPlaylistForm()
 
     # retrieves the playlist from the database
@@ -132,6 +140,8 @@ def view_playlist(playlist_id):
         if sources:
             for source in sources:
                 if 'spotify' in source or len(source) == 22:
+                    sp = clients.get('spotify')
+
                     # verifies the source and returns the service id
                     service_id = sp.get_service_id(source)
                     if not service_id:
@@ -162,6 +172,8 @@ def view_playlist(playlist_id):
                         Source.query.filter_by(
                             service_id=service_id).first())
                 elif 'youtube' in source or len(source) == 34:
+                    yt = clients.get('youtube')
+
                     # verifies the source
                     service_id = yt.get_service_id(source)
                     if not service_id:
@@ -200,54 +212,152 @@ def view_playlist(playlist_id):
 
         return redirect(url_for('playlists.refresh_playlist', playlist_id=playlist_id))
 
-    # retrieves the playlist's tracks from the db
-    # tracks = playlist.tracks.all()
+    # only the length and the first page of tracks are sent with the page,
+    # the rest of the list is loaded by playlists.js as it is scrolled to
     playlist_length = playlist.tracks.count()
+    first_page = track_page(playlist.id, amount=Config.TRACK_PAGE_SIZE)
+
+    # a pending refresh is polled by the page until it finishes
+    refresh_job = runner.active_job(playlist)
 
     return render_template('playlists/view_playlist.html',
-        form=form, playlist=playlist, playlist_length=playlist_length, sources=sources, str=str)
+        form=form, playlist=playlist, playlist_length=playlist_length, sources=sources,
+        first_page=first_page, page_size=Config.TRACK_PAGE_SIZE, refresh_job=refresh_job, str=str)
+
+# server-side cache of serialized track pages
+# pages are keyed by the playlist's version, so pages of an outdated tracklist
+# are never served and simply fall out of the cache
+page_cache = LRUCache(maxsize=Config.TRACK_PAGE_CACHE_SIZE)
+page_cache_lock = threading.Lock()
+
+# fields sent for each track, album and artist, as declared by their schemas
+# pages are built from plain rows with these lists instead of dumping every object
+TRACK_FIELDS = tuple(TrackSchema().fields)
+ALBUM_FIELDS = tuple(AlbumSchema().fields)
+ARTIST_FIELDS = tuple(ArtistSchema().fields)
+
+# encodes a page of tracks as compact json
+def dump_page(data):
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+
+# queries for the artists of every given track at once and attaches them
+def attach_artists(data):
+    artists = {}
+    if data:
+        artist_columns = [Artist.__table__.c[f] for f in ARTIST_FIELDS]
+        track_artists = db.session.execute(
+            select(track_artist.c.track_id, *artist_columns).join(
+                Artist, track_artist.c.artist_id == Artist.id).where(
+                    track_artist.c.track_id.in_([d['id'] for d in data])))
+
+        for row in track_artists:
+            artists.setdefault(row[0], []).append(dict(zip(ARTIST_FIELDS, row[1:])))
+
+    for d in data:
+        d['artists'] = artists.get(d['id'], [])
+
+# returns a page of tracks from a playlist, ordered by their track positions
+# pages are requested after the track_pos of the last track already loaded
+# (?after=<track_pos>), or at an offset when jumping ahead (?offset=<n>)
+# the page takes a constant number of queries, however large it is
+def track_page(playlist_id, after=None, offset=0, amount=15):
+    track_columns = [Track.__table__.c[f] for f in TRACK_FIELDS]
+    album_columns = [Album.__table__.c[f] for f in ALBUM_FIELDS]
+
+    # queries for the page's tracks along with their positions and albums
+    query = select(*track_columns, playlist_track.c.track_pos, *album_columns).select_from(
+        Track.__table__).join(
+            playlist_track, playlist_track.c.track_id == Track.id).join(
+                Playlist, Playlist.id == playlist_track.c.playlist_id).outerjoin(
+                    Album, Album.id == Track.album_id).where(
+                        Playlist.id == playlist_id,
+                        Playlist.user_id == current_user.id).order_by(
+                            playlist_track.c.track_pos)
+
+    if after is not None:
+        query = query.where(playlist_track.c.track_pos > after)
+    else:
+        query = query.offset(offset)
 
-# returns a group of tracks from a certain section of a playlist
-@bp.route('/get_tracks/<playlist_id>/<offset>/<amount>', methods=['POST'])
-@login_required
-def get_tracks(playlist_id, offset, amount):
-    track_schema = TrackSchema()
-    artist_schema = ArtistSchema()
-    album_schema = AlbumSchema()
+    rows = db.session.execute(query.limit(amount)).all()
 
-    # Queries for 15 tracks from the playlist, ordered by their track positions
-    tracks = Track.query.join(playlist_track).filter(
-        playlist_track.c.playlist_id == playlist_id).order_by(
-            playlist_track.c.track_pos).limit(amount).offset(offset).all()
+    # splits each row into the track, its position and its album
+    pos = len(TRACK_FIELDS)
 
-    # retrieves the playlist from the database
+    # attaches relevant album and track_pos data to each track
+    data = []
+    for row in rows:
+        d = dict(zip(TRACK_FIELDS, row[:pos]))
+        album = row[pos + 1:]
+        d['album'] = dict(zip(ALBUM_FIELDS, album)) if album[ALBUM_FIELDS.index('id')] is not None else {}
+        d['track_pos'] = row[pos]
+        data.append(d)
+
+    attach_artists(data)
+
+    return data
+
+# returns the number of tracks a request asks for, at most TRACK_PAGE_MAX
+# so that a page can never turn into a dump of the whole playlist
+# answers with a 400 if it is not a positive number
+def page_amount(amount):
+    if amount < 1:
+        abort(400)
+
+    return min(amount, current_app.config['TRACK_PAGE_MAX'])
+
+# the page can also be given in the url, as get_tracks/<playlist_id>/<offset>/<amount>,
+# which older pages of the site still request
+@bp.route('/get_tracks/<playlist_id>', methods=['POST'])
+@bp.route('/get_tracks/<playlist_id>/<int:offset>/<int:amount>', methods=['POST'])
+@login_required
+def get_tracks(playlist_id, offset=None, amount=None):
+    page = track_page(
+        playlist_id,
+        after=request.args.get('after', type=int),
+        offset=request.args.get('offset', 0, type=int) if offset is None else offset,
+        amount=page_amount(request.args.get('amount', 15, type=int) if amount is None else amount))
+
+    return current_app.response_class(dump_page(page), mimetype='application/json')
+
+# cacheable variant of get_tracks
+# pages are tagged with the playlist's version, so the browser revalidates them
+# with If-None-Match and gets an empty 304 back while the tracklist is unchanged.
+# pages that did change are served from page_cache when possible
+@bp.route('/tracks/<playlist_id>')
+@login_required
+def tracks(playlist_id):
     playlist = Playlist.query.filter_by(
         id=playlist_id,
-        user_id=current_user.id).first()
+        user_id=current_user.id).first_or_404()
 
-    # retrieves each track's corresponding artists and albums and serializes them
-    artists = [[artist_schema.dump(a) for a in t.artists.all()] for t in tracks]
-    albums = [album_schema.dump(Album.query.filter_by(id=t.album_id).first()) for t in tracks]
+    after = request.args.get('after', type=int)
+    offset = request.args.get('offset', 0, type=int)
+    amount = page_amount(request.args.get('amount', 15, type=int))
 
-    # gets corresponding track positions
-    track_positions = []
-    for t in tracks:
-        track_positions.append(db.session.execute(
-            f"""SELECT track_pos
-                FROM playlist_track
-                WHERE playlist_id={playlist.id}
-                AND track_id={t.id};""").first()[0])
+    response = current_app.response_class(mimetype='application/json')
+    response.set_etag(f'{playlist.id}-{playlist.version}')
+    if playlist.updated is not None:
+        response.last_modified = playlist.updated
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
 
-    # converts tracks to serializable objects
-    data = [track_schema.dump(t) for t in tracks]
+    # answers with a 304 if the browser's copy of the page is still current
+    response.make_conditional(request)
+    if response.status_code == 304:
+        return response
 
-    # attaches relevant artist, album, and track_pos data to each track
-    for i in range(len(data)):
-        data[i].update({'artists': artists[i]})
-        data[i].update({'album': albums[i]})
-        data[i].update({'track_pos': track_positions[i]})
+    key = (playlist.id, playlist.version, after, offset, amount)
+    with page_cache_lock:
+        page = page_cache.get(key)
 
-    return jsonify(data)
+    if page is None:
+        page = dump_page(track_page(playlist.id, after, offset, amount))
+        with page_cache_lock:
+            page_cache[key] = page
+
+    response.set_data(page)
+    return response
 
 # TODOTODOTODOTODOTODOTODOTODOTODOTODOTODOTODO
 @bp.route('/update_playlist/<playlist_id>', methods=['POST'])
@@ -324,6 +434,84 @@ def update_playlist(playlist_id):
 
     return redirect(url_for('playlists.refresh_playlist', playlist_id=playlist_id))
 
+# downloads the whole playlist as ndjson, csv or m3u
+# the file is streamed as it is read from the database, so it starts right away
+@bp.route('/export_playlist/<playlist_id>/<format>')
+@login_required
+def export_playlist(playlist_id, format):
+    playlist = Playlist.query.filter_by(
+        id=playlist_id,
+        user_id=current_user.id).first_or_404()
+
+    if format not in EXPORT_FORMATS:
+        abort(404)
+
+    mimetype, _ = EXPORT_FORMATS[format]
+    response = current_app.response_class(
+        stream_with_context(export.export_playlist(playlist.id, format)),
+        mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="playlist-{playlist.id}.{format}"'
+
+    return response
+
+# searches the tracks on the user's playlists by title, artists and album
+# e.g. /search_tracks?q=daft punk&page=2, best matches first
+@bp.route('/search_tracks')
+@login_required
+def search_tracks():
+    q = request.args.get('q', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', Config.SEARCH_PAGE_SIZE, type=int), 1), 100)
+
+    # one extra hit tells whether there is a next page
+    hits = search.search_tracks(current_user.id, q, page, per_page + 1)
+    has_more = len(hits) > per_page
+    hits = hits[:per_page]
+
+    track_ids = [hit.track_id for hit in hits]
+    tracks = {}
+    playlists = {}
+    if track_ids:
+        track_columns = [Track.__table__.c[f] for f in TRACK_FIELDS]
+        album_columns = [Album.__table__.c[f] for f in ALBUM_FIELDS]
+        pos = len(TRACK_FIELDS)
+
+        rows = db.session.execute(
+            select(*track_columns, *album_columns).outerjoin(
+                Album, Album.id == Track.album_id).where(Track.id.in_(track_ids)))
+
+        for row in rows:
+            d = dict(zip(TRACK_FIELDS, row[:pos]))
+            album = row[pos:]
+            d['album'] = dict(zip(ALBUM_FIELDS, album)) if album[ALBUM_FIELDS.index('id')] is not None else {}
+            tracks[d['id']] = d
+
+        # the user's playlists each hit is on
+        rows = db.session.execute(
+            select(playlist_track.c.track_id, Playlist.id, Playlist.title).join(
+                Playlist, Playlist.id == playlist_track.c.playlist_id).where(
+                    Playlist.user_id == current_user.id,
+                    playlist_track.c.track_id.in_(track_ids)).order_by(Playlist.id))
+
+        for track_id, playlist_id, title in rows:
+            playlists.setdefault(track_id, []).append({'id': playlist_id, 'title': title})
+
+    data = []
+    for hit in hits:
+        d = tracks[hit.track_id]
+        d['rank'] = hit.rank
+        d['playlists'] = playlists.get(hit.track_id, [])
+        data.append(d)
+
+    attach_artists(data)
+
+    return current_app.response_class(dump_page({
+        'query': q,
+        'page': page,
+        'per_page': per_page,
+        'has_more': has_more,
+        'hits': data}), mimetype='application/json')
+
 @bp.route('/view_blacklist/<playlist_id>')
 @login_required
 def view_blacklist(playlist_id):
@@ -332,150 +520,49 @@ def view_blacklist(playlist_id):
 
     return render_template('playlists/view_blacklist.html', playlist=playlist, blacklist=blacklist, len=len)
 
+# queues a refresh of the playlist on the background workers
+# POST requests (from playlists.js) get the job's status back to poll /refresh_status with
 @bp.route('/refresh_playlist/<playlist_id>', methods=['GET', 'POST'])
 @login_required
 def refresh_playlist(playlist_id):
     # retrieves the playlist from the database
     playlist = Playlist.query.filter_by(
         id=playlist_id,
-        user_id=current_user.id).first()
+        user_id=current_user.id).first_or_404()
 
-    sp = Spotify()
-    sp.create_api()
-
-    yt = Youtube()
-    yt.create_api()
-
-    # loops through the db's list of sources and keeps it up-to-date
-    # tries to retrieve the playlist from a service, if it doesn't exist remove it from db
-    for source in playlist.sources.all():
-        if source.service == 'spotify':
-            # returns whether the user is following the given playlist
-            response = sp.api.playlist_is_following(
-                playlist_id=source.service_id,
-                user_ids=[sp.api.current_user()['display_name']])
-
-            # checks if the source still exists
-            if response[0] == False:
-                # removes the tracks that were on the source from the db
-                playlist_tracks = playlist.tracks.all()
-                source_tracks = source.tracks.all()
-                to_delete_tracks = set(playlist_tracks) & set(source_tracks)
-
-                for track in to_delete_tracks:
-                    playlist.remove_track(track)
-
-                # if the user is not following the playlist
-                playlist.remove_source(source)
-            else:
-                # updates playlist art and title
-                source.art = sp.api.playlist_cover_image(playlist_id=source.service_id)[0]['url']
-                source.title = sp.api.playlist(playlist_id=source.service_id)['name']
-
-                # if the service id is no longer valid, remove the source and it's associated tracks
-                if not sp.verify_service_id(source.service_id):
-                    # queries for tracks attached to the source to be removed
-                    # and removes the tracks
-                    source_tracks = source.tracks.all()
-                    for track in source_tracks:
-                        playlist.remove_track(track)
-
-                    # removes the source from the playlist
-                    playlist.remove_source(source)
-
-                # if the user is following the playlist, retrieve tracklist
-                sp_tracks = sp.get_tracks(source.service_id)
-
-                # retrieves the trackslist associated with the source and playlist from db
-                source_tracks = source.tracks.all()
-                playlist_tracks = playlist.tracks.filter_by(
-                    service='spotify').all()
-                db_tracks = set(playlist_tracks) & set(source_tracks)
-
-                # parses the tracklists for just the titles
-                sp_tracks_ids = [track['track']['id'] for track in sp_tracks]
-                db_tracks_ids = [track.service_id for track in db_tracks]
-
-                """
-                loops through tracklist of the spotify playlist and
-                checks if each track is in the database or not. It adds a track
-                to the database if it does not yet exist
-                """
-                for track in sp_tracks:
-                    if not track['track']['id'] in db_tracks_ids:
-                        # if the track is not in the list of local playlist tracks
-                        sp.add_track_to_playlist(playlist, source, track)
-
-                """
-                loops through tracklist of the musiversal playlist and
-                checks if each track is in the list of spotify tracks.
-                It removes a track from the musiversal playlist if it
-                does not exist in the spotify tracklist.
-                """
-                for track in db_tracks:
-                    if not track.service_id in sp_tracks_ids:
-                        # if the track is not in the spotify tracklist
-                        playlist.remove_track(track)
-
-
-        elif source.service == 'youtube':
-            # tries to retrieve the playlist from youtube
-            request = yt.api.playlists().list(
-                part='id',
-                id=source.service_id)
-            response = request.execute()
-
-            # if the source doesn't exist, delete the source from db
-            if response['pageInfo']['totalResults'] == 0:
-                # TODO delete playlist_source assciation rows
-                d = delete(Source).where(Source.id == source.id)
-                db.session.execute(d)
-            else:
-                # updates playlist art and title
-                yt_playlist = yt.get_playlist(source.service_id)
-                title = yt_playlist['items'][0]['snippet']['title']
-                art = yt_playlist['items'][0]['snippet']['thumbnails']['default']['url']
-
-                # if the playlist still exists, retrieve tracklist
-                yt_tracks = yt.get_tracks(source.service_id)
-
-                # retrieves the trackslist associated with the source and playlist from db
-                source_tracks = source.tracks.all()
-                playlist_tracks = playlist.tracks.filter_by(
-                    service='youtube').all()
-                db_tracks = set(playlist_tracks) & set(source_tracks)
-
-                # parses the tracklists for just the names
-                yt_tracks_ids = [track['snippet']['resourceId']['videoId'] for track in yt_tracks]
-                db_tracks_ids = [track.service_id for track in db_tracks]
-
-                """
-                loops through tracklist of the youtube playlist and
-                checks if each track is in the database or not. It adds a track
-                to the database if it does not yet exist
-                """
-                for track in yt_tracks:
-                    if not track['snippet']['resourceId']['videoId'] in db_tracks_ids:
-                        # if the track is not in the list of local playlist tracks
-                        yt.add_track_to_playlist(playlist, source, track)
-
-                """
-                loops through tracklist of the musiversal playlist and
-                checks if each track is in the list of youtube tracks.
-                It removes a track from the musiversal playlist if it
-                does not exist in the youtube tracklist.
-                """
-                for track in db_tracks:
-                    if not track.service_id in yt_tracks_ids:
-                        # if the track is not in the spotify tracklist
-                        playlist.remove_track(track)
-
-    playlist.refresh_track_positions()
+    job = runner.enqueue(playlist, lane='user')
 
-    db.session.commit()
+    if request.method == 'POST':
+        return jsonify(runner.status(job)), 202
+
+    return redirect(url_for('playlists.view_playlist', playlist_id=playlist_id))
+
+# queues a push of the playlist's tracklist to the spotify and youtube playlists it created
+@bp.route('/push_playlist/<playlist_id>')
+@login_required
+def push_playlist(playlist_id):
+    playlist = Playlist.query.filter_by(
+        id=playlist_id,
+        user_id=current_user.id).first_or_404()
+
+    if not playlist.push_targets():
+        flash('This playlist has no Spotify or YouTube playlist to push to')
+    else:
+        runner.enqueue(playlist, lane='user', kind='push')
+        flash('Pushing the playlist')
 
     return redirect(url_for('playlists.view_playlist', playlist_id=playlist_id))
 
+# reports the status and progress of a background job
+@bp.route('/refresh_status/<job_id>')
+@login_required
+def refresh_status(job_id):
+    job = Job.query.filter_by(
+        id=job_id,
+        user_id=current_user.id).first_or_404()
+
+    return jsonify(runner.status(job))
+
 @bp.route('/delete_playlist/<playlist_id>')
 @login_required
 def delete_playlist(playlist_id):
@@ -521,7 +608,7 @@ def delete_source(playlist_id, source_id):
         playlist.remove_track(track)
 
     playlist.sources.remove(source)
-    playlist.refresh_track_positions()
+    playlist.bump_version()
 
     db.session.commit()
 
@@ -540,14 +627,41 @@ def blacklist_track(playlist_id, track_id):
     if playlist and not track in playlist.blacklist:
         playlist.remove_track(track)
         playlist.blacklist.append(track)
+        playlist.bump_version()
         # db.session.execute(f"UPDATE blacklist SET reason = {"User removed"} WHERE track_id = {track.id}")
-        playlist.refresh_track_positions()
         db.session.commit()
     else:
         flash('This playlist does not exist or the track is already blacklisted')
 
     return redirect(url_for('playlists.view_playlist', playlist_id=playlist_id))
 
+# moves a track on the playlist to just after the track given in the 'after' field
+# the track is moved to the top of the playlist if no track is given
+@bp.route('/move_track/<playlist_id>/<track_id>', methods=['POST'])
+@login_required
+def move_track(playlist_id, track_id):
+    playlist = Playlist.query.filter_by(
+        id=playlist_id,
+        user_id=current_user.id).first_or_404()
+
+    track = playlist.tracks.filter_by(
+        id=track_id).first_or_404()
+
+    after = None
+    if request.form.get('after'):
+        after = playlist.tracks.filter_by(
+            id=request.form['after']).first_or_404()
+
+    track_pos, gap = playlist.move_track(track, after)
+    playlist.bump_version()
+    db.session.commit()
+
+    # spreads the positions out again before the gaps run out
+    if gap is not None and gap < TRACK_POS_MIN_GAP:
+        runner.enqueue(playlist, lane='scheduled', kind='renumber')
+
+    return jsonify({'track_id': track.id, 'track_pos': track_pos})
+
 @bp.route('/whitelist_track/<playlist_id>/<track_id>')
 @login_required
 def whitelist_track(playlist_id, track_id):
@@ -560,6 +674,10 @@ def whitelist_track(playlist_id, track_id):
     # removes the track if the playlist exists
     if playlist:
         playlist.blacklist.remove(track)
+
+        # the track is only re-added if the next refresh downloads every source in full
+        playlist.reset_source_states()
+        playlist.bump_version()
         db.session.commit()
     else:
         flash('This playlist does not exist')
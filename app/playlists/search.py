@@ -0,0 +1,118 @@
+import re
+from sqlalchemy import text, bindparam
+from app import db
+from app.playlists import bp
+from app.playlists import sync
+
+# full-text search over the tracks in the catalog
+# sqlite keeps the index in an fts5 table (track_search) whose rowids are track
+# ids, postgres in a track_search table of weighted tsvectors. both are filled
+# by PlaylistSync.flush as tracks are created, see the migration that added them
+
+# the document of each track: its title, the names of its artists and its album's title
+DOCUMENTS = {
+    'sqlite': """
+        INSERT INTO track_search (rowid, title, artists, album)
+        SELECT track.id, track.title,
+            (SELECT group_concat(artist.name, ' ') FROM track_artist
+                JOIN artist ON artist.id = track_artist.artist_id
+                WHERE track_artist.track_id = track.id),
+            album.title
+        FROM track LEFT JOIN album ON album.id = track.album_id
+        WHERE track.id IN :track_ids""",
+    'postgresql': """
+        INSERT INTO track_search (track_id, document)
+        SELECT track.id,
+            setweight(to_tsvector('simple', coalesce(track.title, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce((SELECT string_agg(artist.name, ' ') FROM track_artist
+                JOIN artist ON artist.id = track_artist.artist_id
+                WHERE track_artist.track_id = track.id), '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce(album.title, '')), 'C')
+        FROM track LEFT JOIN album ON album.id = track.album_id
+        WHERE track.id IN :track_ids
+        ON CONFLICT (track_id) DO UPDATE SET document = excluded.document""",
+}
+
+# ranked ids of the tracks on a user's playlists that match a query
+# a match in the title counts twice as much as one in the artists, and ten
+# times as much as one in the album
+SEARCHES = {
+    # bm25 takes the weights of the title, artists and album columns
+    # the + keeps sqlite from handing the IN list to fts5, which would run the
+    # match once per track on the user's playlists instead of once
+    'sqlite': """
+        SELECT rowid AS track_id, bm25(track_search, 10.0, 5.0, 1.0) AS rank
+        FROM track_search
+        WHERE track_search MATCH :query AND +rowid IN (
+            SELECT playlist_track.track_id FROM playlist_track
+            JOIN playlist ON playlist.id = playlist_track.playlist_id
+            WHERE playlist.user_id = :user_id)
+        ORDER BY rank, rowid
+        LIMIT :limit OFFSET :offset""",
+    # ts_rank takes the weights of the D, C, B and A labels, in that order
+    'postgresql': """
+        SELECT track_id, ts_rank('{0, 0.1, 0.5, 1}', document, query) AS rank
+        FROM track_search, to_tsquery('simple', :query) query
+        WHERE document @@ query AND track_id IN (
+            SELECT playlist_track.track_id FROM playlist_track
+            JOIN playlist ON playlist.id = playlist_track.playlist_id
+            WHERE playlist.user_id = :user_id)
+        ORDER BY rank DESC, track_id
+        LIMIT :limit OFFSET :offset""",
+}
+
+WORDS = re.compile(r'\w+')
+
+def dialect():
+    return db.engine.dialect.name
+
+# turns what the user typed into a query of the backend's syntax
+# every word has to match, and the last one may be a prefix of a word since
+# the user may still be typing it. returns none if there is nothing to search for
+def parse_query(q):
+    words = WORDS.findall(q or '')
+    if not words:
+        return None
+
+    if dialect() == 'postgresql':
+        return ' & '.join(words) + ':*'
+
+    # quoting each word keeps fts5 from reading them as operators (AND, NEAR, ...)
+    return ' '.join(f'"{w}"' for w in words) + '*'
+
+# adds tracks to the search index, or updates them if they are already in it
+def index_tracks(track_ids):
+    sql = text(DOCUMENTS[dialect()]).bindparams(bindparam('track_ids', expanding=True))
+
+    for chunk in sync.chunks(track_ids):
+        if dialect() == 'sqlite':
+            # fts5 tables have no upsert, existing documents are replaced instead
+            db.session.execute(
+                text('DELETE FROM track_search WHERE rowid IN :track_ids').bindparams(
+                    bindparam('track_ids', expanding=True)),
+                {'track_ids': chunk})
+        db.session.execute(sql, {'track_ids': chunk})
+
+# returns (track id, rank) of a page of the tracks on a user's playlists
+# matching a query, best match first
+def search_tracks(user_id, q, page=1, per_page=20):
+    query = parse_query(q)
+    if query is None:
+        return []
+
+    return db.session.execute(text(SEARCHES[dialect()]), {
+        'query': query,
+        'user_id': user_id,
+        'limit': per_page,
+        'offset': (page - 1) * per_page}).all()
+
+# rebuilds the search index from the catalog
+# e.g. after restoring a database without it: flask playlists reindex
+@bp.cli.command('reindex')
+def reindex_command():
+    db.session.execute(text('DELETE FROM track_search'))
+    track_ids = db.session.execute(text('SELECT id FROM track')).scalars().all()
+    index_tracks(track_ids)
+    db.session.commit()
+
+    print(f'Indexed {len(track_ids)} tracks')
@@ -0,0 +1,241 @@
+from sqlalchemy import select, insert, delete
+from sqlalchemy.dialects import sqlite, postgresql
+from app import db
+from app.playlists import search
+from app.models import Track, Artist, Album, playlist_track, track_source, \
+    track_artist, blacklist, TRACK_POS_GAP
+
+# sqlite limits the number of bound parameters per statement,
+# so large IN clauses and inserts are split into chunks of this size
+CHUNK_SIZE = 500
+
+# returns an INSERT into a table that skips the rows clashing with one of its
+# unique constraints, e.g. a track another refresh created since it was looked up
+def insert_new(table):
+    dialects = {'sqlite': sqlite, 'postgresql': postgresql}
+    return dialects[db.engine.dialect.name].insert(table).on_conflict_do_nothing()
+
+# splits a list into chunks small enough for a single statement
+def chunks(l, size=CHUNK_SIZE):
+    l = list(l)
+    for i in range(0, len(l), size):
+        yield l[i:i + size]
+
+# keeps a musiversal playlist in sync with the tracklists of its sources
+# the playlist's membership, blacklist and source links are loaded once, the
+# add/remove diff of every source is computed with set operations and all
+# resulting rows are written in bulk by flush() without committing, so that
+# the caller can commit the whole refresh as one transaction. the playlist's
+# version is only bumped if its tracklist actually changed
+class PlaylistSync():
+
+    def __init__(self, playlist):
+        self.playlist = playlist
+
+        # service id -> track id of every track currently on the playlist
+        # a track id of None marks a track that will be added on flush
+        self.members = dict(db.session.execute(
+            select(Track.service_id, Track.id).join(
+                playlist_track, playlist_track.c.track_id == Track.id).where(
+                    playlist_track.c.playlist_id == playlist.id)).all())
+
+        # service ids of the tracks the user blacklisted on this playlist
+        self.blacklist = set(db.session.execute(
+            select(Track.service_id).join(
+                blacklist, blacklist.c.track_id == Track.id).where(
+                    blacklist.c.playlist_id == playlist.id)).scalars())
+
+        self.new_tracks = {} # service id -> parsed track, in playlist order
+        self.removed = {} # service id -> track id of tracks to remove from the playlist
+        self.links = {} # source id -> service ids linked to the source
+        self.new_links = set() # (service id, source id) pairs to link
+        self.kept = set() # service ids on the remote tracklist of a source synced so far
+
+    # loads the service ids of the tracks linked to a source
+    def source_links(self, source):
+        if source.id not in self.links:
+            self.links[source.id] = set(db.session.execute(
+                select(Track.service_id).join(
+                    track_source, track_source.c.track_id == Track.id).where(
+                        track_source.c.source_id == source.id)).scalars())
+
+        return self.links[source.id]
+
+    # diffs a source's remote tracklist against the playlist
+    # tracks is a list of parsed tracks (see Spotify.parse_track)
+    def sync_source(self, source, tracks):
+        linked = self.source_links(source)
+        remote = {t['service_id']: t for t in tracks}
+
+        # tracks that were on the playlist before this sync and were added from this source
+        # tracks queued by another source are not, even if this source once had them
+        db_tracks = {s for s in linked if self.members.get(s) is not None}
+
+        # queues tracks that are not on the playlist yet, keeping their remote order
+        for service_id, track in remote.items():
+            if service_id in self.blacklist:
+                continue
+
+            self.kept.add(service_id)
+            if service_id in db_tracks:
+                continue
+
+            if service_id in self.removed:
+                # another source removed the track during this sync, so it is kept
+                self.members[service_id] = self.removed.pop(service_id)
+            elif service_id not in self.members:
+                self.members[service_id] = None
+                self.new_tracks[service_id] = track
+
+            if service_id not in linked:
+                linked.add(service_id)
+                self.new_links.add((service_id, source.id))
+
+        # removes tracks that are no longer on the remote playlist, unless
+        # another source synced before this one still has them
+        for service_id in db_tracks - remote.keys() - self.kept:
+            self.remove(service_id)
+
+    # removes every track that was added from a source from the playlist
+    # tracks that other sources synced so far still have are kept
+    def remove_source(self, source):
+        for service_id in (self.source_links(source) & self.members.keys()) - self.kept:
+            self.remove(service_id)
+
+    # removes a track from the playlist by its service id
+    def remove(self, service_id):
+        track_id = self.members.pop(service_id)
+
+        if track_id is None:
+            # the track was queued during this sync, so it is simply dropped
+            del self.new_tracks[service_id]
+        else:
+            self.removed[service_id] = track_id
+
+        # the track is no longer linked to the sources that queued it
+        self.new_links = {link for link in self.new_links if link[0] != service_id}
+
+    # returns service id -> id for the given keys of a catalog table
+    def lookup(self, model, key, service_ids):
+        ids = {}
+        for chunk in chunks(set(service_ids)):
+            rows = db.session.execute(
+                select(getattr(model, key), model.service_id, model.id).where(
+                    model.service_id.in_(chunk))).all()
+            ids.update({(row[0], row[1]): row[2] for row in rows})
+
+        return ids
+
+    # bulk inserts the catalog rows that do not exist yet and returns all of their ids
+    def insert_missing(self, model, key, rows):
+        ids = self.lookup(model, key, [r['service_id'] for r in rows.values()])
+        missing = [r for k, r in rows.items() if k not in ids]
+
+        if missing:
+            for chunk in chunks(missing):
+                db.session.execute(insert(model.__table__), chunk)
+            ids = self.lookup(model, key, [r['service_id'] for r in rows.values()])
+
+        return ids
+
+    # writes the computed diff to the database in bulk
+    # returns the number of tracks that were added to the playlist
+    def flush(self):
+        # tracks that already exist in the catalog are only linked, not created
+        catalog = {
+            service_id: track_id for (_, service_id), track_id in self.lookup(
+                Track, 'service', self.new_tracks.keys()).items()}
+        created = [t for s, t in self.new_tracks.items() if s not in catalog]
+
+        if created:
+            # creates the artists and albums of the new tracks
+            artists = {}
+            albums = {}
+            for t in created:
+                for a in t['artists']:
+                    artists[(a['name'], a['service_id'])] = dict(a, service=t['service'])
+                if t['album']:
+                    a = t['album']
+                    albums[(a['title'], a['service_id'])] = dict(a, service=t['service'])
+
+            artist_ids = self.insert_missing(Artist, 'name', artists)
+            album_ids = self.insert_missing(Album, 'title', albums)
+
+            # creates the new tracks
+            rows = [{
+                'service': t['service'],
+                'service_id': t['service_id'],
+                'title': t['title'],
+                'art': t['art'],
+                'href': t['href'],
+                'album_id': album_ids.get(
+                    (t['album']['title'], t['album']['service_id'])) if t['album'] else None,
+                } for t in created]
+            for chunk in chunks(rows):
+                db.session.execute(insert_new(Track.__table__), chunk)
+
+            catalog.update({
+                service_id: track_id for (_, service_id), track_id in self.lookup(
+                    Track, 'service', [t['service_id'] for t in created]).items()})
+
+            # tracks that another refresh created in the meantime already have their artists
+            credited = set()
+            for chunk in chunks(catalog[t['service_id']] for t in created):
+                credited.update(db.session.execute(
+                    select(track_artist.c.track_id).where(
+                        track_artist.c.track_id.in_(chunk))).scalars())
+            created = [t for t in created if catalog[t['service_id']] not in credited]
+
+            # links the new tracks to their artists
+            rows = []
+            for t in created:
+                track_id = catalog[t['service_id']]
+                # keeps the artists in the order the service credits them
+                artist_ids_of_track = dict.fromkeys(
+                    artist_ids[(a['name'], a['service_id'])] for a in t['artists'])
+                rows.extend(
+                    {'track_id': track_id, 'artist_id': a} for a in artist_ids_of_track)
+            for chunk in chunks(rows):
+                db.session.execute(insert(track_artist), chunk)
+
+            # makes the new tracks searchable
+            search.index_tracks([catalog[t['service_id']] for t in created])
+
+        # appends the new tracks to the end of the playlist
+        next_pos = self.playlist.next_track_pos()
+
+        rows = [{
+            'playlist_id': self.playlist.id,
+            'track_id': catalog[service_id],
+            'track_pos': next_pos + i * TRACK_POS_GAP,
+            } for i, service_id in enumerate(self.new_tracks)]
+        for chunk in chunks(rows):
+            db.session.execute(insert(playlist_track), chunk)
+
+        for service_id in self.new_tracks:
+            self.members[service_id] = catalog[service_id]
+
+        # links tracks to the sources they were added from
+        rows = [{
+            'track_id': self.members[service_id],
+            'source_id': source_id,
+            } for service_id, source_id in self.new_links]
+        for chunk in chunks(rows):
+            db.session.execute(insert(track_source), chunk)
+
+        # removes the tracks that left their sources
+        for chunk in chunks(self.removed.values()):
+            db.session.execute(delete(playlist_track).where(
+                playlist_track.c.playlist_id == self.playlist.id).where(
+                    playlist_track.c.track_id.in_(chunk)))
+
+        added = len(self.new_tracks)
+        if self.new_tracks or self.removed:
+            self.playlist.bump_version()
+
+        self.new_tracks = {}
+        self.removed = {}
+        self.new_links = set()
+        self.kept = set()
+
+        return added
@@ -1,127 +1,202 @@
+// the track list is windowed: only a fixed pool of rows exists in the DOM,
+// which are moved to and filled in with whichever tracks are in view as the user scrolls
+const overscan = 5; // rows kept rendered above and below the viewport
+var pages = {0: firstPage}; // page number -> tracks, loaded pages of the playlist
+var pendingPages = {}; // page numbers currently being requested
+var rowPool = [];
+var rowHeight = 0;
+
+// requests a page of tracks from the server
+// continues after the previous page when it is loaded, otherwise jumps to the page's offset
+function loadPage(page) {
+  if(pages[page] != undefined || pendingPages[page]) {
+    return;
+  };
+  pendingPages[page] = true;
 
+  let previous = pages[page - 1];
+  let query = (previous != undefined && previous.length == pageSize)
+    ? "after=" + previous[previous.length - 1]['track_pos']
+    : "offset=" + page * pageSize;
 
-/*$(document).ready(function loadTracks() {
-
-});*/
-
-// stops the addTracks async function from recalling before tracks are loaded
-var addTracksFlag = false;
-addTracks(0, 15);
-
-// gets a group of tracks from a set position
-async function addTracks(offset, amount) {
   $.ajax({
-    url: "/get_tracks/" + playlistId + "/" + offset + "/" + amount,
-    type: "POST"
+    url: "/tracks/" + playlistId + "?" + query + "&amount=" + pageSize,
+    type: "GET"
   })
   .done(function(tracks) {
-    if(tracks != undefined) {
-      assignTracks(tracks);
-      addTracksFlag = false;
-    };
+    pages[page] = tracks;
+    renderRows();
+  })
+  .always(function() {
+    delete pendingPages[page];
   });
 };
 
-// assigns a list of tracks to their respective track beds
-async function assignTracks(tracks) {
-  for(let i = 0; i < tracks.length; i++) {
-    // queries DOM for track bed
-    trackBed = $('#track' + tracks[i]['track_pos']);
-
-    if(trackBed.attr('class').includes('unloaded')) {
-      // queries DOM for necessary elements
-      trackArt = $(trackBed).find('.track-art')[0];
-      trackInfo = $(trackBed).find('.track-info')[0];
-      albumInfo = $(trackBed).find('.album-info')[0];
-      artistList = $(trackBed).find('.artist-list');
-      service = $(trackBed).find('.track-service');
-
-      // assigns information to track beds
-      trackArt.src = tracks[i]['art'];
-      trackInfo.href = tracks[i]['href'];
-      trackInfo.text = tracks[i]['title'];
-      service.text = tracks[i]['service'];
-
-      // assigns albums to tracks based on service
-      if(tracks[i]['service'] == 'spotify') {
-        albumInfo.href = tracks[i]['album']['href'];
-        albumInfo.text = tracks[i]['album']['title'];
-      } else if(tracks[i]['service'] == 'youtube') {
-        albumInfo.href = '';
-        albumInfo.text = '';
-      };
-
-
-      // assigns track artists, accounting for if there are multiple artists
-      for(let j = 0; j < tracks[i]['artists'].length; j++) {
-        artist = tracks[i]['artists'][j];
-        artistElem = '<a class="artist-info" id="artist' + j + '" href="' + artist['href'] + '">' + artist['name'] + '  </a>';
-        artistList.append(artistElem);
-      };
-
-      // identifies the track bed as loaded once it is finished loading
-      trackBed.removeClass('unloaded');
-      trackBed.addClass('loaded');
+// returns the track at an index of the playlist, or undefined if its page is not loaded yet
+function trackAt(index) {
+  let page = pages[Math.floor(index / pageSize)];
+  return (page != undefined) ? page[index % pageSize] : undefined;
+};
+
+// fills a row with a track's information, or empties it if the track is not loaded yet
+function fillRow(row, track) {
+  let trackArt = row.find('.track-art')[0];
+  let trackInfo = row.find('.track-info')[0];
+  let albumInfo = row.find('.album-info')[0];
+  let artistList = row.find('.artist-list');
+  let service = row.find('.track-service')[0];
+
+  artistList.empty();
+
+  if(track == undefined) {
+    trackArt.removeAttribute('src');
+    trackInfo.removeAttribute('href');
+    trackInfo.text = '';
+    albumInfo.removeAttribute('href');
+    albumInfo.text = '';
+    service.textContent = '';
+    row.removeAttr('data-track-pos');
+    row.removeClass('loaded').addClass('unloaded');
+    return;
+  };
+
+  trackArt.src = track['art'];
+  trackInfo.href = track['href'];
+  trackInfo.text = track['title'];
+  service.textContent = track['service'];
+
+  // assigns albums to tracks based on service
+  if(track['service'] == 'spotify' && track['album']['href'] != undefined) {
+    albumInfo.href = track['album']['href'];
+    albumInfo.text = track['album']['title'];
+  } else {
+    albumInfo.removeAttribute('href');
+    albumInfo.text = '';
+  };
+
+  // assigns track artists, accounting for if there are multiple artists
+  for(let j = 0; j < track['artists'].length; j++) {
+    let artist = track['artists'][j];
+    let artistElem = $('<a class="artist-info"></a>');
+    artistElem.attr('href', artist['href']).text(artist['name'] + '  ');
+    artistList.append(artistElem);
+  };
+
+  row.attr('data-track-pos', track['track_pos']);
+  row.removeClass('unloaded').addClass('loaded');
+};
+
+// grows the pool of rows until it covers the viewport
+function fillPool() {
+  let template = $('#track-template').html();
+  let needed = Math.min(
+    Math.ceil(window.innerHeight / rowHeight) + 2 * overscan,
+    playlistLength);
+
+  while(rowPool.length < needed) {
+    let row = $(template);
+    row.attr('data-index', -1);
+    $('#tracks').append(row);
+    rowPool.push(row);
+  };
+};
+
+// moves the pool of rows to the part of the list in view and fills them in
+function renderRows() {
+  let tracksTop = $('#tracks').offset().top;
+  let scrollpos = $(document).scrollTop();
+  let first = Math.max(Math.floor((scrollpos - tracksTop) / rowHeight) - overscan, 0);
+  first = Math.min(first, Math.max(playlistLength - rowPool.length, 0));
+
+  for(let i = 0; i < rowPool.length; i++) {
+    let index = first + i;
+    let row = rowPool[i];
+    let track = trackAt(index);
+
+    // only rows that moved or whose track just loaded are filled in again
+    if(row.attr('data-index') != index || (track != undefined && row.hasClass('unloaded'))) {
+      row.css('top', index * rowHeight + 'px');
+      row.attr('data-index', index);
+      fillRow(row, track);
+    };
+
+    if(track == undefined) {
+      loadPage(Math.floor(index / pageSize));
     };
   };
+
+  $("#scrollpos").html("" + scrollpos);
+  $("#first").html("" + first);
 };
 
-// returns the first element in the current viewport on scroll
-$(function inViewport() {
-  var table = $("#tracks");
-  var rows = table.children();
-  // var rows = table.children().children();
+// sizes the list for every track of the playlist and renders the first rows
+$(function initTracks() {
+  if(playlistLength == 0) {
+    return;
+  };
 
+  // measures the height of a row once, every row has the same height
+  let probe = $($('#track-template').html());
+  $('#tracks').append(probe);
+  rowHeight = probe.outerHeight(true);
+  probe.remove();
+
+  $('#tracks').css('height', playlistLength * rowHeight + 'px');
+
+  fillPool();
+  renderRows();
+
+  // re-renders at most once per frame while scrolling
+  var scheduled = false;
   $(document).scroll(function() {
-      var scrollpos = $(document).scrollTop();
-      var start = 0;
-      var end = rows.length;
-      var count = 0;
-
-      while(start != end) {
-          count++;
-          var mid = start + Math.floor((end - start) / 2);
-          if($(rows[mid]).offset().top < scrollpos)
-              start = mid + 1;
-          else
-              end = mid;
-      }
-
-      $("#scrollpos").html("" + scrollpos);
-      $("#first").html($($(rows[start]).children()[0]).html());
-      $("#play-track-art").html($($(rows[start]).children()[0]).html());
-      $("#count").html("" + count);
-
-      // adds tracks to the browser as the user scrolls
-      if(!addTracksFlag) {
-        let pos = 0;
-
-        // loops through visible elements and gets the position of the first unloaded element
-        for(let k = 0; k < 15; k++) {
-          let classes = $('#track' + (start + k)).attr('class');
-
-          // having a class including unloaded indicated the first unloaded track
-          if(classes.includes('unloaded')) {
-            pos = start + k;
-
-            addTracks(pos, 15);
-            addTracksFlag = true;
-
-            break;
-          };
-        };
-      };
+    if(!scheduled) {
+      scheduled = true;
+      window.requestAnimationFrame(function() {
+        scheduled = false;
+        renderRows();
+      });
+    };
+  });
+
+  $(window).resize(function() {
+    fillPool();
+    renderRows();
   });
 });
 
-// refreshes the playlist in the background
+// polls a background refresh until it finishes, then reloads the playlist
+function pollRefresh(jobId) {
+  $.ajax({
+    url: "/refresh_status/" + jobId,
+    type: "GET"
+  }).done(function(job) {
+    if(job['status'] == 'done') {
+      location.reload();
+    } else if(job['status'] == 'failed') {
+      $('#refresh-playlist').html("Refresh failed, try again");
+    } else {
+      // shows the refresh's progress on the refresh button
+      $('#refresh-playlist').html(
+        "Refreshing (" + job['phase'] + "): " + job['pages_fetched'] + " pages, " +
+        job['tracks_ingested'] + " new tracks, " + job['sources_skipped'] + " unchanged sources");
+      setTimeout(pollRefresh, 1000, jobId);
+    };
+  });
+};
+
+// resumes polling a refresh that was queued before the page loaded
+if(refreshJobId != null) {
+  pollRefresh(refreshJobId);
+};
+
+// queues a refresh of the playlist in the background
 $('#refresh-playlist').click(async function() {
-  $('#refresh-playlist').html("<img src='{{ url_for('static', filename='images/loading.gif') }}'>");
+  $('#refresh-playlist').html("Refreshing...");
 
   $.ajax({
     url: "/refresh_playlist/" + playlistId,
     type: "POST"
-  }).done(function(response) {
-    $('#refresh-playlist').html("<a id='refresh-playlist'>Refresh Playlist</a>")
+  }).done(function(job) {
+    pollRefresh(job['id']);
   });
 });
@@ -0,0 +1,101 @@
+# times the hot catalog lookups before and after the catalog index migration (e7d3b9a5c1f8)
+# a copy of app.db is migrated to the revision before it, filled with a synthetic catalog
+# (100k tracks, 20k artists, 10k albums, 200 sources, 20 playlists), timed, migrated and timed again
+# run from the repo root: PYTHONPATH=. python benchmarks/catalog_indexes.py
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+path = os.path.join(tempfile.mkdtemp(), 'catalog.db')
+shutil.copy(os.path.join(basedir, 'app.db'), path)
+os.environ['DATABASE_URL'] = 'sqlite:///' + path
+
+from flask_migrate import upgrade
+from app import create_app
+
+BEFORE = 'c4a8f0e6b2d5'
+AFTER = 'e7d3b9a5c1f8'
+RUNS = 200
+
+QUERIES = {
+    'track by service_id': (
+        'select id from track where service_id = ?', ('sid054321',)),
+    'artist by name+service_id': (
+        'select id from artist where name = ? and service_id = ?', ('ar77', 'ars77')),
+    'album by title+service_id': (
+        'select id from album where title = ? and service_id = ?', ('al77', 'als77')),
+    'source by service_id': (
+        'select id from source where service_id = ?', ('src150',)),
+    'playlist page by track_pos': (
+        'select track_id, track_pos from playlist_track where playlist_id = ? '
+        'order by track_pos limit 15 offset 2000', (7,)),
+    'max(track_pos)': (
+        'select max(track_pos) from playlist_track where playlist_id = ?', (7,)),
+    'source tracks join': (
+        'select t.service_id from track t join track_source ts on ts.track_id = t.id '
+        'where ts.source_id = ?', (42,)),
+    'track artists join': (
+        'select a.* from artist a join track_artist ta on ta.artist_id = a.id '
+        'where ta.track_id = ?', (4242,)),
+}
+
+# replaces the copied catalog with the synthetic one
+def fill(conn):
+    for table in ['playlist_track', 'track_source', 'track_artist', 'track', 'artist', 'album', 'source', 'playlist']:
+        conn.execute(f'delete from {table}')
+
+    conn.executemany('insert into album (id, title, service, service_id) values (?, ?, ?, ?)',
+        [(i, f'al{i}', 'spotify', f'als{i}') for i in range(10000)])
+    conn.executemany('insert into artist (id, name, service, service_id) values (?, ?, ?, ?)',
+        [(i, f'ar{i}', 'spotify', f'ars{i}') for i in range(20000)])
+    conn.executemany('insert into track (id, title, service, service_id, album_id) values (?, ?, ?, ?, ?)',
+        [(i, f't{i}', 'spotify', f'sid{i:06d}', i % 10000) for i in range(100000)])
+    conn.executemany('insert into track_artist (track_id, artist_id) values (?, ?)',
+        [(i, (i * 7) % 20000) for i in range(100000)])
+    conn.executemany('insert into source (id, service, service_id) values (?, ?, ?)',
+        [(i, 'spotify', f'src{i}') for i in range(200)])
+    conn.executemany('insert into track_source (track_id, source_id) values (?, ?)',
+        [(i, i % 200) for i in range(100000)])
+    conn.executemany('insert into playlist (id, user_id, title) values (?, ?, ?)',
+        [(i, 1, 'bench') for i in range(20)])
+    conn.executemany('insert into playlist_track (playlist_id, track_id, track_pos) values (?, ?, ?)',
+        [(i % 20, i, i // 20) for i in range(100000)])
+    conn.commit()
+
+# returns the mean time in ms and the query plan of every query
+def measure():
+    conn = sqlite3.connect(path)
+    results = {}
+    for name, (query, args) in QUERIES.items():
+        plan = '; '.join(row[3] for row in conn.execute('explain query plan ' + query, args))
+        start = time.perf_counter()
+        for _ in range(RUNS):
+            conn.execute(query, args).fetchall()
+        results[name] = ((time.perf_counter() - start) / RUNS * 1000, plan)
+    conn.close()
+
+    return results
+
+app = create_app()
+with app.app_context():
+    directory = os.path.join(basedir, 'migrations')
+    upgrade(directory, BEFORE)
+    conn = sqlite3.connect(path)
+    fill(conn)
+    conn.close()
+    before = measure()
+
+    upgrade(directory, AFTER)
+    after = measure()
+
+print(f'mean of {RUNS} runs, before -> after')
+for name in QUERIES:
+    (before_ms, before_plan), (after_ms, after_plan) = before[name], after[name]
+    print(f'{name:28} {before_ms:8.3f} ms -> {after_ms:8.3f} ms')
+    print(f'{"":28} {before_plan}')
+    print(f'{"":28} {after_plan}')
+
+shutil.rmtree(os.path.dirname(path))
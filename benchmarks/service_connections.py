@@ -0,0 +1,121 @@
+# counts the TLS handshakes made when every page request builds fresh service clients
+# before: a spotipy client with its own session and a youtube resource built per request
+# after: the shared spotify_session, youtube_resource() and the youtube connection pool
+# the services are a local TLS server with a throwaway self-signed certificate (made with openssl)
+# run from the repo root: PYTHONPATH=. python benchmarks/service_connections.py
+import json
+import os
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+REQUESTS = 50 # simulated page requests, each making 3 spotify and 3 youtube calls
+
+certs = tempfile.mkdtemp()
+cert, key = os.path.join(certs, 'cert.pem'), os.path.join(certs, 'key.pem')
+subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+    '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost',
+    '-keyout', key, '-out', cert], check=True, capture_output=True)
+
+# both clients have to trust the certificate, httplib2 reads it when imported
+os.environ['REQUESTS_CA_BUNDLE'] = cert
+os.environ['HTTPLIB2_CA_CERTS'] = cert
+
+handshakes = 0
+lock = threading.Lock()
+
+# answers every GET with an empty result, counting each new connection
+class Service(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        global handshakes
+        with lock:
+            handshakes += 1
+        super().setup()
+
+    def do_GET(self):
+        body = json.dumps({'id': 'x', 'items': [], 'pageInfo': {'totalResults': 0}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+server = ThreadingHTTPServer(('localhost', 0), Service)
+context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+context.load_cert_chain(cert, key)
+server.socket = context.wrap_socket(server.socket, server_side=True)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+base = f'https://localhost:{server.server_address[1]}/'
+
+import httplib2
+import spotipy
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build
+import app.auth_external.services as services
+from app.auth_external.scheduler import schedulers
+
+# points both apis at the local server
+spotify_init = spotipy.Spotify.__init__
+def init(self, *args, **kwargs):
+    spotify_init(self, *args, **kwargs)
+    self.prefix = base + 'v1/'
+spotipy.Spotify.__init__ = init
+
+build_from_document = services.build_from_document
+services.build_from_document = lambda doc, **kwargs: build_from_document(
+    doc, client_options={'api_endpoint': base}, **kwargs)
+
+# the youtube scheduler would otherwise hold the calls to its rate and quota
+youtube_scheduler = schedulers['youtube']
+youtube_scheduler.quota.limit = 10 ** 9
+youtube_scheduler.bucket.max_rate = youtube_scheduler.bucket.rate = 10 ** 6
+youtube_scheduler.bucket.burst = youtube_scheduler.bucket.tokens = 10 ** 6
+
+credentials = Credentials(token='token')
+
+# the clients as they were built before connections were pooled
+def before():
+    spotify = spotipy.Spotify(auth='token')
+    for _ in range(3):
+        spotify.current_user()
+
+    youtube = build('youtube', 'v3', credentials=credentials, static_discovery=True,
+        client_options={'api_endpoint': base})
+    http = AuthorizedHttp(credentials, http=httplib2.Http())
+    for _ in range(3):
+        youtube.playlists().list(part='snippet', id='x').execute(http=http)
+
+# the clients as they are built now
+def after():
+    spotify = spotipy.Spotify(auth='token', requests_session=services.spotify_session)
+    for _ in range(3):
+        spotify.current_user()
+
+    youtube = services.Youtube.__new__(services.Youtube)
+    youtube.credentials = credentials
+    youtube.api = services.youtube_resource()
+    for _ in range(3):
+        youtube.execute(youtube.api.playlists().list(part='snippet', id='x'))
+
+for name, page_request in [('before', before), ('after', after)]:
+    page_request() # warms up the imports and the first build
+    handshakes = 0
+    start = time.perf_counter()
+    for _ in range(REQUESTS):
+        page_request()
+    elapsed = time.perf_counter() - start
+    print(f'{name}: {handshakes} TLS handshakes for {REQUESTS} page requests (6 API calls each), '
+          f'{elapsed / REQUESTS * 1000:.1f} ms per request')
+
+shutil.rmtree(certs)
@@ -0,0 +1,78 @@
+# compares fetching a Spotify tracklist page by page with Spotify.get_tracks,
+# which fetches the pages after the first one concurrently
+# the playlist tracks endpoint is a local stub that answers every page after LATENCY seconds
+# run from the repo root: PYTHONPATH=. python benchmarks/spotify_pages.py [sizes...]
+import json
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import spotipy
+from app.auth_external.services import Spotify
+
+LATENCY = 0.03 # seconds per page
+SIZES = [int(n) for n in sys.argv[1:]] or [1000, 10000, 50000]
+
+# serves /playlists/<total>/tracks with tracks numbered 0 to total - 1
+class PlaylistTracks(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        total = int(url.path.split('/')[-2])
+        offset = int(query['offset'][0])
+        limit = int(query['limit'][0])
+        time.sleep(LATENCY)
+
+        items = [{'track': {'id': str(i)}} for i in range(offset, min(offset + limit, total))]
+        body = json.dumps({'items': items, 'total': total}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), PlaylistTracks)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+
+api = spotipy.Spotify(auth='token')
+api.prefix = 'http://127.0.0.1:%d/' % server.server_port
+
+# a Spotify client around the stubbed api, without the oauth setup
+spotify = object.__new__(Spotify)
+spotify.api = api
+
+# the loop get_tracks used before, one page after the other until an empty page
+def serial(playlist_id):
+    tracks = []
+    offset = 0
+    while True:
+        page = api.playlist_tracks(playlist_id, limit=100, offset=offset)['items']
+        if not page:
+            break
+        tracks += page
+        offset += 100
+
+    return tracks
+
+for size in SIZES:
+    playlist_id = str(size)
+
+    start = time.perf_counter()
+    before = serial(playlist_id)
+    serial_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    after = spotify.get_tracks(playlist_id)
+    parallel_time = time.perf_counter() - start
+
+    expected = [str(i) for i in range(size)]
+    assert [t['track']['id'] for t in before] == expected
+    assert [t['track']['id'] for t in after] == expected
+    print(f'{size:>6} tracks: serial {serial_time:6.2f}s  parallel {parallel_time:6.2f}s  '
+          f'({serial_time / parallel_time:.1f}x)')
@@ -0,0 +1,154 @@
+# compares building a page of 1000 tracks through the marshmallow schemas (as track_page did
+# before) with building it from Core rows and encoding it with dump_page
+# runs on a copy of app.db migrated to the latest revision, with a synthetic playlist of
+# 1000 tracks that have 2 artists and an album each. times are the median of RUNS runs
+# run from the repo root: PYTHONPATH=. python benchmarks/track_pages.py
+import json as stdlib_json
+import os
+import shutil
+import tempfile
+import time
+
+basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+path = os.path.join(tempfile.mkdtemp(), 'pages.db')
+shutil.copy(os.path.join(basedir, 'app.db'), path)
+os.environ['DATABASE_URL'] = 'sqlite:///' + path
+
+from flask import json
+from flask_login import current_user, login_user
+from flask_migrate import upgrade
+from sqlalchemy import insert, select
+from app import create_app, db
+from app.models import User, Playlist, Track, Album, Artist, TrackSchema, AlbumSchema, ArtistSchema, \
+    playlist_track, track_artist
+from app.playlists import routes
+
+RUNS = 20
+SIZE = 1000
+
+# the schema based track_page, as it was before pages were built from rows
+def schema_page(playlist_id, after=None, offset=0, amount=15):
+    track_schema = TrackSchema()
+    artist_schema = ArtistSchema()
+    album_schema = AlbumSchema()
+
+    query = db.session.query(Track, playlist_track.c.track_pos, Album).join(
+        playlist_track, playlist_track.c.track_id == Track.id).join(
+            Playlist, Playlist.id == playlist_track.c.playlist_id).outerjoin(
+                Album, Album.id == Track.album_id).filter(
+                    Playlist.id == playlist_id,
+                    Playlist.user_id == current_user.id).order_by(
+                        playlist_track.c.track_pos)
+
+    rows = query.offset(offset).limit(amount).all()
+
+    artists = {}
+    if rows:
+        track_artists = db.session.query(track_artist.c.track_id, Artist).join(
+            track_artist, track_artist.c.artist_id == Artist.id).filter(
+                track_artist.c.track_id.in_([t.id for t, _, _ in rows]))
+
+        for track_id, artist in track_artists:
+            artists.setdefault(track_id, []).append(artist_schema.dump(artist))
+
+    data = []
+    for track, track_pos, album in rows:
+        d = track_schema.dump(track)
+        d.update({
+            'artists': artists.get(track.id, []),
+            'album': album_schema.dump(album) if album else {},
+            'track_pos': track_pos})
+        data.append(d)
+
+    return data
+
+# adds a playlist of SIZE tracks, each with 2 of 200 artists and 1 of 100 albums
+def fill(user):
+    playlist = Playlist(user_id=user.id, title='bench')
+    db.session.add(playlist)
+    db.session.commit()
+
+    db.session.execute(insert(Album.__table__), [
+        {'title': f'al{i}', 'service': 'spotify', 'service_id': f'benchal{i}',
+         'href': 'https://open.spotify.com/album/x'} for i in range(100)])
+    albums = [a for (a,) in db.session.query(Album.id).filter(Album.service_id.like('benchal%'))]
+
+    db.session.execute(insert(Artist.__table__), [
+        {'name': f'ar{i}', 'service': 'spotify', 'service_id': f'benchar{i}',
+         'href': 'https://open.spotify.com/artist/x'} for i in range(200)])
+    artists = [a for (a,) in db.session.query(Artist.id).filter(Artist.service_id.like('benchar%'))]
+
+    db.session.execute(insert(Track.__table__), [
+        {'title': f'Track number {i} ünïcode', 'service': 'spotify', 'service_id': f'bencht{i}',
+         'art': 'https://i.scdn.co/image/abc', 'href': 'https://open.spotify.com/track/abc',
+         'album_id': albums[i % len(albums)]} for i in range(SIZE)])
+    tracks = [t for (t,) in db.session.query(Track.id).filter(Track.service_id.like('bencht%'))]
+
+    db.session.execute(insert(playlist_track), [
+        {'playlist_id': playlist.id, 'track_id': t, 'track_pos': (i + 1) * 1024} for i, t in enumerate(tracks)])
+    db.session.execute(insert(track_artist), [
+        {'track_id': t, 'artist_id': artists[(i + k) % len(artists)]} for i, t in enumerate(tracks) for k in range(2)])
+    db.session.commit()
+
+    return playlist
+
+# returns the median time in ms of building and encoding a page, and the last encoded page
+def median(page, encode, playlist_id):
+    encode(page(playlist_id, amount=SIZE))
+    times = []
+    for _ in range(RUNS):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        out = encode(page(playlist_id, amount=SIZE))
+        times.append(time.perf_counter() - start)
+
+    return sorted(times)[RUNS // 2] * 1000, out
+
+# returns the mean time in ms of encoding rows that were already fetched
+def mean(encode):
+    start = time.perf_counter()
+    for _ in range(RUNS):
+        encode()
+
+    return (time.perf_counter() - start) / RUNS * 1000
+
+app = create_app()
+app.config['SECRET_KEY'] = 'bench'
+with app.test_request_context():
+    upgrade(os.path.join(basedir, 'migrations'))
+    user = User.query.first()
+    if user is None:
+        user = User(username='bench', email='bench@example.com')
+        db.session.add(user)
+        db.session.commit()
+    login_user(user)
+    playlist = fill(user)
+
+    schema_ms, schema_out = median(schema_page, json.dumps, playlist.id)
+    rows_ms, rows_out = median(routes.track_page, routes.dump_page, playlist.id)
+    print('same data:', stdlib_json.loads(schema_out) == stdlib_json.loads(rows_out))
+    print(f'page of {SIZE} tracks (queries + serialize + encode): schemas {schema_ms:.1f} ms, rows {rows_ms:.1f} ms')
+
+    # serialization and encoding alone, on results that were already fetched
+    objects = db.session.query(Track, playlist_track.c.track_pos, Album).join(
+        playlist_track, playlist_track.c.track_id == Track.id).outerjoin(
+            Album, Album.id == Track.album_id).filter(
+                playlist_track.c.playlist_id == playlist.id).all()
+    track_schema, album_schema = TrackSchema(), AlbumSchema()
+    schema_ms = mean(lambda: json.dumps([
+        dict(track_schema.dump(track), album=album_schema.dump(album) if album else {}, track_pos=pos)
+        for track, pos, album in objects]))
+
+    columns = [Track.__table__.c[f] for f in routes.TRACK_FIELDS] + [playlist_track.c.track_pos] + \
+        [Album.__table__.c[f] for f in routes.ALBUM_FIELDS]
+    rows = db.session.execute(select(*columns).select_from(Track.__table__).join(
+        playlist_track, playlist_track.c.track_id == Track.id).outerjoin(
+            Album, Album.id == Track.album_id).where(
+                playlist_track.c.playlist_id == playlist.id)).all()
+    pos = len(routes.TRACK_FIELDS)
+    rows_ms = mean(lambda: routes.dump_page([
+        dict(zip(routes.TRACK_FIELDS, row[:pos]), album=dict(zip(routes.ALBUM_FIELDS, row[pos + 1:])), track_pos=row[pos])
+        for row in rows]))
+    print(f'serialize + encode only, per {SIZE} tracks: schemas {schema_ms:.1f} ms, rows {rows_ms:.1f} ms')
+
+shutil.rmtree(os.path.dirname(path))
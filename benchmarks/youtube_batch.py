@@ -0,0 +1,59 @@
+# compares inserting videos into a youtube playlist one request at a time with
+# Youtube.execute_batch, against the local stub in youtube_stub.py
+# run from the repo root: PYTHONPATH=. python benchmarks/youtube_batch.py [inserts]
+import sys
+import time
+import youtube_stub
+from app.auth_external import services
+from app.auth_external.scheduler import schedulers
+
+INSERTS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+youtube = youtube_stub.client(services, youtube_stub.start())()
+youtube.create_api()
+scheduler = schedulers['youtube']
+scheduler.quota.limit = 10 ** 9
+
+# inserts INSERTS videos into a new playlist, optionally with the scheduler's rate raised to rate
+# appended videos are given no position, so that a failed insert does not fail the ones after it
+def bench(label, batched, rate=None, append=False):
+    if rate:
+        scheduler.bucket.max_rate = scheduler.bucket.rate = rate
+        scheduler.bucket.burst = scheduler.bucket.tokens = rate
+
+    playlist_id = f'PL{label}{batched}{rate}'
+    youtube_stub.remote[playlist_id] = []
+    round_trips = youtube_stub.stats['round_trips']
+    requests = [youtube.insert_item(playlist_id, f'v{i}', None if append else i) for i in range(INSERTS)]
+
+    start = time.perf_counter()
+    failed = 0
+    if batched:
+        for _, error in youtube.execute_batch(requests):
+            failed += error is not None
+    else:
+        for r in requests:
+            try:
+                youtube.execute(r)
+            except Exception:
+                failed += 1
+    elapsed = time.perf_counter() - start
+
+    round_trips = youtube_stub.stats['round_trips'] - round_trips
+    videos = [v for _, v in youtube_stub.remote[playlist_id]]
+    # retried appends land after the ones that went through, so only positioned inserts keep their order
+    result = f'{len(videos)} added' if append else f'in order: {videos == [f"v{i}" for i in range(INSERTS)]}'
+    print(f'{label:32s} {"batched" if batched else "one by one":10s} {INSERTS} inserts in {elapsed:6.2f}s '
+          f'= {INSERTS / elapsed:7.1f}/s, {round_trips} round trips, {failed} failed, {result}')
+
+print(f'stub: {youtube_stub.ROUND_TRIP * 1000:.0f} ms per round trip, {youtube_stub.PER_ITEM * 1000:.0f} ms per write')
+bench('default scheduler', False)
+bench('default scheduler', True)
+bench('scheduler opened up (1000/s)', False, 1000)
+bench('scheduler opened up (1000/s)', True, 1000)
+
+youtube_stub.CONFLICT = youtube_stub.RATE = 0.03
+bench('3% conflicts, 3% rate limited', False, append=True)
+bench('3% conflicts, 3% rate limited', True, append=True)
+status = scheduler.status()
+print('scheduler:', {k: status[k] for k in ('batches', 'rate_limited_calls', 'calls') if k in status})
@@ -0,0 +1,98 @@
+# pushes a tracklist of 1000 videos to a youtube playlist with push_youtube, against the
+# local stub in youtube_stub.py, then pushes it again unchanged and after edits
+# the last edited push runs the batches out of order with 5% conflicts and 5% rate limits
+# run from the repo root: PYTHONPATH=. python benchmarks/youtube_push.py
+import logging
+import random
+import time
+import youtube_stub
+from app import create_app
+from app.auth_external import services
+from app.auth_external.scheduler import schedulers, CallReport, current_report
+from app.playlists import push
+from app.playlists.jobs import Progress
+
+SIZE = 1000
+
+youtube = youtube_stub.client(services, youtube_stub.start())()
+youtube.create_api()
+scheduler = schedulers['youtube']
+scheduler.quota.limit = 10 ** 9
+scheduler.bucket.max_rate = scheduler.bucket.rate = 1000
+scheduler.bucket.burst = scheduler.bucket.tokens = 1000
+
+# hands push_youtube the stubbed client
+class Clients():
+
+    def get(self, service):
+        return youtube
+
+push.clients = Clients()
+
+# keeps the state push_youtube stores for the playlist's youtube source
+class Playlist():
+
+    def __init__(self):
+        self.state = {}
+
+    def set_source_state(self, source, **state):
+        self.state.update(state)
+
+class Source():
+    service_id = 'PLbench'
+
+# pushes local and prints the calls it took, returns the source's new state
+def run(label, local, state):
+    playlist = Playlist()
+    report = CallReport()
+    token = current_report.set(report)
+    stats = dict(youtube_stub.stats)
+
+    start = time.perf_counter()
+    push.push_youtube(playlist, Source, state, local, Progress())
+    elapsed = time.perf_counter() - start
+    current_report.reset(token)
+
+    calls = {k: youtube_stub.stats[k] - stats[k] for k in stats}
+    quota = sum(scheduler.quota.cost(e) * n for e, n in report.snapshot().get('youtube', {}).items() if e != 'total')
+    remote = [v for _, v in youtube_stub.remote[Source.service_id]]
+    wanted = [v for v in local if v not in youtube_stub.DEAD]
+    print(f'{label:44s} {elapsed:5.2f}s  round trips {calls["round_trips"]:3d} (batches {calls["batches"]}), '
+          f'writes {calls["writes"]:4d}, reads {calls["reads"]:3d}, quota {quota:6d}, remote == local {remote == wanted}')
+
+    return dict(state, **playlist.state)
+
+# moves, removes and adds videos at random places
+def edit(local, moves=0, removals=0, adds=0, prefix='new'):
+    local = local[:]
+    for _ in range(moves):
+        local.insert(random.randrange(len(local)), local.pop(random.randrange(len(local))))
+    for _ in range(removals):
+        local.pop(random.randrange(len(local)))
+    for i in range(adds):
+        local.insert(random.randrange(len(local)), f'{prefix}{i}')
+
+    return local
+
+app = create_app()
+logging.getLogger().setLevel(logging.ERROR)
+app.logger.setLevel(logging.ERROR)
+
+with app.app_context():
+    random.seed(1)
+    local = [f'v{i}' for i in range(SIZE)]
+    state = run(f'first push of {SIZE} videos', local, {'tracks_etag': None, 'etag': None, 'pushed_tracks': None})
+    state = run('unchanged', local, state)
+
+    local = edit(local, moves=10, removals=10, adds=20)
+    state = run('10 moves, 10 removals, 20 adds', local, state)
+
+    youtube_stub.SHUFFLE = True
+    youtube_stub.CONFLICT = youtube_stub.RATE = 0.05
+    local = edit(local, moves=10, adds=20, prefix='more')
+    local.insert(5, 'vdead')
+    state = run('same again, shuffled batches, 5%+5% errors', local, state)
+
+    youtube_stub.SHUFFLE = False
+    youtube_stub.CONFLICT = youtube_stub.RATE = 0
+    state = run('unchanged, retrying the missing video', local, state)
@@ -0,0 +1,207 @@
+# a local stub of the youtube playlists and playlistItems endpoints, batch endpoint included
+# every http request (a whole batch counts as one) takes ROUND_TRIP seconds and every write
+# PER_ITEM more. writes can be made to fail with conflicts or rate limits, and the parts of
+# a batch can be run out of order, as youtube does not promise to keep it
+import email
+import hashlib
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+ROUND_TRIP = 0.05 # seconds per http request
+PER_ITEM = 0.004 # seconds per write
+CONFLICT = 0.0 # share of writes failing with a 409
+RATE = 0.0 # share of writes failing with a 403 rateLimitExceeded
+SHUFFLE = False # runs the parts of a batch in random order
+DEAD = {'vdead'} # videos that do not exist
+
+remote = {} # playlist id -> list of [item id, video id]
+stats = {'round_trips': 0, 'writes': 0, 'reads': 0, 'batches': 0}
+lock = threading.Lock()
+item_ids = itertools.count(1)
+rnd = random.Random(7)
+
+def error(code, reason):
+    return code, {'error': {'code': code, 'message': reason, 'errors': [{'reason': reason}]}}
+
+def etag(obj):
+    return hashlib.md5(json.dumps(obj).encode()).hexdigest()
+
+# answers a single api request with its status code and body
+def handle(method, path, query, body, if_none_match=None):
+    path = path.rstrip('/')
+    with lock:
+        if method == 'GET' and path.endswith('/playlistItems'):
+            stats['reads'] += 1
+            items = remote.setdefault(query['playlistId'][0], [])
+            start = int(query.get('pageToken', ['0'])[0])
+            page = items[start:start + 50]
+            out = {
+                'etag': etag([start, page]),
+                'items': [{'id': i, 'snippet': {
+                    'title': v,
+                    'resourceId': {'videoId': v},
+                    'thumbnails': {'default': {'url': ''}}}} for i, v in page]}
+            if if_none_match == out['etag']:
+                return 304, None
+            if start + 50 < len(items):
+                out['nextPageToken'] = str(start + 50)
+            return 200, out
+
+        if method == 'GET' and path.endswith('/playlists'):
+            stats['reads'] += 1
+            items = remote.setdefault(query['id'][0], [])
+            tag = etag([len(items), items[:1]])
+            if if_none_match == tag:
+                return 304, None
+            return 200, {'etag': tag, 'pageInfo': {'totalResults': 1}, 'items': [{
+                'snippet': {'title': 'stub', 'thumbnails': {'default': {'url': ''}}},
+                'contentDetails': {'itemCount': len(items)}}]}
+
+        stats['writes'] += 1
+
+    time.sleep(PER_ITEM)
+    with lock:
+        r = rnd.random()
+        if r < RATE:
+            return error(403, 'rateLimitExceeded')
+        if r < RATE + CONFLICT:
+            return error(409, 'SERVICE_UNAVAILABLE')
+
+        if method == 'DELETE':
+            item_id = query['id'][0]
+            for items in remote.values():
+                for k, (i, _) in enumerate(items):
+                    if i == item_id:
+                        del items[k]
+                        return 204, None
+            return error(404, 'playlistItemNotFound')
+
+        snippet = body['snippet']
+        items = remote.setdefault(snippet['playlistId'], [])
+        video = snippet['resourceId']['videoId']
+        position = snippet.get('position')
+        if position is None:
+            position = len(items)
+        if method == 'POST':
+            if video in DEAD:
+                return error(404, 'videoNotFound')
+            if position > len(items):
+                return error(400, 'invalidPlaylistItemPosition')
+            item = [f'item{next(item_ids)}', video]
+            items.insert(position, item)
+            return 200, {'id': item[0]}
+        if method == 'PUT':
+            k = [i for i, _ in items].index(body['id'])
+            item = items.pop(k)
+            items.insert(min(position, len(items)), item)
+            return 200, {'id': item[0]}
+
+    return error(400, 'badRequest')
+
+# splits one part of a batch into its method, path, query and body
+def parse_part(raw):
+    separator = '\r\n\r\n' if '\r\n\r\n' in raw else '\n\n'
+    head, _, body = raw.partition(separator)
+    method, target, _ = head.splitlines()[0].split(' ')
+    url = urlparse(target)
+
+    return method, url.path, parse_qs(url.query), json.loads(body) if body.strip() else None
+
+class YoutubeApi(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def send(self, code, body, content_type='application/json'):
+        data = body if isinstance(body, bytes) else (b'' if body is None else json.dumps(body).encode())
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def answer(self, method):
+        with lock:
+            stats['round_trips'] += 1
+        time.sleep(ROUND_TRIP)
+
+        raw = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        url = urlparse(self.path)
+        if not url.path.startswith('/batch'):
+            body = json.loads(raw) if raw.strip() else None
+            return self.send(*handle(method, url.path, parse_qs(url.query), body, self.headers.get('If-None-Match')))
+
+        with lock:
+            stats['batches'] += 1
+        message = email.message_from_bytes(
+            b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + raw)
+        parts = message.get_payload()
+        order = list(range(len(parts)))
+        if SHUFFLE:
+            rnd.shuffle(order)
+
+        replies = {}
+        for k in order:
+            replies[k] = (parts[k]['Content-ID'], *handle(*parse_part(parts[k].get_payload())))
+
+        # replies are sent back in the order of the parts, whatever order they ran in
+        boundary = 'stubboundary'
+        out = []
+        for k in range(len(parts)):
+            content_id, code, body = replies[k]
+            data = '' if body is None else json.dumps(body)
+            out.append(
+                f'--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id[1:-1]}>\r\n\r\n'
+                f'HTTP/1.1 {code} X\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n{data}\r\n')
+        out.append(f'--{boundary}--\r\n')
+        self.send(200, ''.join(out).encode(), f'multipart/mixed; boundary={boundary}')
+
+    def do_GET(self):
+        self.answer('GET')
+
+    def do_POST(self):
+        self.answer('POST')
+
+    def do_PUT(self):
+        self.answer('PUT')
+
+    def do_DELETE(self):
+        self.answer('DELETE')
+
+    def log_message(self, *args):
+        pass
+
+# starts the stub in a background thread and returns its root url
+def start():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), YoutubeApi)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return f'http://127.0.0.1:{server.server_address[1]}/'
+
+# returns a Youtube client class whose api talks to the stub at root
+def client(services, root):
+    import httplib2
+    from google.oauth2.credentials import Credentials
+    from googleapiclient.discovery import build_from_document
+    from googleapiclient.discovery_cache import get_static_doc
+
+    doc = json.loads(get_static_doc('youtube', 'v3'))
+    doc['rootUrl'] = root
+    doc['baseUrl'] = root + doc['servicePath']
+    api = build_from_document(doc, http=httplib2.Http())
+
+    class StubYoutube(services.Youtube):
+
+        def __init__(self):
+            pass
+
+        def create_api(self):
+            self.credentials = Credentials(token='token')
+            self.api = api
+            self.expires_at = float('inf')
+
+    return StubYoutube
@@ -25,6 +25,40 @@ class Config(object):
         user-library-modify user-read-playback-position playlist-read-private user-read-email
         user-read-private user-library-read playlist-read-collaborative streaming"""
 
+    SPOTIFY_PAGE_WORKERS = int(os.environ.get('SPOTIFY_PAGE_WORKERS') or 8) # pages of a tracklist fetched at once
+
+    # keep-alive connections kept open to each service, per process
+    HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE') or 16)
+
+    # outbound calls per second to each service, and how many can be made at once after idling
+    # the rates are lowered automatically while a service is rate limiting calls
+    SPOTIFY_RATE_LIMIT = float(os.environ.get('SPOTIFY_RATE_LIMIT') or 10)
+    SPOTIFY_BURST = 20
+    YOUTUBE_RATE_LIMIT = float(os.environ.get('YOUTUBE_RATE_LIMIT') or 10)
+    YOUTUBE_BURST = 20
+    RATE_LIMIT_RETRIES = 5 # times a rate limited call is retried before giving up
+
+    # youtube's daily quota and the units each endpoint costs, other endpoints cost 1
+    YOUTUBE_DAILY_QUOTA = int(os.environ.get('YOUTUBE_DAILY_QUOTA') or 10000)
+    YOUTUBE_QUOTA_COSTS = {
+        'playlists.list': 1,
+        'playlistItems.list': 1,
+        'search.list': 100,
+        'playlists.insert': 50,
+        'playlists.update': 50,
+        'playlists.delete': 50,
+        'playlistItems.insert': 50,
+        'playlistItems.update': 50,
+        'playlistItems.delete': 50,
+    }
+
+    # requests youtube takes per batch, each still costs its own quota
+    YOUTUBE_BATCH_SIZE = 50
+
+    # spotify and youtube search results kept per process, and for how many seconds
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE') or 1024)
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 3600)
+
     # used in youtube authorization
     YOUTUBE_API_KEY = os.environ.get('YOUTUBE_API_KEY')
     YOUTUBE_API_VERSION = 'v3'
@@ -38,6 +72,37 @@ class Config(object):
         'https://www.googleapis.com/auth/youtubepartner',
         'https://www.googleapis.com/auth/youtubepartner-channel-audit']
 
+    # background jobs (e.g. playlist refreshes)
+    REFRESH_WORKERS = int(os.environ.get('REFRESH_WORKERS') or 2) # worker threads per process
+    JOB_POLL_INTERVAL = 5 # seconds between checks of the job table for new work
+    JOB_HEARTBEAT_INTERVAL = 30 # seconds between the heartbeats of a process's running jobs
+    JOB_STALE_AFTER = 120 # seconds without a heartbeat after which a running job is queued again
+    REFRESH_FETCH_WORKERS = 8 # sources fetched concurrently during a refresh
+
+    # seconds users and their services are cached between requests
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL') or 60)
+
+    # longest time a user's last_seen time is buffered before it is written
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 30)
+
+    # tracks per page of a playlist's track list
+    TRACK_PAGE_SIZE = 50
+    TRACK_PAGE_MAX = TRACK_PAGE_SIZE * 4 # most tracks a single request can ask for
+
+    # serialized pages of playlist tracks kept in memory per process
+    TRACK_PAGE_CACHE_SIZE = int(os.environ.get('TRACK_PAGE_CACHE_SIZE') or 1024)
+
+    # hits per page of a library search
+    SEARCH_PAGE_SIZE = 20
+
+    # tracks read from the database and written out at a time when exporting a playlist
+    EXPORT_CHUNK_SIZE = 500
+
+    # cross-service track matching (flask playlists match)
+    MATCH_THRESHOLD = 0.8 # lowest score at which two tracks are linked as the same song
+    MATCH_WORKERS = int(os.environ.get('MATCH_WORKERS') or os.cpu_count() or 1) # processes matching large catalogs
+    MATCH_PROCESS_THRESHOLD = 5000 # tracks to match before the work is split across processes
+
     # gets database uri from .env and fallbacks to app.db
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
@@ -0,0 +1,64 @@
+"""added track search index
+
+Revision ID: 9d4c7a1e3f52
+Revises: 6b2e9d4f8a1c
+Create Date: 2026-10-18 17:03:41.205376
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4c7a1e3f52'
+down_revision = '6b2e9d4f8a1c'
+branch_labels = None
+depends_on = None
+
+
+# written by hand, the index is not a model (see app/playlists/search.py)
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.create_table('track_search',
+        sa.Column('track_id', sa.Integer(), nullable=False),
+        sa.Column('document', postgresql.TSVECTOR(), nullable=True),
+        sa.ForeignKeyConstraint(['track_id'], ['track.id'], name=op.f('fk_track_search_track_id_track'), ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('track_id', name=op.f('pk_track_search'))
+        )
+        op.create_index('ix_track_search_document', 'track_search', ['document'], unique=False, postgresql_using='gin')
+
+        # indexes the tracks already in the catalog
+        op.execute("""
+            INSERT INTO track_search (track_id, document)
+            SELECT track.id,
+                setweight(to_tsvector('simple', coalesce(track.title, '')), 'A') ||
+                setweight(to_tsvector('simple', coalesce((SELECT string_agg(artist.name, ' ') FROM track_artist
+                    JOIN artist ON artist.id = track_artist.artist_id
+                    WHERE track_artist.track_id = track.id), '')), 'B') ||
+                setweight(to_tsvector('simple', coalesce(album.title, '')), 'C')
+            FROM track LEFT JOIN album ON album.id = track.album_id""")
+    else:
+        # remove_diacritics lets "beyonce" find "Beyoncé"
+        op.execute("""
+            CREATE VIRTUAL TABLE track_search USING fts5(
+                title, artists, album,
+                tokenize = 'unicode61 remove_diacritics 2')""")
+
+        # indexes the tracks already in the catalog
+        op.execute("""
+            INSERT INTO track_search (rowid, title, artists, album)
+            SELECT track.id, track.title,
+                (SELECT group_concat(artist.name, ' ') FROM track_artist
+                    JOIN artist ON artist.id = track_artist.artist_id
+                    WHERE track_artist.track_id = track.id),
+                album.title
+            FROM track LEFT JOIN album ON album.id = track.album_id""")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_track_search_document', table_name='track_search')
+        op.drop_table('track_search')
+    else:
+        op.execute('DROP TABLE track_search')
@@ -0,0 +1,33 @@
+"""spaced out track positions in playlist_track table
+
+Revision ID: f1c6a2b8d4e9
+Revises: e7d3b9a5c1f8
+Create Date: 2026-10-18 13:21:40.218655
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1c6a2b8d4e9'
+down_revision = 'e7d3b9a5c1f8'
+branch_labels = None
+depends_on = None
+
+# must match app.models.TRACK_POS_GAP
+TRACK_POS_GAP = 1024
+
+
+def upgrade():
+    # track positions used to be continuous, so spreading them out keeps their order
+    op.execute(f"UPDATE playlist_track SET track_pos = track_pos * {TRACK_POS_GAP}")
+
+
+def downgrade():
+    # makes the positions of each playlist continuous again
+    op.execute("""
+        UPDATE playlist_track SET track_pos = (
+            SELECT COUNT(*) FROM playlist_track p
+            WHERE p.playlist_id = playlist_track.playlist_id
+            AND p.track_pos < playlist_track.track_pos)""")
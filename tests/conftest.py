@@ -0,0 +1,42 @@
+import pytest
+from sqlalchemy import text
+from app import create_app, db
+from app.models import User
+from config import Config
+
+class TestConfig(Config):
+    TESTING = True
+    SECRET_KEY = 'test'
+
+# returns an app on an empty sqlite database holding the models' tables and
+# the search index, which the migrations create outside the models
+@pytest.fixture
+def app(tmp_path):
+    TestConfig.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + str(tmp_path / 'test.db')
+
+    app = create_app(TestConfig)
+    with app.app_context():
+        db.create_all()
+        db.session.execute(text("""
+            CREATE VIRTUAL TABLE track_search USING fts5(
+                title, artists, album,
+                tokenize = 'unicode61 remove_diacritics 2')"""))
+        db.session.commit()
+        yield app
+        db.session.remove()
+
+@pytest.fixture
+def user(app):
+    user = User(username='test', email='test@example.com')
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+# a test client logged in as the user
+@pytest.fixture
+def client(app, user):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+    return client
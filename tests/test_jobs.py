@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta
+import pytest
+from app import db
+from app.models import Job, Playlist
+from app.playlists import jobs
+from app.auth_external.scheduler import current_report
+
+@pytest.fixture
+def runner(app):
+    runner = jobs.JobRunner()
+    runner.app = app
+    return runner
+
+@pytest.fixture
+def playlist(user):
+    playlist = Playlist(user_id=user.id, title='test')
+    db.session.add(playlist)
+    db.session.commit()
+    return playlist
+
+def running_job(playlist, **values):
+    job = Job(user_id=playlist.user_id, playlist_id=playlist.id, status='running', **values)
+    db.session.add(job)
+    db.session.commit()
+    return job.id
+
+# only jobs whose process stopped reporting them alive are queued again
+def test_requeue_stale_leaves_live_jobs_alone(runner, playlist):
+    now = datetime.utcnow()
+    old = now - timedelta(seconds=runner.app.config['JOB_STALE_AFTER'] + 1)
+
+    live = running_job(playlist, started=old, heartbeat=now)
+    stale = running_job(playlist, started=old, heartbeat=old)
+    legacy = running_job(playlist, started=old)
+    recent = running_job(playlist, started=now)
+
+    runner.requeue_stale()
+
+    statuses = {job.id: job.status for job in Job.query.all()}
+    assert statuses == {live: 'running', stale: 'queued', legacy: 'queued', recent: 'running'}
+
+# a job whose outcome cannot be written does not leave its progress or call report behind
+def test_run_cleans_up_when_the_final_commit_fails(runner, playlist, monkeypatch):
+    job_id = running_job(playlist, started=datetime.utcnow())
+
+    def fail():
+        raise RuntimeError('database is locked')
+
+    monkeypatch.setitem(jobs.HANDLERS, 'refresh', lambda playlist, progress: None)
+    monkeypatch.setattr(db.session, 'commit', fail)
+
+    with pytest.raises(RuntimeError):
+        runner.run(job_id)
+
+    assert runner.progress == {}
+    assert current_report.get() is None
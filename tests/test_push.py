@@ -0,0 +1,96 @@
+import random
+import pytest
+from app.playlists.push import plan_push, longest_increasing, youtube_requests, PUSH_BATCH_SIZE
+
+# applies planned operations to a list the way spotify does
+def apply_ops(remote, ops):
+    tracks = list(remote)
+    for op in ops:
+        if op[0] == 'remove':
+            removed = set(op[1])
+            tracks = [t for t in tracks if t not in removed]
+        elif op[0] == 'move':
+            _, start, before, length = op
+            moved = tracks[start:start + length]
+            del tracks[start:start + length]
+            at = before - length if before > start else before
+            tracks[at:at] = moved
+        elif op[0] == 'add':
+            _, ids, position = op
+            assert 0 <= position <= len(tracks)
+            assert len(ids) <= PUSH_BATCH_SIZE
+            tracks[position:position] = ids
+    return tracks
+
+# builds youtube requests as tuples instead of api requests
+class FakeYoutube():
+
+    def delete_item(self, item_id):
+        return ('delete', item_id)
+
+    def move_item(self, playlist_id, item_id, video_id, position):
+        return ('move', item_id, position)
+
+    def insert_item(self, playlist_id, video_id, position):
+        return ('insert', video_id, position)
+
+# applies youtube requests, one after the other, to a list of (item id, video id)
+def apply_requests(items, requests):
+    items = list(items)
+    for request, _, _ in requests:
+        if request[0] == 'delete':
+            items = [item for item in items if item[0] != request[1]]
+        elif request[0] == 'move':
+            item = next(item for item in items if item[0] == request[1])
+            items.remove(item)
+            assert 0 <= request[2] <= len(items)
+            items.insert(request[2], item)
+        elif request[0] == 'insert':
+            assert 0 <= request[2] <= len(items)
+            items.insert(request[2], (None, request[1]))
+    return [video_id for _, video_id in items]
+
+def random_case(rng):
+    catalog = [f't{i}' for i in range(rng.randrange(1, 60))]
+    local = rng.sample(catalog, rng.randrange(len(catalog) + 1))
+    remote = [rng.choice(catalog) for _ in range(rng.randrange(60))]
+    # items without an id, e.g. local files
+    remote += [None] * rng.randrange(3)
+    rng.shuffle(remote)
+    return remote, local
+
+@pytest.mark.parametrize('seed', range(20))
+def test_plan_push_turns_remote_into_local(seed):
+    rng = random.Random(seed)
+    for _ in range(100):
+        remote, local = random_case(rng)
+        ops = plan_push(remote, local)
+        assert apply_ops(remote, ops) == local + [t for t in remote if t is None]
+
+@pytest.mark.parametrize('seed', range(20))
+def test_youtube_requests_turn_remote_into_local(seed):
+    rng = random.Random(seed)
+    for _ in range(100):
+        remote, local = random_case(rng)
+        remote = [t for t in remote if t is not None]
+        items = [(f'item{i}', t) for i, t in enumerate(remote)]
+        requests = youtube_requests(FakeYoutube(), 'playlist', items, plan_push(remote, local))
+        assert apply_requests(items, requests) == local
+
+# tracks that kept their order are not moved
+def test_plan_push_moves_only_what_changed():
+    remote = [f't{i}' for i in range(1000)]
+    local = list(remote)
+    local.insert(10, local.pop(900))
+    local.insert(500, local.pop(20))
+
+    ops = plan_push(remote, local)
+    assert [op[0] for op in ops] == ['move', 'move']
+    assert plan_push(local, local) == []
+
+def test_longest_increasing():
+    numbers = [3, 1, 4, 1, 5, 9, 2, 6, 5, 3, 5]
+    indexes = longest_increasing(numbers)
+    values = [numbers[i] for i in indexes]
+    assert values == sorted(set(values)) and len(values) == 4
+    assert longest_increasing([]) == []
@@ -0,0 +1,92 @@
+import hashlib
+import json
+from app.auth_external.services import Youtube
+from app.playlists.refresh import fetch_youtube_source
+
+# a youtube client whose playlist is a list of video ids, served in pages of 50
+# answers like youtube: 304 (none) when the etag sent along still matches
+class FakeYoutube(Youtube):
+
+    def __init__(self, videos):
+        self.videos = videos
+        self.api = self
+        self.pages = 0 # playlistItems pages downloaded
+
+    def playlistItems(self):
+        return self
+
+    def list(self, **params):
+        return params
+
+    def etag(self, obj):
+        return hashlib.md5(json.dumps(obj).encode()).hexdigest()
+
+    # the playlist's etag only covers its item count, as with the fields requested
+    def get_playlist(self, service_id, etag=None):
+        playlist = {
+            'etag': self.etag(len(self.videos)),
+            'pageInfo': {'totalResults': 1},
+            'items': [{'snippet': {'title': 'playlist', 'thumbnails': {'default': {'url': ''}}}}]}
+        return None if etag == playlist['etag'] else playlist
+
+    def execute(self, request, etag=None):
+        start = int(request.get('pageToken', 0))
+        page = {'items': [
+            {'snippet': {
+                'title': v,
+                'resourceId': {'videoId': v},
+                'thumbnails': {'default': {'url': ''}},
+                'videoOwnerChannelTitle': 'channel',
+                'videoOwnerChannelId': 'channel'}}
+            for v in self.videos[start:start + 50]]}
+        if start + 50 < len(self.videos):
+            page['nextPageToken'] = str(start + 50)
+        page['etag'] = self.etag(page)
+        if etag == page['etag']:
+            return None
+
+        self.pages += 1
+        return page
+
+def refresh(yt, state):
+    result = fetch_youtube_source(yt, dict(state, service_id='PLfake'), lambda: None)
+    return result, dict(state, **result['state'])
+
+def videos(result):
+    return [t['service_id'] for t in result['tracks']]
+
+# a video removed from the second page and one appended change neither the
+# item count nor the first page, the tracklist is still downloaded and diffed
+def test_change_past_the_first_page_is_fetched():
+    yt = FakeYoutube([f'v{i}' for i in range(120)])
+    _, state = refresh(yt, {'etag': None, 'tracks_etag': None})
+
+    yt.videos = yt.videos[:60] + yt.videos[61:] + ['new']
+    result, state = refresh(yt, state)
+    assert videos(result) == yt.videos
+
+    # the whole tracklist is compared again, but not diffed when it is unchanged
+    result, state = refresh(yt, state)
+    assert result['tracks'] is None
+
+# an unchanged tracklist of one page is not downloaded again
+def test_unchanged_single_page_is_not_downloaded():
+    yt = FakeYoutube([f'v{i}' for i in range(30)])
+    _, state = refresh(yt, {'etag': None, 'tracks_etag': None})
+    pages = yt.pages
+
+    result, state = refresh(yt, state)
+    assert result['tracks'] is None
+    assert yt.pages == pages
+
+    yt.videos[3] = 'new'
+    result, state = refresh(yt, state)
+    assert videos(result) == yt.videos
+
+# an etag stored as the first page's alone is never trusted for the whole tracklist
+def test_etag_of_the_first_page_alone_is_not_trusted():
+    yt = FakeYoutube([f'v{i}' for i in range(120)])
+    first_page = yt.execute(yt.list())['etag']
+
+    result, _ = refresh(yt, {'etag': yt.get_playlist('PLfake')['etag'], 'tracks_etag': first_page})
+    assert videos(result) == yt.videos
@@ -0,0 +1,40 @@
+from app.auth_external import services
+from app.auth_external.services import Spotify, SearchCache
+
+class FakeApi():
+
+    def __init__(self):
+        self.calls = []
+
+    def search(self, q, type, market):
+        self.calls.append((q, type, market))
+        return {'q': q}
+
+def spotify_client(api, user_id, country):
+    sp = Spotify.__new__(Spotify)
+    sp.api = api
+    sp.user_id = user_id
+    sp.country = country
+    return sp
+
+# searches without a market are only shared between users of the same country
+def test_spotify_searches_are_shared_per_country(monkeypatch):
+    monkeypatch.setattr(services, 'searches', SearchCache(16, 60))
+    api = FakeApi()
+
+    spotify_client(api, 'a', 'US').search('track', 'Song')
+    spotify_client(api, 'b', 'US').search('track', 'song')
+    assert len(api.calls) == 1
+
+    spotify_client(api, 'c', 'DE').search('track', 'song')
+    assert len(api.calls) == 2
+
+    # users whose country is unknown keep their own results
+    spotify_client(api, 'd', None).search('track', 'song')
+    spotify_client(api, 'e', None).search('track', 'song')
+    assert len(api.calls) == 4
+
+    # an explicit market is shared by everyone asking for it
+    spotify_client(api, 'f', 'US').search('track', 'song', market='FR')
+    spotify_client(api, 'g', 'DE').search('track', 'song', market='FR')
+    assert len(api.calls) == 5
@@ -0,0 +1,113 @@
+from sqlalchemy import select, func
+from app import db
+from app.models import Playlist, Source, Track, playlist_track, track_source, track_artist
+from app.playlists.sync import PlaylistSync
+
+def parsed(service_id):
+    return {
+        'service': 'spotify',
+        'service_id': service_id,
+        'title': service_id,
+        'art': '',
+        'href': '',
+        'artists': [{'name': 'artist', 'service_id': 'artist', 'href': ''}],
+        'album': None,
+    }
+
+# syncs every source of a playlist against its tracklist, in order, like a refresh does
+def refresh(playlist, tracklists):
+    sync = PlaylistSync(playlist)
+    for source, service_ids in tracklists:
+        sync.sync_source(source, [parsed(s) for s in service_ids])
+    added = sync.flush()
+    db.session.commit()
+    return added
+
+def on_playlist(playlist):
+    return set(db.session.execute(
+        select(Track.service_id).join(
+            playlist_track, playlist_track.c.track_id == Track.id).where(
+                playlist_track.c.playlist_id == playlist.id)).scalars())
+
+def sources_of(service_id):
+    return set(db.session.execute(
+        select(track_source.c.source_id).join(
+            Track, Track.id == track_source.c.track_id).where(
+                Track.service_id == service_id)).scalars())
+
+def make_playlist(user):
+    playlist = Playlist(user_id=user.id, title='test')
+    a = Source(service='spotify', service_id='a')
+    b = Source(service='spotify', service_id='b')
+    db.session.add_all([playlist, a, b])
+    db.session.flush()
+    playlist.add_source(a)
+    playlist.add_source(b)
+    db.session.commit()
+    return playlist, a, b
+
+# a track that left one source and later shows up on another, synced first,
+# is added back from the new source. the old source's stale link must not
+# make its sync remove the track again
+def test_track_moves_to_a_source_synced_earlier(user):
+    playlist, a, b = make_playlist(user)
+
+    refresh(playlist, [(a, []), (b, ['x', 'y'])])
+    assert on_playlist(playlist) == {'x', 'y'}
+
+    # b drops x, which leaves its link to b behind
+    refresh(playlist, [(a, []), (b, ['y'])])
+    assert on_playlist(playlist) == {'y'}
+
+    # x shows up on a
+    assert refresh(playlist, [(a, ['x']), (b, ['y'])]) == 1
+    assert on_playlist(playlist) == {'x', 'y'}
+    assert a.id in sources_of('x')
+
+    # and the next refresh goes through as well
+    assert refresh(playlist, [(a, ['x']), (b, ['y'])]) == 0
+    assert on_playlist(playlist) == {'x', 'y'}
+
+# a track moving from one source to another within a single refresh stays on the playlist
+def test_track_moves_between_sources_in_one_refresh(user):
+    playlist, a, b = make_playlist(user)
+    refresh(playlist, [(a, []), (b, ['x'])])
+
+    refresh(playlist, [(a, ['x']), (b, [])])
+    assert on_playlist(playlist) == {'x'}
+
+    refresh(playlist, [(a, []), (b, ['x'])])
+    assert on_playlist(playlist) == {'x'}
+
+# a track another refresh creates between the lookup and the insert of a flush
+# is linked instead of failing the refresh on the unique constraint
+def test_flush_links_tracks_created_concurrently(user, monkeypatch):
+    playlist, a, b = make_playlist(user)
+    other = Playlist(user_id=user.id, title='other')
+    db.session.add(other)
+    db.session.flush()
+    other.add_source(b)
+    db.session.commit()
+
+    sync = PlaylistSync(playlist)
+    sync.sync_source(a, [parsed('x')])
+
+    lookup = sync.lookup
+    raced = []
+    def racing_lookup(model, key, service_ids):
+        ids = lookup(model, key, service_ids)
+        if model is Track and not raced:
+            raced.append(True)
+            refresh(other, [(b, ['x'])])
+        return ids
+    monkeypatch.setattr(sync, 'lookup', racing_lookup)
+
+    assert sync.flush() == 1
+    db.session.commit()
+
+    assert raced
+    assert on_playlist(playlist) == {'x'}
+    assert on_playlist(other) == {'x'}
+    assert Track.query.filter_by(service_id='x').count() == 1
+    assert db.session.execute(
+        select(func.count()).select_from(track_artist)).scalar() == 1
@@ -0,0 +1,55 @@
+from datetime import datetime
+import pytest
+from app import db
+from app.models import Playlist, Track, playlist_track
+
+@pytest.fixture
+def playlist(user):
+    playlist = Playlist(user_id=user.id, title='test')
+    db.session.add(playlist)
+    db.session.commit()
+    return playlist
+
+# pages of a playlist that has not changed are revalidated by date as well as by etag
+def test_tracks_revalidates_with_if_modified_since(client, playlist):
+    playlist.updated = datetime(2026, 1, 2, 3, 4, 5)
+    db.session.commit()
+
+    response = client.get(f'/tracks/{playlist.id}')
+    assert response.status_code == 200
+    assert response.headers['Last-Modified'] == 'Fri, 02 Jan 2026 03:04:05 GMT'
+
+    response = client.get(f'/tracks/{playlist.id}', headers={
+        'If-Modified-Since': response.headers['Last-Modified']})
+    assert response.status_code == 304
+
+# a playlist without an updated date sends no Last-Modified, rather than the current time
+def test_tracks_without_updated_date(client, playlist):
+    playlist.updated = None
+    db.session.commit()
+
+    response = client.get(f'/tracks/{playlist.id}')
+    assert response.status_code == 200
+    assert 'Last-Modified' not in response.headers
+
+# the page can still be given in the url of get_tracks
+def test_get_tracks_legacy_url(client, playlist):
+    assert client.post(f'/get_tracks/{playlist.id}/0/15').get_json() == []
+    assert client.post(f'/get_tracks/{playlist.id}?offset=0&amount=15').get_json() == []
+
+# a page never holds more than TRACK_PAGE_MAX tracks, and asking for none is an error
+def test_page_size_is_bounded(app, client, playlist):
+    for i in range(3):
+        track = Track(service='spotify', service_id=f't{i}', title=f't{i}')
+        db.session.add(track)
+        db.session.flush()
+        db.session.execute(playlist_track.insert().values(
+            playlist_id=playlist.id, track_id=track.id, track_pos=i))
+    db.session.commit()
+    app.config['TRACK_PAGE_MAX'] = 2
+
+    assert len(client.get(f'/tracks/{playlist.id}?amount=10000000').get_json()) == 2
+    assert len(client.post(f'/get_tracks/{playlist.id}?amount=10000000').get_json()) == 2
+    assert len(client.post(f'/get_tracks/{playlist.id}/0/10000000').get_json()) == 2
+    assert client.get(f'/tracks/{playlist.id}?amount=0').status_code == 400
+    assert client.post(f'/get_tracks/{playlist.id}?amount=-5').status_code == 400